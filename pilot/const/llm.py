@@ -1,5 +1,56 @@
 import os
 MAX_GPT_MODEL_TOKENS = int(os.getenv('MAX_TOKENS', 8192))
 MIN_TOKENS_FOR_GPT_RESPONSE = 600
+# Context window of the model, looked up in MODEL_CONTEXT_WINDOWS by default (see `get_context_window()`)
+LLM_CONTEXT_WINDOW = int(os.getenv('LLM_CONTEXT_WINDOW', 0)) or None
+# Context windows of the known models, by model name prefix (the longest matching prefix wins)
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-1106': 128000,
+    'gpt-4-0125': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4-vision': 128000,
+    'gpt-4o': 128000,
+    'claude-2': 100000,
+    'claude-3': 200000,
+}
+# Compact long conversations before they hit the context window of the model (see helpers/ConvoCompactor.py)
+CONVO_COMPACTION = os.getenv('CONVO_COMPACTION', 'true').lower() != 'false'
+# 'stable' keeps earlier messages unchanged so providers can cache the prompt prefix (see helpers/AgentConvo.py)
+STABLE_CONVO_LAYOUT = os.getenv('CONVO_LAYOUT', 'default').lower() == 'stable'
+# Conversation branches kept in memory, the least recently used ones are spilled to disk (see helpers/ConvoBranches.py)
+CONVO_BRANCHES_IN_MEMORY = int(os.getenv('CONVO_BRANCHES_IN_MEMORY', 0)) or None
 MAX_QUESTIONS = 5
-END_RESPONSE = "EVERYTHING_CLEAR"
\ No newline at end of file
+END_RESPONSE = "EVERYTHING_CLEAR"
+
+# Streamed LLM output is printed at line breaks or after this many milliseconds (see utils/stream_output.py)
+STREAM_FLUSH_INTERVAL = int(os.getenv('STREAM_FLUSH_INTERVAL_MS', 40)) / 1000
+
+# HTTP connection pooling for LLM requests (see utils/llm_sessions.py)
+LLM_POOL_SIZE = int(os.getenv('LLM_POOL_SIZE', 10))
+LLM_KEEP_ALIVE = os.getenv('LLM_KEEP_ALIVE', 'true').lower() != 'false'
+# Concurrent requests of independent conversations forked off one (see `AgentConvo.fork_join()`)
+LLM_MAX_PARALLEL_REQUESTS = int(os.getenv('LLM_MAX_PARALLEL_REQUESTS', 4))
+
+# Routing table picking the model, endpoint, max_tokens and context per prompt or step (see utils/llm_routing.py)
+LLM_ROUTES = os.getenv('LLM_ROUTES')
+# Fast model for small classification and summary prompts
+LLM_FAST_MODEL = os.getenv('LLM_FAST_MODEL')
+
+# How the JSON schema of function calls is sent (see utils/function_calling.py): 'prompt' appends it to the
+# messages, 'tools' sends it as a native tool, 'json_object' also asks for a JSON response format
+LLM_JSON_TRANSPORT = os.getenv('LLM_JSON_TRANSPORT', 'prompt').lower()
+
+# Write the LLM request metrics (see utils/llm_metrics.py) to this JSON file at exit
+LLM_METRICS_FILE = os.getenv('LLM_METRICS_FILE')
+
+# Hedging and failover between the endpoints in LLM_ENDPOINTS (see utils/llm_endpoints.py)
+LLM_HEDGE_AFTER = int(os.getenv('LLM_HEDGE_AFTER_MS', 10000)) / 1000
+LLM_FAILOVER_RETRIES = int(os.getenv('LLM_FAILOVER_RETRIES', 3))
+
+# Streamed LLM responses which stall are cancelled and retried (see utils/llm_endpoints.py)
+LLM_CONNECT_TIMEOUT = int(os.getenv('LLM_CONNECT_TIMEOUT_MS', 10000)) / 1000
+LLM_FIRST_BYTE_TIMEOUT = int(os.getenv('LLM_FIRST_BYTE_TIMEOUT_MS', 120000)) / 1000
+LLM_IDLE_TIMEOUT = int(os.getenv('LLM_IDLE_TIMEOUT_MS', 30000)) / 1000
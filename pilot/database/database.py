@@ -1,6 +1,7 @@
 from playhouse.shortcuts import model_to_dict
 from utils.style import color_yellow, color_red
-from peewee import DoesNotExist, IntegrityError
+from peewee import DoesNotExist, IntegrityError, chunked, fn
+from playhouse.migrate import PostgresqlMigrator, SqliteMigrator, migrate
 from functools import reduce
 import operator
 import psycopg2
@@ -27,6 +28,9 @@ from database.models.user_apps import UserApps
 from database.models.user_inputs import UserInputs
 from database.models.files import File
 from database.models.feature import Feature
+from database.models.llm_requests import LLMRequests
+from database.models.content_blobs import ContentBlob
+from utils.content_store import content_store, encode_content, hash_content
 
 TABLES = [
             User,
@@ -45,8 +49,26 @@ TABLES = [
             UserInputs,
             File,
             Feature,
+            LLMRequests,
+            ContentBlob,
         ]
 
+# How `get_llm_usage()` can group the LLM requests
+LLM_USAGE_GROUPS = {
+    'app': (App.id, App.name),
+    # Task numbers start over in every app
+    'task': (App.id, App.name, LLMRequests.task),
+    'prompt_path': (LLMRequests.req_type, LLMRequests.prompt_path),
+    'model': (LLMRequests.model,),
+}
+LLM_USAGE_TOTALS = ('requests', 'prompt_tokens', 'completion_tokens', 'cached_tokens', 'duration')
+# Rows per query when saving or migrating blobs, within the SQLite limit of query parameters
+BLOBS_BATCH_SIZE = 100
+# Models with saved conversations, which may reference blobs (see `utils/content_store.py`)
+MESSAGES_MODELS = [table for table in TABLES if 'messages' in table._meta.fields]
+# Whether steps were deleted since the unused blobs were last deleted, see `delete_unused_blobs_if_needed()`
+steps_deleted = False
+
 
 def get_created_apps():
     return [model_to_dict(app) for app in App.select().where((App.name.is_null(False)) & (App.status.is_null(False)))]
@@ -271,7 +293,7 @@ def hash_and_save_step(Model, app_id, unique_data_fields, data_fields, message):
     return record
 
 
-def save_development_step(project, prompt_path, prompt_data, messages, llm_response, exception=None):
+def save_development_step(project, prompt_path, prompt_data, messages, llm_response, exception=None, metrics=None):
     data_fields = {
         'messages': messages,
         'llm_response': llm_response,
@@ -288,24 +310,210 @@ def save_development_step(project, prompt_path, prompt_data, messages, llm_respo
         'high_level_step': project.current_step,
     }
 
+    save_content_blobs(messages)
     development_step = hash_and_save_step(DevelopmentSteps, project.args['app_id'], unique_data, data_fields,
                                           "Saved Development Step")
     project.checkpoints['last_development_step'] = development_step
 
     project.save_files_snapshot(development_step.id)
+    save_llm_request(project, metrics, development_step)
 
     return development_step
 
 
+def save_llm_request(project, metrics, development_step=None):
+    """
+    Save the token usage and latency of an LLM request to the ledger, including failed requests.
+
+    :param project: project
+    :param metrics: `utils.llm_metrics.RequestMetrics` of the request
+    :param development_step: (optional) the development step the request was made for
+    :return: the saved request, or None if no request was sent, eg. the response came from the LLM cache
+    """
+    if metrics is None or not metrics.attempts:
+        return None
+    return LLMRequests.create(
+        app=project.args['app_id'],
+        development_step=development_step,
+        task=project.current_task,
+        req_type=metrics.req_type,
+        prompt_path=metrics.prompt_path,
+        model=metrics.model,
+        endpoint=metrics.endpoint,
+        prompt_tokens=metrics.prompt_tokens,
+        completion_tokens=metrics.completion_tokens,
+        cached_tokens=metrics.cached_tokens,
+        usage_reported=metrics.usage_reported,
+        attempts=metrics.attempts,
+        ttft=metrics.ttft,
+        duration=metrics.duration,
+        error=metrics.error,
+    )
+
+
+def get_llm_usage(app_id=None, group_by='app'):
+    """
+    Report the tokens and time spent on LLM requests, most tokens first.
+
+    :param app_id: (optional) only report the requests of this app
+    :param group_by: 'app', 'task', 'prompt_path' or 'model', see `LLM_USAGE_GROUPS`
+    :return: [{group fields..., and the `LLM_USAGE_TOTALS`}, ...]
+    """
+    if group_by not in LLM_USAGE_GROUPS:
+        raise ValueError(f"Unable to group LLM usage by {group_by}, use one of: {', '.join(LLM_USAGE_GROUPS)}")
+
+    group = LLM_USAGE_GROUPS[group_by]
+    total_tokens = fn.SUM(LLMRequests.prompt_tokens) + fn.SUM(LLMRequests.completion_tokens)
+    query = (LLMRequests
+             .select(*group,
+                     fn.COUNT(LLMRequests.id).alias('requests'),
+                     fn.SUM(LLMRequests.prompt_tokens).alias('prompt_tokens'),
+                     fn.SUM(LLMRequests.completion_tokens).alias('completion_tokens'),
+                     fn.SUM(LLMRequests.cached_tokens).alias('cached_tokens'),
+                     fn.SUM(LLMRequests.duration).alias('duration'))
+             .join(App)
+             .group_by(*group)
+             .order_by(total_tokens.desc()))
+    if app_id is not None:
+        query = query.where(LLMRequests.app == app_id)
+
+    usage = []
+    for row in query.dicts():
+        if 'id' in row:
+            row['id'] = str(row['id'])
+        for key in LLM_USAGE_TOTALS:
+            row[key] = row[key] or 0
+        row['duration'] = round(row['duration'], 1)
+        usage.append(row)
+    return usage
+
+
 def get_saved_development_step(project):
     development_step = get_db_model_from_hash_id(DevelopmentSteps, project.args['app_id'],
                                                  project.checkpoints['last_development_step'], project.current_step)
 
     if development_step is None and project.skip_steps:
         project.finish_loading()
+    elif development_step is not None:
+        load_content_blobs(development_step.messages)
     return development_step
 
 
+def save_content_blobs(messages):
+    """
+    Save the file contents referenced in the messages which are not in the database yet, see `utils/content_store.py`.
+
+    :param messages: [{ "role": "system"|"assistant"|"user", "content": string }, ... ]
+    """
+    contents = content_store.unsaved(messages)
+    if not contents:
+        return
+
+    ContentBlob.insert_many([
+        {'hash': content_hash, 'content': content.encode('utf-8', errors='surrogatepass')}
+        for content_hash, content in contents.items()
+    ]).on_conflict_ignore().execute()
+    content_store.add(contents, saved=True)
+
+
+def save_blobs(contents):
+    """
+    Save the contents which are not in the database yet, see `ContentBlob`.
+
+    Only the hashes of the contents which weren't saved by this process before are looked up,
+    and only the new contents are sent to the database.
+
+    :param contents: list of file contents, str or bytes
+    :return: the hashes of the contents, in the same order
+    """
+    hashes = [hash_content(content) for content in contents]
+    insert_new_blobs({content_hash: encode_content(content) for content_hash, content in zip(hashes, contents)
+                      if not content_store.is_saved(content_hash)})
+    content_store.mark_saved(hashes)
+    return hashes
+
+
+def insert_new_blobs(blobs):
+    """
+    :param blobs: {hash: bytes}
+    :return: {hash: bytes} of the blobs which were not in the database
+    """
+    new_blobs = dict(blobs)
+    for batch in chunked(list(blobs), BLOBS_BATCH_SIZE):
+        for blob in ContentBlob.select(ContentBlob.hash).where(ContentBlob.hash.in_(batch)):
+            del new_blobs[blob.hash]
+    for batch in chunked(new_blobs.items(), BLOBS_BATCH_SIZE):
+        ContentBlob.insert_many([
+            {'hash': content_hash, 'content': content} for content_hash, content in batch
+        ]).on_conflict_ignore().execute()
+    return new_blobs
+
+
+def delete_unused_blobs():
+    """
+    Delete the blobs which neither a file snapshot nor a saved conversation references anymore,
+    eg. after the development steps they were saved with were deleted.
+
+    :return: number of blobs deleted
+    """
+    unused = {content_hash for content_hash, in ContentBlob.select(ContentBlob.hash).where(
+        ContentBlob.hash.not_in(FileSnapshot.select(FileSnapshot.blob).where(FileSnapshot.blob.is_null(False)))
+    ).tuples()}
+    for model in MESSAGES_MODELS:
+        if not unused:
+            break
+        for messages, in model.select(model.messages).where(model.messages.is_null(False)).tuples().iterator():
+            for message in messages or []:
+                unused.difference_update(content_store.references(message.get('content') or ''))
+
+    for batch in chunked(list(unused), BLOBS_BATCH_SIZE):
+        ContentBlob.delete().where(ContentBlob.hash.in_(batch)).execute()
+    content_store.mark_unsaved(unused)
+    if unused:
+        logger.info(f'Deleted {len(unused)} unused blobs')
+    return len(unused)
+
+
+def mark_steps_deleted():
+    """
+    Record that steps were deleted, their blobs are deleted once at exit: `delete_unused_blobs()` reads
+    every saved conversation, that's too slow to do for every deletion.
+    """
+    global steps_deleted
+    steps_deleted = True
+
+
+def delete_unused_blobs_if_needed():
+    """
+    Delete the unused blobs if steps were deleted since they were last deleted, see `mark_steps_deleted()`.
+
+    :return: number of blobs deleted
+    """
+    global steps_deleted
+    if not steps_deleted:
+        return 0
+    steps_deleted = False
+    return delete_unused_blobs()
+
+
+def load_content_blobs(messages):
+    """
+    Load the file contents referenced in the messages into `content_store`, see `utils/content_store.py`.
+
+    :param messages: [{ "role": "system"|"assistant"|"user", "content": string }, ... ]
+    """
+    missing = content_store.missing(messages or [])
+    if not missing:
+        return
+
+    contents = {}
+    for blob in ContentBlob.select().where(ContentBlob.hash.in_(missing)):
+        # `SmartBlobField` only decodes valid UTF-8
+        contents[blob.hash] = blob.content if isinstance(blob.content, str) \
+            else blob.content.decode('utf-8', errors='surrogatepass')
+    content_store.add(contents, saved=True)
+
+
 def save_command_run(project, command, cli_response, done_or_error_response, exit_code):
     if project.current_step != 'coding':
         return
@@ -378,6 +586,7 @@ def delete_all_subsequent_steps(project):
     delete_subsequent_steps(DevelopmentSteps, app, project.checkpoints['last_development_step'])
     delete_subsequent_steps(CommandRuns, app, project.checkpoints['last_command_run'])
     delete_subsequent_steps(UserInputs, app, project.checkpoints['last_user_input'])
+    mark_steps_deleted()
 
 
 def delete_subsequent_steps(Model, app, step):
@@ -390,6 +599,8 @@ def delete_subsequent_steps(Model, app, step):
             subsequent_step.delete_instance()
             if Model == DevelopmentSteps:
                 FileSnapshot.delete().where(FileSnapshot.development_step == subsequent_step).execute()
+                (LLMRequests.update(development_step=None)
+                 .where(LLMRequests.development_step == subsequent_step).execute())
                 Feature.delete().where(Feature.previous_step == subsequent_step).execute()
 
 
@@ -404,9 +615,10 @@ def get_all_connected_steps(step, previous_step_field_name):
 
 
 def delete_all_app_development_data(app):
-    models = [DevelopmentSteps, CommandRuns, UserInputs, UserApps, File, FileSnapshot]
+    models = [DevelopmentSteps, CommandRuns, UserInputs, UserApps, File, FileSnapshot, LLMRequests]
     for model in models:
         model.delete().where(model.app == app).execute()
+    mark_steps_deleted()
 
 
 def delete_unconnected_steps_from(step, previous_step_field_name):
@@ -460,6 +672,65 @@ def create_tables():
         database.create_tables(TABLES)
 
 
+def migrate_file_snapshots():
+    """
+    Move the contents of the file snapshots saved before the blobs (see `FileSnapshot`) to `ContentBlob`,
+    so each content is stored once, and add the `blob_id` column to the `file_snapshot` table if needed.
+
+    :return: {'snapshots': number of snapshots moved, 'blobs': number of blobs created,
+              'bytes_before': size of the moved contents, 'bytes_after': size of the blobs created,
+              'bytes_saved': bytes_before - bytes_after}, or None if there was nothing to move
+    """
+    db = FileSnapshot._meta.database
+    if db.deferred:
+        return None
+
+    table = FileSnapshot._meta.table_name
+    if 'blob_id' not in [column.name for column in db.get_columns(table)]:
+        migrator = PostgresqlMigrator(db) if DATABASE_TYPE == 'postgres' else SqliteMigrator(db)
+        with db.atomic():
+            migrate(
+                migrator.add_column(table, 'blob_id', FileSnapshot.blob),
+                migrator.drop_not_null(table, 'content'),
+            )
+
+    report = {'snapshots': 0, 'blobs': 0, 'bytes_before': 0, 'bytes_after': 0}
+    while True:
+        with db.atomic():
+            snapshots = list(FileSnapshot.select(FileSnapshot.id, FileSnapshot.content)
+                             .where(FileSnapshot.blob.is_null() & FileSnapshot.content.is_null(False))
+                             .limit(BLOBS_BATCH_SIZE))
+            if not snapshots:
+                break
+
+            snapshots_by_hash = {}
+            blobs = {}
+            for snapshot in snapshots:
+                content = encode_content(snapshot.content)
+                content_hash = hash_content(content)
+                snapshots_by_hash.setdefault(content_hash, []).append(snapshot.id)
+                blobs[content_hash] = content
+                report['bytes_before'] += len(content)
+
+            new_blobs = insert_new_blobs(blobs)
+            for content_hash, snapshot_ids in snapshots_by_hash.items():
+                (FileSnapshot.update(blob=content_hash, content=None)
+                 .where(FileSnapshot.id.in_(snapshot_ids)).execute())
+
+            report['snapshots'] += len(snapshots)
+            report['blobs'] += len(new_blobs)
+            report['bytes_after'] += sum(len(content) for content in new_blobs.values())
+
+    if report['snapshots'] == 0:
+        return None
+
+    report['bytes_saved'] = report['bytes_before'] - report['bytes_after']
+    if DATABASE_TYPE == 'sqlite' and not db.in_transaction():
+        # Give the space of the moved contents back to the file system
+        db.execute_sql('VACUUM')
+    return report
+
+
 def drop_tables():
     with database.atomic():
         for table in TABLES:
@@ -508,14 +779,14 @@ def create_database():
 
 
 def tables_exist():
-    if DATABASE_TYPE == "postgres":
-        for table in TABLES:
-            try:
-                database.get_tables().index(table._meta.table_name)
-            except ValueError:
-                return False
-    else:
-        pass
+    if database.deferred:
+        # No database to check, `DB_NAME` is not set
+        return True
+
+    existing_tables = database.get_tables()
+    for table in TABLES:
+        if table._meta.table_name not in existing_tables:
+            return False
     return True
 
 
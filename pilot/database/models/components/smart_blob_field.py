@@ -0,0 +1,30 @@
+import logging
+
+from peewee import BlobField
+
+log = logging.getLogger(__name__)
+
+
+class SmartBlobField(BlobField):
+    """
+    A binary blob field that can also accept/return utf-8 strings.
+
+    This is a temporary workaround for the fact that we're passing either binary
+    or string contents to the database. Once this is cleaned up, we should only
+    accept binary content and explcitily convert from/to strings as needed.
+    """
+
+    def db_value(self, value):
+        if isinstance(value, str):
+            log.warning("Blob content is a string, expected bytes, working around it.")
+            value = value.encode("utf-8")
+        return super().db_value(value)
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        val = bytes(super().python_value(value))
+        try:
+            return val.decode("utf-8")
+        except UnicodeDecodeError:
+            return val
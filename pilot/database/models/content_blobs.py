@@ -0,0 +1,16 @@
+from peewee import CharField
+
+from database.models.components.base_models import BaseModel
+from database.models.components.smart_blob_field import SmartBlobField
+
+
+class ContentBlob(BaseModel):
+    """
+    File contents by their SHA-256 hash, stored once however many times they're referenced,
+    by the messages (see `utils/content_store.py`) or by the file snapshots (see `FileSnapshot`).
+    """
+    hash = CharField(primary_key=True, max_length=64)
+    content = SmartBlobField()
+
+    class Meta:
+        table_name = 'content_blobs'
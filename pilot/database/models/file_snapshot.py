@@ -1,46 +1,30 @@
-import logging
-
-from peewee import ForeignKeyField, BlobField
+from peewee import ForeignKeyField
 
 from database.models.components.base_models import BaseModel
+from database.models.components.smart_blob_field import SmartBlobField
+from database.models.content_blobs import ContentBlob
 from database.models.development_steps import DevelopmentSteps
 from database.models.app import App
 from database.models.files import File
 
-log = logging.getLogger(__name__)
-
 
-class SmartBlobField(BlobField):
+class FileSnapshot(BaseModel):
     """
-    A binary blob field that can also accept/return utf-8 strings.
-
-    This is a temporary workaround for the fact that we're passing either binary
-    or string contents to the database. Once this is cleaned up, we should only
-    accept binary content and explcitily convert from/to strings as needed.
+    The content of a file at a development step. The content itself is a `ContentBlob`, stored once however
+    many snapshots have it, see `save_blobs()` in `database/database.py`.
     """
-
-    def db_value(self, value):
-        if isinstance(value, str):
-            log.warning("FileSnapshot content is a string, expected bytes, working around it.")
-            value = value.encode("utf-8")
-        return super().db_value(value)
-
-    def python_value(self, value):
-        val = bytes(super().python_value(value))
-        try:
-            return val.decode("utf-8")
-        except UnicodeDecodeError:
-            return val
-
-
-class FileSnapshot(BaseModel):
     app = ForeignKeyField(App, on_delete='CASCADE')
     development_step = ForeignKeyField(DevelopmentSteps, backref='files', on_delete='CASCADE')
     file = ForeignKeyField(File, on_delete='CASCADE', null=True)
-    content = SmartBlobField()
+    blob = ForeignKeyField(ContentBlob, null=True)
+    # Content of the snapshots saved before the blobs, moved to `blob` by `migrate_file_snapshots()`
+    content = SmartBlobField(null=True)
 
     class Meta:
         table_name = 'file_snapshot'
         indexes = (
             (('development_step', 'file'), True),
         )
+
+    def get_content(self):
+        return self.blob.content if self.blob_id is not None else self.content
@@ -0,0 +1,33 @@
+from peewee import ForeignKeyField, AutoField, TextField, IntegerField, CharField, FloatField, BooleanField
+
+from database.models.components.base_models import BaseModel
+from database.models.app import App
+from database.models.development_steps import DevelopmentSteps
+
+
+class LLMRequests(BaseModel):
+    """
+    Token usage and latency of the LLM requests, see `utils.llm_metrics.RequestMetrics`.
+
+    Token counts are the ones reported by the provider when `usage_reported` is set, else local tiktoken counts.
+    """
+    id = AutoField()
+    app = ForeignKeyField(App, on_delete='CASCADE')
+    # Kept when the step is deleted, the tokens were spent anyway
+    development_step = ForeignKeyField(DevelopmentSteps, null=True, on_delete='SET NULL')
+    task = IntegerField(null=True)
+    req_type = CharField(null=True)
+    prompt_path = TextField(null=True)
+    model = CharField(null=True)
+    endpoint = CharField(null=True)
+    prompt_tokens = IntegerField(null=True)
+    completion_tokens = IntegerField(default=0)
+    cached_tokens = IntegerField(null=True)
+    usage_reported = BooleanField(default=False)
+    attempts = IntegerField(default=1)
+    ttft = FloatField(null=True)
+    duration = FloatField(null=True)
+    error = CharField(null=True)
+
+    class Meta:
+        table_name = 'llm_requests'
@@ -1,24 +1,46 @@
+import asyncio
 import json
-import re
 import subprocess
-import uuid
+import time
 from utils.style import color_yellow, color_yellow_bold
 
-from database.database import get_saved_development_step, save_development_step, delete_all_subsequent_steps
+from database.database import get_saved_development_step, save_development_step, delete_all_subsequent_steps, \
+    save_llm_request
 from helpers.exceptions.TokenLimitError import TokenLimitError
-from utils.function_calling import parse_agent_response, FunctionCallSet
-from utils.llm_connection import create_gpt_chat_completion
+from utils.content_store import content_store, hash_content
+from utils.function_calling import parse_agent_response, schema_registry, FunctionCallSet
+from utils.llm_connection import create_gpt_chat_completion, acreate_gpt_chat_completion
+from utils.llm_metrics import RequestMetrics
+from utils.llm_routing import llm_router
+from utils.llm_response import LLMResponse
+from utils.token_counter import token_counter, TOKENS_PER_REPLY
 from utils.utils import get_prompt, get_sys_message, capitalize_first_word_with_underscores
 from logger.logger import logger
 from prompts.prompts import ask_user
-from const.llm import END_RESPONSE
+from const.llm import END_RESPONSE, CONVO_COMPACTION, STABLE_CONVO_LAYOUT, CONVO_BRANCHES_IN_MEMORY, \
+    LLM_MAX_PARALLEL_REQUESTS
 from helpers.cli import running_processes
+from helpers.ConvoBranches import ConvoBranches
+from helpers.ConvoCompactor import ConvoCompactor, FILE_LISTING_RE
 
 
 class AgentConvo:
     """
     Represents a conversation with an agent.
 
+    By default, the files listed in earlier messages are updated to their current content before every
+    request. With `CONVO_LAYOUT=stable`, earlier messages are never changed: the files which changed since
+    they were last listed are listed again in a new message before the latest prompt, so the conversation
+    so far is a stable prefix which LLM providers can cache.
+
+    Files are listed with a reference to their content (see `utils/content_store.py`) instead of the content
+    itself, the messages are rendered with the full contents when they're sent. Prompts only list the files
+    which are new or changed since they were last listed in the conversation, see `get_files_to_send()`.
+
+    Saved branches share `self.messages` instead of copying it, so the messages a branch points to are never
+    changed in place: `self.messages` is only appended to, and is copied before a message is replaced
+    (see `replace_message()`).
+
     Args:
         agent: An instance of the agent participating in the conversation.
     """
@@ -26,7 +48,23 @@ class AgentConvo:
     def __init__(self, agent):
         # [{'role': 'system'|'user'|'assistant', 'content': ''}, ...]
         self.messages: list[dict] = []
-        self.branches = {}
+        # [(content, tokens), ...] for each message in `self.messages`, see `get_token_count()`
+        self.message_tokens: list[tuple[str, int]] = []
+        self.token_count = TOKENS_PER_REPLY
+        # [(content, {file path: hash of the listed content}), ...] for each message in `self.messages`,
+        # see `replace_files()`
+        self.message_files: list[tuple[str, dict[str, str]]] = []
+        # Time spent updating the files listed in the messages, see `replace_files()`
+        self.replace_files_stats = {'calls': 0, 'duration': 0.0, 'messages_updated': 0, 'files_updated': 0}
+        self.compactor = ConvoCompactor()
+        # [{'tokens_before': int, 'tokens_after': int, 'files_collapsed': [str], ...}, ...]
+        self.compactions: list[dict] = []
+        self.stable_layout = STABLE_CONVO_LAYOUT
+        # [(role, content), ...] of the last request, see `get_stable_prefix_tokens()`
+        self.sent_messages: list[tuple[str, str]] = []
+        self.branches = ConvoBranches(CONVO_BRANCHES_IN_MEMORY)
+        # (message list, number of messages) shared with the saved branches, see `copy_on_write()`
+        self.shared_messages: tuple[list[dict], int] = ([], 0)
         self.log_to_user = True
         self.agent = agent
         self.high_level_step = self.agent.project.current_step
@@ -49,49 +87,255 @@ class AgentConvo:
         Returns:
             The response from the agent.
         """
+        prompt_data = self.add_prompt(prompt_path, prompt_data)
+
+        # check if we already have the LLM response saved
+        development_step = self.get_development_step_to_restore()
+        if development_step is not None:
+            # if we do, use it
+            response, should_log_message = self.restore_development_step(development_step, should_log_message)
+        else:
+            # if we don't, get the response from LLM
+            response = self.send_request(prompt_path, prompt_data, function_calls)
+
+        return self.add_response(response, function_calls, should_log_message)
+
+    def send_request(self, prompt_path, prompt_data, function_calls: FunctionCallSet = None):
+        """
+        Sends the conversation, ending with the prompt, to the LLM and saves the development step.
+
+        Returns:
+            The response from the LLM.
+        """
+        metrics = None
+        try:
+            messages, stable_prefix_tokens, metrics = self.prepare_request(prompt_path, function_calls)
+            response = create_gpt_chat_completion(messages, self.high_level_step, self.agent.project,
+                                                  function_calls=function_calls, prompt_path=prompt_path,
+                                                  stable_prefix_tokens=stable_prefix_tokens, metrics=metrics)
+        except TokenLimitError as e:
+            save_development_step(self.agent.project, prompt_path, prompt_data, self.messages, '', str(e),
+                                  metrics=metrics)
+            raise e
+        self.save_development_step(prompt_path, prompt_data, response, metrics)
+        return response
+
+    def fork(self) -> 'AgentConvo':
+        """
+        Returns:
+            A new conversation with the messages of this one so far, see `fork_join()`.
+        """
+        convo = AgentConvo(self.agent)
+        convo.messages = self.messages.copy()
+        convo.high_level_step = self.high_level_step
+        convo.log_to_user = self.log_to_user
+        return convo
+
+    def fork_join(self, requests: list[tuple], max_parallel: int = LLM_MAX_PARALLEL_REQUESTS,
+                  should_log_message=True) -> list:
+        """
+        Sends independent messages, each in its own fork of this conversation, with at most `max_parallel`
+        requests to the LLM at a time.
+
+        The development steps are restored and saved in the order of `requests`, as if the messages were sent
+        one after the other with `send_message()`, so they are replayed the same way with `skip_steps`.
+        The responses aren't printed while they stream but logged in the same order. If a request fails or gets
+        an empty response, the requests after it are cancelled, and it and the cancelled ones are sent again one
+        after the other with `send_request()`, which asks the user what to do if a request fails again.
+
+        >>> responses = convo.fork_join([
+        ...     ('development/get_fully_coded_file.prompt', {'file': file, 'new_file': new_file}, GET_FULLY_CODED_FILE)
+        ...     for file, new_file in files])
+
+        Args:
+            requests: [(prompt_path, prompt_data, function_calls), ...]
+            max_parallel: The maximum number of concurrent requests to the LLM (`LLM_MAX_PARALLEL_REQUESTS`).
+            should_log_message: Flag if final responses should be logged.
+        Returns:
+            The responses, in the order of `requests`.
+        """
+        forks = [self.fork() for _ in requests]
+        prompts = []
+        responses = []
+        restoring = True
+
+        for convo, (prompt_path, prompt_data, function_calls) in zip(forks, requests):
+            prompt_data = convo.add_prompt(prompt_path, prompt_data)
+            # Once a step isn't found, the next ones can't be either: they follow a step which isn't saved yet
+            development_step = convo.get_development_step_to_restore(look_up=restoring)
+            if development_step is not None:
+                response, log_message = convo.restore_development_step(development_step, should_log_message)
+                responses.append(convo.add_response(response, function_calls, log_message))
+                continue
+            restoring = False
+            prompts.append((convo, prompt_path, prompt_data, function_calls, self.agent.project.llm_req_num))
+
+        requests_to_send = []
+        for convo, prompt_path, _, function_calls, _ in prompts:
+            try:
+                requests_to_send.append(convo.prepare_request(prompt_path, function_calls))
+            except TokenLimitError as e:
+                # The requests after this one would never have been sent
+                requests_to_send.append(e)
+                break
+
+        async def send(convo, prompt_path, function_calls, request, semaphore):
+            if isinstance(request, Exception):
+                return request
+            messages, stable_prefix_tokens, metrics = request
+            async with semaphore:
+                # The responses are printed one after the other by `add_response()`, not interleaved as they stream,
+                # and the user isn't asked whether to retry by several forks at once
+                response = await acreate_gpt_chat_completion(messages, convo.high_level_step, convo.agent.project,
+                                                             function_calls=function_calls, prompt_path=prompt_path,
+                                                             stable_prefix_tokens=stable_prefix_tokens,
+                                                             metrics=metrics, stream_output=False,
+                                                             interactive_retry=False)
+            if not response:
+                raise ValueError(f'Empty response from the LLM to {prompt_path}')
+            return response
+
+        async def send_all():
+            semaphore = asyncio.Semaphore(max_parallel)
+            tasks = [asyncio.create_task(send(convo, prompt_path, function_calls, request, semaphore))
+                     for (convo, prompt_path, _, function_calls, _), request in zip(prompts, requests_to_send)]
+            results = []
+            for i, task in enumerate(tasks):
+                try:
+                    results.append(await task)
+                except BaseException as e:
+                    results.append(e)
+                    # The steps are saved in order, so the requests after a failed one are sent again after it:
+                    # don't spend more tokens on them now
+                    for later_task in tasks[i + 1:]:
+                        later_task.cancel()
+                    await asyncio.gather(*tasks[i + 1:], return_exceptions=True)
+                    break
+            return results
+
+        results = asyncio.run(send_all()) if requests_to_send else []
+
+        for i, ((convo, prompt_path, prompt_data, function_calls, llm_req_num), request) in \
+                enumerate(zip(prompts, requests_to_send)):
+            self.agent.project.llm_req_num = llm_req_num
+            # None if the request was cancelled
+            result = results[i] if i < len(results) else None
+            if isinstance(result, TokenLimitError):
+                # The requests cancelled after this one may have spent tokens too
+                for later_request in requests_to_send[i + 1:]:
+                    if not isinstance(later_request, Exception):
+                        save_llm_request(self.agent.project, later_request[2])
+                save_development_step(self.agent.project, prompt_path, prompt_data, convo.messages, '', str(result),
+                                      metrics=None if request is result else request[2])
+                raise result
+
+            if result is None or isinstance(result, BaseException):
+                if result is not None:
+                    logger.warning(f'Forked request for {prompt_path} failed, sending it again: {result}')
+                # The tokens spent on the failed or cancelled request aren't saved with a development step
+                save_llm_request(self.agent.project, request[2])
+                result = convo.send_request(prompt_path, prompt_data, function_calls)
+            else:
+                convo.save_development_step(prompt_path, prompt_data, result, request[2])
+            responses.append(convo.add_response(result, function_calls, should_log_message))
+
+        return responses
+
+    def add_prompt(self, prompt_path, prompt_data):
+        """
+        Adds the message made from the prompt to the conversation.
+
+        Returns:
+            The prompt data the message was made from, with the files to list, see `get_files_to_send()`.
+        """
+        if prompt_data is not None and prompt_data.get('files'):
+            files, unchanged_files = self.get_files_to_send(prompt_data['files'])
+            prompt_data = {**prompt_data, 'files': files, 'unchanged_files': unchanged_files}
+
         # craft message
         self.construct_and_add_message_from_prompt(prompt_path, prompt_data)
+        return prompt_data
+
+    def get_development_step_to_restore(self, look_up=True):
+        """
+        Counts the request and, when loading a project with `skip_steps`, returns its saved development step.
 
+        Args:
+            look_up: False to only count the request.
+        Returns:
+            The saved development step to restore the response from, or None to send the request.
+        """
         # TODO: move this if block (and the other below) to Developer agent - https://github.com/Pythagora-io/gpt-pilot/issues/91#issuecomment-1751964079
-        # check if we already have the LLM response saved
         if self.agent.__class__.__name__ == 'Developer':
             self.agent.project.llm_req_num += 1
+        if not look_up:
+            return None
         development_step = get_saved_development_step(self.agent.project)
         if development_step is not None and self.agent.project.skip_steps:
-            # if we do, use it
-            print(color_yellow(f'Restoring development step with id {development_step.id}'))
-            self.agent.project.checkpoints['last_development_step'] = development_step
-            self.agent.project.restore_files(development_step.id)
-            response = development_step.llm_response
-            self.messages = development_step.messages
-
-            if self.agent.project.skip_until_dev_step and str(
-                    development_step.id) == self.agent.project.skip_until_dev_step:
-                self.agent.project.finish_loading()
-                delete_all_subsequent_steps(self.agent.project)
-
-                if 'delete_unrelated_steps' in self.agent.project.args and self.agent.project.args[
-                    'delete_unrelated_steps']:
-                    self.agent.project.delete_all_steps_except_current_branch()
-            else:
-                should_log_message = True
+            return development_step
+        return None
 
-            if development_step.token_limit_exception_raised:
-                raise TokenLimitError(development_step.token_limit_exception_raised)
+    def restore_development_step(self, development_step, should_log_message):
+        """
+        Returns:
+            (the saved LLM response, whether it should be logged)
+        """
+        print(color_yellow(f'Restoring development step with id {development_step.id}'))
+        self.agent.project.checkpoints['last_development_step'] = development_step
+        self.agent.project.restore_files(development_step.id)
+        response = development_step.llm_response
+        self.messages = development_step.messages
+
+        if self.agent.project.skip_until_dev_step and str(
+                development_step.id) == self.agent.project.skip_until_dev_step:
+            self.agent.project.finish_loading()
+            delete_all_subsequent_steps(self.agent.project)
+
+            if 'delete_unrelated_steps' in self.agent.project.args and self.agent.project.args[
+                'delete_unrelated_steps']:
+                self.agent.project.delete_all_steps_except_current_branch()
         else:
-            # if we don't, get the response from LLM
-            try:
-                self.replace_files()
-                response = create_gpt_chat_completion(self.messages, self.high_level_step, self.agent.project,
-                                                      function_calls=function_calls)
-            except TokenLimitError as e:
-                save_development_step(self.agent.project, prompt_path, prompt_data, self.messages, '', str(e))
-                raise e
+            should_log_message = True
+
+        if development_step.token_limit_exception_raised:
+            raise TokenLimitError(development_step.token_limit_exception_raised)
+        return response, should_log_message
 
-            # TODO: move this code to Developer agent - https://github.com/Pythagora-io/gpt-pilot/issues/91#issuecomment-1751964079
-            if hasattr(self.agent, 'save_dev_steps') and self.agent.save_dev_steps:
-                save_development_step(self.agent.project, prompt_path, prompt_data, self.messages, response)
+    def prepare_request(self, prompt_path,
+                        function_calls: FunctionCallSet = None) -> tuple[list[dict], int, RequestMetrics]:
+        """
+        Updates the files listed in the conversation and compacts it if needed, before sending it.
+
+        Returns:
+            (the messages to send, rendered, the number of tokens unchanged since the last request, request metrics)
+        """
+        if self.stable_layout:
+            self.add_updated_files()
+        else:
+            self.replace_files()
+        self.compact_if_needed(function_calls, prompt_path)
+        stable_prefix_tokens = self.get_stable_prefix_tokens()
+        logger.info(f'Sending {len(self.messages)} messages with {self.get_token_count()} tokens '
+                    f'({stable_prefix_tokens} unchanged since the last request)')
+        metrics = RequestMetrics(self.high_level_step, prompt_path, None)
+        return content_store.render_messages(self.messages), stable_prefix_tokens, metrics
+
+    def save_development_step(self, prompt_path, prompt_data, response, metrics):
+        # TODO: move this code to Developer agent - https://github.com/Pythagora-io/gpt-pilot/issues/91#issuecomment-1751964079
+        if hasattr(self.agent, 'save_dev_steps') and self.agent.save_dev_steps:
+            save_development_step(self.agent.project, prompt_path, prompt_data, self.messages, response,
+                                  metrics=metrics)
+        else:
+            # The tokens were spent all the same, see `get_llm_usage()`
+            save_llm_request(self.agent.project, metrics)
 
+    def add_response(self, response, function_calls: FunctionCallSet = None, should_log_message=True):
+        """
+        Adds the LLM response to the conversation.
+
+        Returns:
+            The response from the agent, parsed.
+        """
         # TODO handle errors from OpenAI
         # It's complicated because calling functions are expecting different types of responses - string or tuple
         # https://github.com/Pythagora-io/gpt-pilot/issues/165 & #91
@@ -99,8 +343,13 @@ class AgentConvo:
             logger.error('Aborting with "OpenAI API error happened"')
             raise Exception("OpenAI API error happened.")
 
-        response = parse_agent_response(response, function_calls)
-        message_content = self.format_message_content(response, function_calls)
+        llm_response = response
+        response = parse_agent_response(llm_response, function_calls)
+        if function_calls and isinstance(llm_response, LLMResponse) and llm_response.validated:
+            # The validated JSON text, instead of serializing the parsed response again
+            message_content = llm_response.text
+        else:
+            message_content = self.format_message_content(response, function_calls)
 
         # TODO we need to specify the response when there is a function called
         # TODO maybe we can have a specific function that creates the GPT response from the function call
@@ -172,60 +421,263 @@ class AgentConvo:
         return accepted_messages
 
     def save_branch(self, branch_name=None):
-        if branch_name is None:
-            branch_name = str(uuid.uuid4())
-        self.branches[branch_name] = self.messages.copy()
-        return branch_name
+        """
+        Saves the conversation so far, to get back to it with `load_branch()`. The messages are not copied.
+
+        Args:
+            branch_name: (optional) The name of the branch, a UUID by default.
+
+        Returns:
+            The branch, which is garbage-collected once it's not referenced anymore: keep it (not a copy of
+            its name) for as long as the branch may be loaded.
+        """
+        self.shared_messages = (self.messages, len(self.messages))
+        return self.branches.save(self.messages, branch_name)
 
     def load_branch(self, branch_name, reload_files=True):
-        self.messages = self.branches[branch_name].copy()
-        if reload_files:
+        messages, length = self.branches[branch_name].get_messages()
+        if len(messages) == length:
+            # Nothing was added since the branch was saved, keep sharing the messages
+            self.messages = messages
+            self.shared_messages = (messages, length)
+        else:
+            self.messages = messages[:length]
+        # With the stable layout, updated files are added by the next `send_message()`
+        if reload_files and not self.stable_layout:
             # TODO make this more flexible - with every message, save metadata so every time we load a branch, reconstruct all messages from scratch
             self.replace_files()
 
     def replace_files(self):
-        files = self.agent.project.get_all_coded_files()
+        """
+        Updates the files listed in the user messages (`**path/name**:` followed by a code block) to their
+        current content.
+
+        The files listed in each message are indexed, with a hash of the listed content, the first time the
+        message is seen (see `index_file_listings()`), so only the messages listing a file which changed since
+        are rewritten. The time spent is added to `self.replace_files_stats`.
+        """
+        started_at = time.perf_counter()
+        listed_files = self.index_file_listings()
+        messages_updated = 0
+        files_updated = 0
+
+        # Don't read the files if no message lists them
+        if listed_files:
+            current_files = {}
+            for file in self.agent.project.get_all_coded_files():
+                file_path = f"{file['path']}/{file['name']}"
+                if file_path in listed_files:
+                    reference = content_store.reference(file['content'])
+                    current_files[file_path] = (reference, hash_content(reference))
+
+            for i, (msg, (_, listings)) in enumerate(zip(self.messages, self.message_files)):
+                changed_files = {file_path: current_files[file_path] for file_path, content_hash in listings.items()
+                                 if file_path in current_files and current_files[file_path][1] != content_hash}
+                if changed_files:
+                    self.replace_message(i, self.replace_file_listings(msg['content'], changed_files))
+                    listings.update({file_path: content_hash for file_path, (_, content_hash) in changed_files.items()})
+                    messages_updated += 1
+                    files_updated += len(changed_files)
+            # The index still matches the rewritten messages
+            self.message_files = [(msg['content'], listings)
+                                  for msg, (_, listings) in zip(self.messages, self.message_files)]
+
+        duration = time.perf_counter() - started_at
+        self.replace_files_stats['calls'] += 1
+        self.replace_files_stats['duration'] += duration
+        self.replace_files_stats['messages_updated'] += messages_updated
+        self.replace_files_stats['files_updated'] += files_updated
+        logger.debug(f'Updated {files_updated} file listings in {messages_updated} messages in {duration:.3f}s')
+
+    def index_file_listings(self) -> set[str]:
+        """
+        Updates `self.message_files` with the files listed in the messages added or changed since the last call.
+
+        Returns:
+            The paths of the files listed in any user message.
+        """
+        listed_files = set()
+        for i, msg in enumerate(self.messages):
+            if i < len(self.message_files) and self.message_files[i][0] is msg['content']:
+                listed_files.update(self.message_files[i][1])
+                continue
+
+            listings = {}
+            if msg['role'] == 'user':
+                for match in FILE_LISTING_RE.finditer(msg['content']):
+                    content_hash = hash_content(match.group('content'))
+                    # A file listed twice with different contents is rewritten by the next update
+                    listings[match.group('path')] = content_hash \
+                        if listings.get(match.group('path'), content_hash) == content_hash else None
+            listed_files.update(listings)
+            if i < len(self.message_files):
+                self.message_files[i] = (msg['content'], listings)
+            else:
+                self.message_files.append((msg['content'], listings))
+
+        del self.message_files[len(self.messages):]
+        return listed_files
+
+    @staticmethod
+    def replace_file_listings(content: str, files: dict[str, tuple[str, str]]) -> str:
+        """
+        Args:
+            content: The content of a message.
+            files: {file path: (new content, hash)} of the files to update.
+
+        Returns:
+            The content with the listings of `files` updated.
+        """
+        def replace(match):
+            file_path = match.group('path')
+            if file_path not in files:
+                return match.group(0)
+            return f"**{file_path}**{match.group('colon')}\n```\n{files[file_path][0]}\n```"
+
+        return FILE_LISTING_RE.sub(replace, content)
+
+    def get_files_to_send(self, files: list[dict]) -> tuple[list[dict], list[str]]:
+        """
+        Splits the files for a prompt into the ones to list, which are new or changed since they were last listed
+        in the conversation, and the ones the LLM has already seen as they are.
+
+        Args:
+            files: [{'path': str, 'name': str, 'content': str}, ...]
+
+        Returns:
+            (files with their content referenced, see `reference_file_contents()`, paths of the unchanged files)
+        """
+        self.index_file_listings()
+        latest_listings = {}
+        for _, listings in self.message_files:
+            latest_listings.update(listings)
+
+        files_to_send = []
+        unchanged_files = []
+        for file in self.reference_file_contents(files):
+            file_path = f"{file['path']}/{file['name']}"
+            if isinstance(file['content'], str) and latest_listings.get(file_path) == hash_content(file['content']):
+                unchanged_files.append(file_path)
+            else:
+                files_to_send.append(file)
+
+        if unchanged_files:
+            logger.info(f'Not listing {len(unchanged_files)} files unchanged since they were last listed: '
+                        f'{", ".join(unchanged_files)}')
+        return files_to_send, unchanged_files
+
+    @staticmethod
+    def reference_file_contents(files: list[dict]) -> list[dict]:
+        """
+        Returns:
+            Copies of `files` with their content replaced by a reference to it, see `utils/content_store.py`.
+        """
+        return [{**file, 'content': content_store.reference(file['content'])} if isinstance(file.get('content'), str)
+                else file for file in files]
+
+    def add_updated_files(self):
+        """
+        Stable layout: list the files which changed since they were last listed in a new message,
+        before the latest prompt, instead of changing earlier messages.
+        """
+        latest_listings = {}
         for msg in self.messages:
             if msg['role'] == 'user':
-                for file in files:
-                    msg['content'] = self.replace_file_content(msg['content'], f"{file['path']}/{file['name']}", file['content'])
+                for match in FILE_LISTING_RE.finditer(msg['content']):
+                    latest_listings[match.group('path')] = match.group('content')
+        if not latest_listings:
+            return
+
+        updated_files = [file for file in self.reference_file_contents(self.agent.project.get_all_coded_files())
+                         if latest_listings.get(f"{file['path']}/{file['name']}", file['content']) != file['content']]
+        if not updated_files:
+            return
+
+        message = {'role': 'user', 'content': get_prompt('utils/updated_files.prompt', {'files': updated_files})}
+        position = len(self.messages) - 1 if self.messages[-1]['role'] == 'user' else len(self.messages)
+        self.copy_on_write(position)
+        self.messages.insert(position, message)
+
+    def copy_on_write(self, index: int):
+        """
+        Copies `self.messages` before the message at `index` is replaced or a message is inserted there,
+        if a saved branch shares it.
+        """
+        messages, length = self.shared_messages
+        if index < 0:
+            index += len(self.messages)
+        if messages is self.messages and index < length:
+            self.messages = self.messages.copy()
 
-    def escape_specials(self, s):
-        s = s.replace("\\", "\\\\")
+    def replace_message(self, index: int, content: str):
+        """
+        Replaces the content of the message at `index`, without changing the message in the saved branches.
+        """
+        self.copy_on_write(index)
+        self.messages[index] = {**self.messages[index], 'content': content}
 
-        # List of sequences to preserve
-        sequences_to_preserve = [
-            # todo check if needed "\\\\",  # Backslash - note: probably not eg. paths on Windows
-            "\\'",  # Single quote
-            '\\"',  # Double quote
-            # todo check if needed '\\a',  # ASCII Bell (BEL)
-            # todo check if needed '\\b',  # ASCII Backspace (BS) - note: different from regex \b
-            # todo check if needed '\\f',  # ASCII Formfeed (FF)
-            '\\n',  # ASCII Linefeed (LF)
-            # todo check if needed '\\r',  # ASCII Carriage Return (CR)
-            '\\t',  # ASCII Horizontal Tab (TAB)
-            # todo check if needed '\\v'  # ASCII Vertical Tab (VT)
-        ]
+    def get_stable_prefix_tokens(self) -> int:
+        """
+        Number of tokens at the start of the conversation which are unchanged since the last request,
+        ie. the prompt prefix an LLM provider can serve from its cache.
+        """
+        self.get_token_count()
+        stable_prefix_tokens = 0
+        for sent, msg, (_, tokens) in zip(self.sent_messages, self.messages, self.message_tokens):
+            if sent != (msg['role'], msg['content']):
+                break
+            stable_prefix_tokens += tokens
 
-        for seq in sequences_to_preserve:
-            s = s.replace('\\\\' + seq[-1], seq)
-        return s
+        self.sent_messages = [(msg['role'], msg['content']) for msg in self.messages]
+        return stable_prefix_tokens
 
-    def replace_file_content(self, message, file_path, new_content):
-        pattern = rf'\*\*{re.escape(file_path)}\*\*:\n```\n(.*?)\n```'
+    def get_token_count(self) -> int:
+        """
+        Running total of the tokens in `self.messages`, with the file contents they reference.
 
-        # Escape special characters in new_content for the sake of regex replacement
-        new_content_escaped = self.escape_specials(new_content)
-        file_path_escaped = self.escape_specials(file_path)
+        Only the messages that were added or changed since the last call are counted again,
+        so this is cheap enough to call before every request.
+        """
+        for i, msg in enumerate(self.messages):
+            if i < len(self.message_tokens):
+                content, tokens = self.message_tokens[i]
+                if content is msg['content']:
+                    continue
+                self.token_count -= tokens
+                self.message_tokens[i] = (msg['content'], self.count_message_tokens(msg))
+            else:
+                self.message_tokens.append((msg['content'], self.count_message_tokens(msg)))
+            self.token_count += self.message_tokens[i][1]
 
-        new_section_content = f'**{file_path_escaped}**\n```\n{new_content_escaped}\n```'
+        for _, tokens in self.message_tokens[len(self.messages):]:
+            self.token_count -= tokens
+        del self.message_tokens[len(self.messages):]
 
-        updated_message, num_replacements = re.subn(pattern, new_section_content, message, flags=re.DOTALL)
+        return self.token_count
 
-        if num_replacements == 0:
-            return message
+    @staticmethod
+    def count_message_tokens(msg: dict) -> int:
+        return token_counter.count_message(content_store.render_message(msg))
+
+    def compact_if_needed(self, function_calls: FunctionCallSet = None, prompt_path=None):
+        """
+        Compacts the conversation if it's getting close to the token limit of the model it's sent to,
+        see `ConvoCompactor`.
+
+        Args:
+            function_calls: Optional function calls to be included in the next request.
+            prompt_path: The prompt of the next request, which may be routed to another model (see `llm_router`).
+        """
+        if not CONVO_COMPACTION:
+            return
 
-        return updated_message
+        model = llm_router.route(self.high_level_step, prompt_path).get_model()
+        reserved_tokens = 0
+        if function_calls:
+            reserved_tokens = schema_registry.get(function_calls['definitions']).num_tokens(model)
+        if self.compactor.needs_compaction(self.get_token_count(), reserved_tokens, model):
+            self.messages, compaction = self.compactor.compact(self.messages, reserved_tokens, model)
+            self.compactions.append(compaction)
 
     def convo_length(self):
         return len([msg for msg in self.messages if msg['role'] != 'system'])
@@ -263,7 +715,8 @@ class AgentConvo:
         with open('const/convert_to_playground_convo.js', 'r', encoding='utf-8') as file:
             content = file.read()
         process = subprocess.Popen('pbcopy', stdin=subprocess.PIPE)
-        process.communicate(content.replace('{{messages}}', str(self.messages)).encode('utf-8'))
+        messages = content_store.render_messages(self.messages)
+        process.communicate(content.replace('{{messages}}', str(messages)).encode('utf-8'))
 
     def remove_last_x_messages(self, x):
         logger.info('removing last %d messages: %s', x, self.messages[-x:])
@@ -0,0 +1,105 @@
+import json
+import os
+import tempfile
+import uuid
+import weakref
+from itertools import count
+from typing import Optional
+
+from logger.logger import logger
+
+
+class ConvoBranch(str):
+    """
+    A saved point of a conversation, see `AgentConvo.save_branch()`.
+
+    The branch is its name (so it can be logged and looked up by name), and a pointer to the first `length`
+    messages of a message list shared with the conversation, which is only ever appended to while shared.
+    A branch which wasn't used for a while can be spilled to disk, see `ConvoBranches`.
+    """
+
+    def __new__(cls, name: str, messages: list[dict], used: int):
+        branch = super().__new__(cls, name)
+        branch.log = messages
+        branch.length = len(messages)
+        branch.used = used
+        branch.path = None
+        return branch
+
+    def get_messages(self) -> tuple[list[dict], int]:
+        """
+        :return: (message list, number of messages of the branch), the list may be longer than the branch
+        """
+        if self.log is None:
+            with open(self.path, 'r', encoding='utf-8') as fp:
+                self.log = json.load(fp)
+            self.spilled_file()
+            self.path = None
+        return self.log, self.length
+
+    def spill(self, directory: str):
+        """Writes the messages to a file in `directory` and drops the reference to the message list"""
+        fd, self.path = tempfile.mkstemp(prefix='branch-', suffix='.json', dir=directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+            json.dump(self.log[:self.length], fp)
+        self.log = None
+        # Removes the file once the branch is loaded or garbage-collected
+        self.spilled_file = weakref.finalize(self, os.remove, self.path)
+
+
+class ConvoBranches:
+    """
+    Branches of a conversation, by name.
+
+    Saving a branch doesn't copy the messages (see `ConvoBranch`). A branch is kept only as long as the
+    `ConvoBranch` returned by `save()` is referenced, so the branches of the functions which returned are
+    garbage-collected: keep the returned branch (not a copy of its name) for as long as it may be loaded.
+
+    With `max_in_memory` set (see `CONVO_BRANCHES_IN_MEMORY`), the least recently used branches above that
+    number are spilled to disk, and read back when they're loaded.
+
+    >>> branch = branches.save(messages)
+    >>> messages, length = branches[branch].get_messages()
+    """
+
+    def __init__(self, max_in_memory: Optional[int] = None, spill_dir: Optional[str] = None):
+        self.branches: weakref.WeakValueDictionary[str, ConvoBranch] = weakref.WeakValueDictionary()
+        self.max_in_memory = max_in_memory
+        self.spill_dir = spill_dir
+        self.uses = count()
+
+    def save(self, messages: list[dict], branch_name: Optional[str] = None) -> ConvoBranch:
+        branch = ConvoBranch(branch_name or str(uuid.uuid4()), messages, next(self.uses))
+        # Keyed by a plain copy of the name, the branch itself is only referenced weakly
+        self.branches[str(branch)] = branch
+        self.spill_least_recently_used()
+        return branch
+
+    def __getitem__(self, branch_name: str) -> ConvoBranch:
+        branch = self.branches[branch_name]
+        branch.used = next(self.uses)
+        return branch
+
+    def __contains__(self, branch_name: str) -> bool:
+        return branch_name in self.branches
+
+    def __len__(self) -> int:
+        return len(self.branches)
+
+    def keys(self) -> list[str]:
+        return list(self.branches.keys())
+
+    def spill_least_recently_used(self):
+        if not self.max_in_memory:
+            return
+
+        in_memory = sorted((branch for branch in self.branches.values() if branch.log is not None),
+                           key=lambda branch: branch.used)
+        if len(in_memory) <= self.max_in_memory:
+            return
+
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='gpt-pilot-branches-')
+        for branch in in_memory[:len(in_memory) - self.max_in_memory]:
+            branch.spill(self.spill_dir)
+            logger.debug(f'Spilled conversation branch {branch} ({branch.length} messages) to {branch.path}')
@@ -0,0 +1,194 @@
+import os
+import re
+from typing import Optional
+
+from const.llm import MIN_TOKENS_FOR_GPT_RESPONSE
+from logger.logger import logger
+from utils.content_store import content_store
+from utils.token_counter import token_counter, get_context_window
+
+# `**path/name**:` followed by the file content in a code block, see `prompts/components/files_list.prompt`
+FILE_LISTING_RE = re.compile(r'\*\*(?P<path>[^*\n]+)\*\*(?P<colon>:?)\n```\n(?P<content>.*?)\n```', re.DOTALL)
+
+# (prefix, CLI output, suffix) in `dev_ops/ran_command.prompt`, `development/task/update_task.prompt`
+# and `development/env_setup/cli_response.prompt`
+CLI_OUTPUT_RES = [
+    re.compile(r'(The output was:\n+)(.*?)(\n\nThink about this output)', re.DOTALL),
+    re.compile(r'(we got the following output:\n)(.*?)(\n\n)', re.DOTALL),
+    re.compile(r'(Response from the CLI:\n)(.*)()', re.DOTALL),
+]
+
+EVICTED_MESSAGES_NOTE = '[{count} earlier messages of this conversation were removed to fit the context window]'
+EVICTED_MESSAGES_RE = re.compile(r'^\[(\d+) earlier messages of this conversation were removed')
+
+
+def count_tokens(messages: list[dict]) -> int:
+    """Tokens the messages take in a request, with the file contents they reference (see `utils/content_store.py`)"""
+    return token_counter.count_messages(content_store.render_messages(messages))
+
+
+class ConvoCompactor:
+    """
+    Shrinks a conversation that no longer fits in the context window, without an extra LLM request.
+
+    When the messages get close to the context window of the model they're sent to (see `get_context_window()`),
+    these steps are applied in order until the conversation is back under the target size:
+      1. file listings superseded by a later listing of the same file are collapsed
+      2. the CLI output in all but the latest command result is trimmed to its first and last lines
+      3. the oldest user/assistant messages are evicted and replaced by a short note
+
+    The system message, the first user message (the task), the latest listing of every file and
+    the last `keep_last` messages are never removed.
+
+    Messages are never changed in place (they may be shared with saved branches), compacted messages
+    are replaced by new dicts. Conversations with a model of unknown context window are never compacted.
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, trigger_ratio: float = 0.9,
+                 target_ratio: float = 0.75, keep_last: int = 2, cli_output_lines: int = 10):
+        """
+        :param max_tokens: (optional) context window, of the model the conversation is sent to by default
+        """
+        self.max_tokens = max_tokens
+        self.trigger_ratio = trigger_ratio
+        self.target_ratio = target_ratio
+        self.keep_last = keep_last
+        self.cli_output_lines = cli_output_lines
+
+    def get_context_window(self, model: Optional[str] = None) -> Optional[int]:
+        """
+        :param model: (optional) the model the conversation is sent to, `MODEL_NAME` by default
+        :return: `max_tokens` if set, else the context window of the model, None if it isn't known
+        """
+        if self.max_tokens is not None:
+            return self.max_tokens
+        return get_context_window(model or os.getenv('MODEL_NAME', 'gpt-4'))
+
+    def available_tokens(self, reserved_tokens: int = 0, model: Optional[str] = None) -> int:
+        """
+        :param reserved_tokens: tokens needed in the request on top of the messages, eg. for the JSON schema
+        :param model: (optional) the model the conversation is sent to
+        :return: tokens available for the messages
+        """
+        return self.get_context_window(model) - MIN_TOKENS_FOR_GPT_RESPONSE - reserved_tokens
+
+    def needs_compaction(self, num_tokens: int, reserved_tokens: int = 0, model: Optional[str] = None) -> bool:
+        if self.get_context_window(model) is None:
+            return False
+        return num_tokens > self.available_tokens(reserved_tokens, model) * self.trigger_ratio
+
+    def compact(self, messages: list[dict], reserved_tokens: int = 0,
+                model: Optional[str] = None) -> tuple[list[dict], dict]:
+        """
+        :param messages: [{ "role": "system"|"assistant"|"user", "content": string }, ... ]
+        :param reserved_tokens: tokens needed in the request on top of the messages
+        :param model: (optional) the model the conversation is sent to
+        :return: (compacted messages, record of what was compacted)
+        """
+        target = int(self.available_tokens(reserved_tokens, model) * self.target_ratio)
+        record = {
+            'tokens_before': count_tokens(messages),
+            'files_collapsed': [],
+            'outputs_trimmed': 0,
+            'messages_evicted': 0,
+        }
+
+        messages = self.collapse_file_listings(messages, record)
+        if count_tokens(messages) > target:
+            messages = self.trim_cli_outputs(messages, record)
+        if count_tokens(messages) > target:
+            messages = self.evict_old_messages(messages, target, record)
+
+        record['tokens_after'] = count_tokens(messages)
+        logger.info(f'Compacted conversation from {record["tokens_before"]} to {record["tokens_after"]} tokens: '
+                    f'{len(record["files_collapsed"])} file listings collapsed, {record["outputs_trimmed"]} CLI '
+                    f'outputs trimmed, {record["messages_evicted"]} messages evicted')
+        return messages, record
+
+    @staticmethod
+    def latest_file_listings(messages: list[dict]) -> dict[str, int]:
+        """
+        :return: {file_path: index of the last message listing the file}
+        """
+        latest = {}
+        for i, message in enumerate(messages):
+            if message['role'] == 'user':
+                for match in FILE_LISTING_RE.finditer(message['content']):
+                    latest[match.group('path')] = i
+        return latest
+
+    def collapse_file_listings(self, messages: list[dict], record: dict) -> list[dict]:
+        latest = self.latest_file_listings(messages)
+        compacted = []
+
+        for i, message in enumerate(messages):
+            if message['role'] == 'user':
+                def collapse(match):
+                    path = match.group('path')
+                    if latest[path] == i:
+                        return match.group(0)
+                    record['files_collapsed'].append(path)
+                    # Not a code block anymore, so `AgentConvo.replace_files()` won't restore the content
+                    return f'**{path}**{match.group("colon")} (superseded, see the latest version of this file below)'
+
+                content = FILE_LISTING_RE.sub(collapse, message['content'])
+                if content != message['content']:
+                    message = {**message, 'content': content}
+            compacted.append(message)
+
+        return compacted
+
+    def trim_output(self, output: str) -> str:
+        lines = output.split('\n')
+        if len(lines) <= self.cli_output_lines * 2:
+            return output
+        trimmed = len(lines) - self.cli_output_lines * 2
+        return '\n'.join(lines[:self.cli_output_lines] +
+                         [f'[... {trimmed} lines of old output trimmed ...]'] +
+                         lines[-self.cli_output_lines:])
+
+    def trim_cli_outputs(self, messages: list[dict], record: dict) -> list[dict]:
+        with_output = [i for i, message in enumerate(messages)
+                       if message['role'] == 'user' and any(regex.search(message['content']) for regex in CLI_OUTPUT_RES)]
+        compacted = list(messages)
+
+        # The latest output is what the LLM is working on, keep it intact
+        for i in with_output[:-1]:
+            content = messages[i]['content']
+            for regex in CLI_OUTPUT_RES:
+                content = regex.sub(lambda match: match.group(1) + self.trim_output(match.group(2)) + match.group(3),
+                                    content, count=1)
+            if content != messages[i]['content']:
+                compacted[i] = {**messages[i], 'content': content}
+                record['outputs_trimmed'] += 1
+
+        return compacted
+
+    def evict_old_messages(self, messages: list[dict], target: int, record: dict) -> list[dict]:
+        # Keep the system message and the task, plus the note about previously evicted messages
+        start = 1 if messages and messages[0]['role'] == 'system' else 0
+        start += 1
+        evicted_before = 0
+        if start < len(messages) and EVICTED_MESSAGES_RE.match(messages[start]['content']):
+            evicted_before = int(EVICTED_MESSAGES_RE.match(messages[start]['content']).group(1))
+            messages = messages[:start] + messages[start + 1:]
+
+        protected = set(self.latest_file_listings(messages).values())
+        num_tokens = count_tokens(messages)
+        kept = []
+        evicted = 0
+
+        for i, message in enumerate(messages):
+            if start <= i < len(messages) - self.keep_last and i not in protected and num_tokens > target:
+                num_tokens -= token_counter.count_message(content_store.render_message(message))
+                evicted += 1
+            else:
+                kept.append(message)
+
+        if evicted + evicted_before:
+            kept.insert(start, {
+                'role': 'user',
+                'content': EVICTED_MESSAGES_NOTE.format(count=evicted + evicted_before),
+            })
+        record['messages_evicted'] += evicted
+        return kept
@@ -1,5 +1,4 @@
 import platform
-import uuid
 import re
 
 from const.code_execution import MAX_COMMAND_DEBUG_TRIES, MAX_RECUSION_LAYER
@@ -37,8 +36,7 @@ class Debugger:
             self.recursion_layer = 0
             raise TooDeepRecursionError()
 
-        function_uuid = str(uuid.uuid4())
-        convo.save_branch(function_uuid)
+        function_uuid = convo.save_branch()
         success = False
 
         for i in range(MAX_COMMAND_DEBUG_TRIES):
@@ -104,12 +102,12 @@ class Debugger:
                             convo.load_branch(function_uuid)
                             if 'cli_response' in result:
                                 user_input = result['cli_response']
-                                convo.messages[-2]['content'] = re.sub(
+                                convo.replace_message(-2, re.sub(
                                     r'(?<=The output was:\n\n).*?(?=\n\nThink about this output)',
                                     result['cli_response'],
                                     convo.messages[-2]['content'],
                                     flags=re.DOTALL
-                                )
+                                ))
                         break
 
             except TokenLimitError as e:
@@ -3,11 +3,13 @@ import os
 from pathlib import Path
 import re
 from typing import Tuple
+from peewee import JOIN
 
 from const.messages import CHECK_AND_CONTINUE, AFFIRMATIVE_ANSWERS, NEGATIVE_ANSWERS
 from utils.style import color_yellow_bold, color_cyan, color_white_bold, color_green
 from const.common import IGNORE_FOLDERS, STEPS
-from database.database import delete_unconnected_steps_from, delete_all_app_development_data, update_app_status
+from database.database import delete_unconnected_steps_from, delete_all_app_development_data, update_app_status, \
+    save_blobs, mark_steps_deleted
 from const.ipc import MESSAGE_TYPE
 from prompts.prompts import ask_user
 from helpers.exceptions.TokenLimitError import TokenLimitError
@@ -21,6 +23,7 @@ from helpers.agents.ProductOwner import ProductOwner
 from helpers.agents.TechnicalWriter import TechnicalWriter
 
 from database.models.development_steps import DevelopmentSteps
+from database.models.content_blobs import ContentBlob
 from database.models.file_snapshot import FileSnapshot
 from database.models.files import File
 from logger.logger import logger
@@ -68,6 +71,8 @@ class Project:
 
         self.finished = False
         self.current_step = current_step
+        # Number of the development task being implemented, if any
+        self.current_task = None
         self.name = name
         self.project_description = project_description
         self.clarifications = clarifications
@@ -384,8 +389,10 @@ class Project:
     def save_files_snapshot(self, development_step_id):
         files = get_directory_contents(self.root_path, ignore=IGNORE_FOLDERS)
         development_step, created = DevelopmentSteps.get_or_create(id=development_step_id)
+        # Usually only a few files changed since the last step, only their contents are new blobs
+        blobs = save_blobs([file.get('content', '') for file in files])
 
-        for file in files:
+        for file, blob in zip(files, blobs):
             if not self.check_ipc():
                 print(color_cyan(f'Saving file {file["full_path"]}'))
             # TODO this can be optimized so we don't go to the db each time
@@ -400,18 +407,22 @@ class Project:
                 app=self.app,
                 development_step=development_step,
                 file=file_in_db,
-                defaults={'content': file.get('content', '')}
+                defaults={'blob': blob}
             )
-            file_snapshot.content = file['content']
-            file_snapshot.save()
+            if file_snapshot.blob_id != blob or file_snapshot.content is not None:
+                file_snapshot.blob = blob
+                file_snapshot.content = None
+                file_snapshot.save()
 
     def restore_files(self, development_step_id):
         development_step = DevelopmentSteps.get(DevelopmentSteps.id == development_step_id)
-        file_snapshots = FileSnapshot.select().where(FileSnapshot.development_step == development_step)
+        file_snapshots = (FileSnapshot.select(FileSnapshot, ContentBlob)
+                          .join(ContentBlob, JOIN.LEFT_OUTER)
+                          .where(FileSnapshot.development_step == development_step))
 
         clear_directory(self.root_path, IGNORE_FOLDERS + self.files)
         for file_snapshot in file_snapshots:
-            update_file(file_snapshot.file.full_path, file_snapshot.content, project=self)
+            update_file(file_snapshot.file.full_path, file_snapshot.get_content(), project=self)
             if file_snapshot.file.full_path not in self.files:
                 self.files.append(file_snapshot.file.full_path)
 
@@ -419,6 +430,7 @@ class Project:
         delete_unconnected_steps_from(self.checkpoints['last_development_step'], 'previous_step')
         delete_unconnected_steps_from(self.checkpoints['last_command_run'], 'previous_step')
         delete_unconnected_steps_from(self.checkpoints['last_user_input'], 'previous_step')
+        mark_steps_deleted()
 
     def ask_for_human_intervention(self, message, description=None, cbs={}, convo=None, is_root_task=False):
         answer = ''
@@ -1,5 +1,4 @@
 import platform
-import uuid
 import re
 
 from const.messages import WHEN_USER_DONE
@@ -72,6 +71,7 @@ class Developer(Agent):
         # DEVELOPMENT END
         self.project.technical_writer.document_project(100)
         self.project.dot_pilot_gpt.chat_log_folder(None)
+        self.project.current_task = None
         if not self.project.finished:
             self.project.finished = True
             update_app_status(self.project.args['app_id'], self.project.current_step)
@@ -86,6 +86,7 @@ class Developer(Agent):
     def implement_task(self, i, development_task=None):
         print(color_green_bold(f'Implementing task #{i + 1}: ') + color_green(f' {development_task["description"]}\n'))
         self.project.dot_pilot_gpt.chat_log_folder(i + 1)
+        self.project.current_task = i + 1
 
         convo_dev_task = AgentConvo(self)
         convo_dev_task.send_message('development/task/breakdown.prompt', {
@@ -146,16 +147,20 @@ class Developer(Agent):
     def replace_old_code_comments(self, files_with_changes):
         files_with_comments = [{**file, 'comments': [line for line in file['content'].split('\n') if '[OLD CODE]' in line]} for file in files_with_changes]
 
-        for file in files_with_comments:
-            if len(file['comments']) > 0:
-                fully_coded_file_convo = AgentConvo(self)
-                fully_coded_file_response = fully_coded_file_convo.send_message(
-                    'development/get_fully_coded_file.prompt', {
-                        'file': self.project.get_files([file['path']])[0],
-                        'new_file': file,
-                    }, GET_FULLY_CODED_FILE)
+        files_to_code = [file for file in files_with_comments if len(file['comments']) > 0]
+        if not files_to_code:
+            return files_with_comments
 
-                file['content'] = fully_coded_file_response['file_content']
+        # The files are independent, so they're coded at the same time
+        fully_coded_file_responses = AgentConvo(self).fork_join([
+            ('development/get_fully_coded_file.prompt', {
+                'file': self.project.get_files([file['path']])[0],
+                'new_file': file,
+            }, GET_FULLY_CODED_FILE)
+            for file in files_to_code])
+
+        for file, fully_coded_file_response in zip(files_to_code, fully_coded_file_responses):
+            file['content'] = fully_coded_file_response['file_content']
 
         return files_with_comments
 
@@ -382,8 +387,7 @@ class Developer(Agent):
     def execute_task(self, convo, task_description, task_steps, test_command=None, reset_convo=True,
                      test_after_code_changes=True, continue_development=False,
                      development_task=None, is_root_task=False, continue_from_step=0):
-        function_uuid = str(uuid.uuid4())
-        convo.save_branch(function_uuid)
+        function_uuid = convo.save_branch()
 
         for (i, step) in enumerate(task_steps):
             # Skip steps before continue_from_step
@@ -8,6 +8,7 @@ from utils.utils import json_serial
 class IPCClient:
     def __init__(self, port):
         self.ready = False
+        self.num_messages = 0
         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         print("Connecting to the external process...")
         try:
@@ -37,6 +38,7 @@ class IPCClient:
 
     def send(self, data):
         serialized_data = json.dumps(data, default=json_serial)
-        data_length = len(serialized_data)
-        self.client.sendall(data_length.to_bytes(4, byteorder='big'))
-        self.client.sendall(serialized_data.encode('utf-8'))
+        encoded_data = serialized_data.encode('utf-8')
+        # Length prefix and message in a single syscall
+        self.client.sendall(len(encoded_data).to_bytes(4, byteorder='big') + encoded_data)
+        self.num_messages += 1
@@ -1,11 +1,20 @@
 import builtins
 import os.path
+import asyncio
+from unittest.mock import patch, Mock
+
+import pytest
 from dotenv import load_dotenv
 from database.database import database
 from const.function_calls import IMPLEMENT_TASK
 from helpers.agents.Developer import Developer
 from helpers.AgentConvo import AgentConvo
+from utils.token_counter import token_counter, TOKENS_PER_REPLY
 from utils.custom_print import get_custom_print
+from utils.utils import get_prompt
+from utils.content_store import content_store
+from utils.llm_response import LLMResponse
+from utils.llm_routing import LLMRouter
 from .test_Project import create_project
 
 load_dotenv()
@@ -13,6 +22,351 @@ load_dotenv()
 builtins.print, ipc_client_instance = get_custom_print({})
 
 
+def test_get_token_count():
+    # Given
+    project = create_project()
+    convo = AgentConvo(Developer(project))
+    system_tokens = convo.get_token_count()
+
+    # When messages are added, changed and removed
+    convo.messages.append({'role': 'user', 'content': 'Hello world'})
+    with_message = convo.get_token_count()
+    convo.messages[1]['content'] = 'Hello big world'
+    with_changed_message = convo.get_token_count()
+    convo.remove_last_x_messages(1)
+
+    # Then the running total follows the messages
+    assert with_message > system_tokens
+    assert with_changed_message > with_message
+    assert convo.get_token_count() == system_tokens
+    assert token_counter.count_messages(convo.messages) == system_tokens
+
+
+def test_compact_if_needed():
+    # Given a conversation close to the token limit
+    project = create_project()
+    convo = AgentConvo(Developer(project))
+    convo.compactor.max_tokens = convo.get_token_count() + 2000
+    for i in range(10):
+        convo.messages.append({'role': 'user', 'content': f'Question {i} ' * 50})
+        convo.messages.append({'role': 'assistant', 'content': f'Answer {i} ' * 50})
+
+    # When
+    convo.compact_if_needed()
+
+    # Then
+    assert len(convo.compactions) == 1
+    assert convo.compactions[0]['messages_evicted'] > 0
+    assert convo.get_token_count() == convo.compactions[0]['tokens_after']
+
+
+def test_add_updated_files():
+    # Given a conversation listing a file which changed since
+    project = create_project()
+    convo = AgentConvo(Developer(project))
+    convo.stable_layout = True
+    listing = 'Here are files that are currently implemented:\n\n**/src/app.js**:\n```\nold\n```\n'
+    convo.messages.append({'role': 'user', 'content': listing})
+    convo.messages.append({'role': 'assistant', 'content': 'OK'})
+    convo.messages.append({'role': 'user', 'content': 'Implement the next task'})
+    project.get_all_coded_files = lambda: [
+        {'path': '/src', 'name': 'app.js', 'content': 'new'},
+        {'path': '/src', 'name': 'other.js', 'content': 'not listed'},
+    ]
+
+    # When
+    convo.add_updated_files()
+
+    # Then the earlier message is left as it was and the new content is listed before the latest prompt
+    assert convo.messages[1]['content'] == listing
+    assert convo.messages[3]['role'] == 'user'
+    assert '**/src/app.js**:\n```\nnew\n```' in content_store.render(convo.messages[3]['content'])
+    assert content_store.reference('new') in convo.messages[3]['content']
+    assert 'other.js' not in convo.messages[3]['content']
+    assert convo.messages[4]['content'] == 'Implement the next task'
+
+    # And nothing is added while the files are unchanged
+    convo.add_updated_files()
+    assert len(convo.messages) == 5
+
+
+def test_replace_files():
+    # Given a conversation listing files
+    project = create_project()
+    convo = AgentConvo(Developer(project))
+    listing = 'Here are files that are currently implemented:\n\n' \
+              '**/src/app.js**:\n```\n{app}\n```\n\n' \
+              '**/src/util.js**:\n```\n{util}\n```\n'
+    old = content_store.reference('old')
+    util = content_store.reference('util')
+    convo.messages.append({'role': 'user', 'content': listing.format(app=old, util=util)})
+    convo.messages.append({'role': 'assistant', 'content': f'**/src/app.js**:\n```\n{old}\n```'})
+    convo.messages.append({'role': 'user', 'content': 'Implement the next task'})
+    files = [
+        {'path': '/src', 'name': 'app.js', 'content': 'console.log("\\n")'},
+        {'path': '/src', 'name': 'util.js', 'content': 'util'},
+    ]
+    project.get_all_coded_files = lambda: files
+
+    # When
+    convo.replace_files()
+
+    # Then only the changed file is updated, in the user messages, with a reference to its content
+    assert convo.messages[1]['content'] == listing.format(app=content_store.reference('console.log("\\n")'), util=util)
+    assert content_store.render(convo.messages[1]['content']) == listing.format(app='console.log("\\n")', util='util')
+    assert convo.messages[2]['content'] == f'**/src/app.js**:\n```\n{old}\n```'
+    assert convo.replace_files_stats['messages_updated'] == 1
+    assert convo.replace_files_stats['files_updated'] == 1
+
+    # And the messages are left as they are while the files are unchanged
+    content = convo.messages[1]['content']
+    convo.replace_files()
+    assert convo.messages[1]['content'] is content
+    assert convo.replace_files_stats['calls'] == 2
+    assert convo.replace_files_stats['files_updated'] == 1
+
+    # And the file is updated again when it changes again
+    files[0]['content'] = 'new'
+    convo.replace_files()
+    assert content_store.render(convo.messages[1]['content']) == listing.format(app='new', util='util')
+
+
+def test_get_files_to_send():
+    # Given a conversation which listed two files
+    project = create_project()
+    convo = AgentConvo(Developer(project))
+    convo.messages.append({'role': 'user', 'content': get_prompt('components/files_list.prompt', {
+        'files': convo.reference_file_contents([
+            {'path': '/src', 'name': 'app.js', 'content': 'app'},
+            {'path': '/src', 'name': 'util.js', 'content': 'util'},
+        ])})})
+    convo.messages.append({'role': 'assistant', 'content': 'OK'})
+
+    # When one of them changed and a new one was added
+    files, unchanged_files = convo.get_files_to_send([
+        {'path': '/src', 'name': 'app.js', 'content': 'app'},
+        {'path': '/src', 'name': 'util.js', 'content': 'new util'},
+        {'path': '/src', 'name': 'new.js', 'content': 'new'},
+    ])
+
+    # Then only the changed and the new files are listed again
+    assert [(file['name'], file['content']) for file in files] == [
+        ('util.js', content_store.reference('new util')),
+        ('new.js', content_store.reference('new')),
+    ]
+    assert unchanged_files == ['/src/app.js']
+    prompt = content_store.render(get_prompt('components/files_list.prompt',
+                                             {'files': files, 'unchanged_files': unchanged_files}))
+    assert '**/src/util.js**:\n```\nnew util\n```' in prompt
+    assert '**/src/app.js**' not in prompt
+    assert prompt.endswith('so their content is not repeated: /src/app.js\n')
+
+
+def test_replace_files_without_listings():
+    # Given a conversation which doesn't list any files
+    project = create_project()
+    convo = AgentConvo(Developer(project))
+    convo.messages.append({'role': 'user', 'content': 'Implement the next task'})
+
+    # When
+    with patch.object(project, 'get_all_coded_files') as mock_get_all_coded_files:
+        convo.replace_files()
+
+    # Then the files are not read
+    mock_get_all_coded_files.assert_not_called()
+
+
+def test_branches_copy_on_write():
+    # Given a saved branch
+    project = create_project()
+    convo = AgentConvo(Developer(project))
+    convo.messages.append({'role': 'user', 'content': 'Implement the task'})
+    branch = convo.save_branch()
+    assert convo.branches[branch].log is convo.messages
+
+    # When the conversation continues and an earlier message is changed
+    convo.messages.append({'role': 'assistant', 'content': 'DONE'})
+    convo.replace_message(1, 'Implement the task again')
+
+    # Then the branch is unchanged
+    assert convo.messages[1]['content'] == 'Implement the task again'
+    convo.load_branch(branch, reload_files=False)
+    assert convo.messages == [convo.messages[0], {'role': 'user', 'content': 'Implement the task'}]
+
+
+@patch('helpers.AgentConvo.save_development_step')
+@patch('helpers.AgentConvo.get_saved_development_step', return_value=None)
+@patch('helpers.AgentConvo.acreate_gpt_chat_completion')
+def test_fork_join(mock_completion, mock_get_saved_step, mock_save_step):
+    # Given
+    project = create_project()
+    convo = AgentConvo(Developer(project))
+    convo.messages.append({'role': 'user', 'content': 'Implement the task'})
+    parent_messages = list(convo.messages)
+    in_flight = []
+    max_in_flight = []
+
+    async def complete(messages, *args, **kwargs):
+        in_flight.append(1)
+        max_in_flight.append(len(in_flight))
+        # The later requests finish first
+        await asyncio.sleep(0.01 * (4 - int(messages[-1]['content'][-1])))
+        in_flight.pop()
+        return {'text': f'Response to {messages[-1]["content"]}'}
+
+    mock_completion.side_effect = complete
+
+    # When
+    with patch.object(project, 'get_all_coded_files', return_value=[]), \
+         patch('helpers.AgentConvo.get_prompt', side_effect=lambda path, data: data['message']):
+        responses = convo.fork_join([('utils/echo.prompt', {'message': f'Message {i}'}, None) for i in range(4)],
+                                    max_parallel=2)
+
+    # Then the responses are in the order of the requests, and so are the saved steps
+    assert responses == [f'Response to Message {i}' for i in range(4)]
+    assert [call.args[4] for call in mock_save_step.call_args_list] == \
+           [{'text': f'Response to Message {i}'} for i in range(4)]
+    assert [call.args[3][-2]['content'] for call in mock_save_step.call_args_list] == \
+           [f'Message {i}' for i in range(4)]
+    assert max(max_in_flight) == 2
+    assert project.llm_req_num == 4
+    assert convo.messages == parent_messages
+
+
+@pytest.mark.parametrize('failure', [ValueError('API error'), {}])
+@patch('helpers.AgentConvo.save_development_step')
+@patch('helpers.AgentConvo.get_saved_development_step', return_value=None)
+@patch('helpers.AgentConvo.create_gpt_chat_completion')
+@patch('helpers.AgentConvo.acreate_gpt_chat_completion')
+def test_fork_join_failure(mock_acompletion, mock_completion, mock_get_saved_step, mock_save_step, failure):
+    # Given the second of three requests fails, or gets an empty response
+    project = create_project()
+    convo = AgentConvo(Developer(project))
+    sent = []
+
+    async def complete(messages, *args, **kwargs):
+        sent.append(messages[-1]['content'])
+        if messages[-1]['content'] == 'Message 1':
+            if isinstance(failure, Exception):
+                raise failure
+            return failure
+        await asyncio.sleep(0.01)
+        return {'text': f'Response to {messages[-1]["content"]}'}
+
+    mock_acompletion.side_effect = complete
+    mock_completion.side_effect = lambda messages, *args, **kwargs: {'text': f'Retried {messages[-1]["content"]}'}
+
+    # When
+    with patch.object(project, 'get_all_coded_files', return_value=[]), \
+         patch('helpers.AgentConvo.get_prompt', side_effect=lambda path, data: data['message']):
+        responses = convo.fork_join([('utils/echo.prompt', {'message': f'Message {i}'}, None) for i in range(3)],
+                                    max_parallel=1)
+
+    # Then the request after the failed one isn't sent, both are sent again one after the other
+    assert sent == ['Message 0', 'Message 1']
+    assert responses == ['Response to Message 0', 'Retried Message 1', 'Retried Message 2']
+    assert [call.args[4] for call in mock_save_step.call_args_list] == \
+           [{'text': 'Response to Message 0'}, {'text': 'Retried Message 1'}, {'text': 'Retried Message 2'}]
+    # And the forks don't print their responses or ask the user to retry at the same time
+    assert all(call.kwargs['stream_output'] is False and call.kwargs['interactive_retry'] is False
+               for call in mock_acompletion.call_args_list)
+
+
+@patch('helpers.AgentConvo.save_development_step')
+@patch('helpers.AgentConvo.get_saved_development_step')
+@patch('helpers.AgentConvo.acreate_gpt_chat_completion')
+def test_fork_join_skip_steps(mock_completion, mock_get_saved_step, mock_save_step):
+    # Given the first request was saved in a development step
+    project = create_project()
+    project.skip_steps = True
+    project.skip_until_dev_step = None
+    project.restore_files = Mock()
+    convo = AgentConvo(Developer(project))
+    saved_step = Mock(id=1, llm_response={'text': 'Saved response'}, token_limit_exception_raised=None,
+                      messages=convo.messages + [{'role': 'user', 'content': 'Message 0'}])
+    mock_get_saved_step.side_effect = [saved_step, None]
+    mock_completion.return_value = {'text': 'New response'}
+
+    # When
+    with patch.object(project, 'get_all_coded_files', return_value=[]), \
+         patch('helpers.AgentConvo.get_prompt', side_effect=lambda path, data: data['message']):
+        responses = convo.fork_join([('utils/echo.prompt', {'message': f'Message {i}'}, None) for i in range(3)])
+
+    # Then the saved response is restored, the steps after the first one which isn't saved are not looked up
+    assert responses == ['Saved response', 'New response', 'New response']
+    assert mock_get_saved_step.call_count == 2
+    assert mock_completion.call_count == 2
+    assert mock_save_step.call_count == 2
+    project.restore_files.assert_called_once_with(1)
+
+
+def test_get_stable_prefix_tokens():
+    # Given a request has been sent
+    project = create_project()
+    convo = AgentConvo(Developer(project))
+    convo.messages.append({'role': 'user', 'content': 'Hello world'})
+    assert convo.get_stable_prefix_tokens() == 0
+    sent_tokens = convo.get_token_count()
+
+    # When the conversation continues
+    convo.messages.append({'role': 'assistant', 'content': 'Hi'})
+    convo.messages.append({'role': 'user', 'content': 'Bye'})
+
+    # Then the messages of the last request are the stable prefix
+    assert convo.get_stable_prefix_tokens() == sent_tokens - TOKENS_PER_REPLY
+
+    # Unless an earlier message is changed
+    convo.messages[1] = {'role': 'user', 'content': 'Hello big world'}
+    assert convo.get_stable_prefix_tokens() == token_counter.count_message(convo.messages[0])
+
+
+def test_compact_if_needed_routed_model(monkeypatch):
+    # Given a conversation which fits the context window of the main model, but not the one of the routed model
+    monkeypatch.setenv('MODEL_NAME', 'gpt-4-1106-preview')
+    project = create_project()
+    convo = AgentConvo(Developer(project))
+    for i in range(20):
+        convo.messages.append({'role': 'user', 'content': f'Question {i} ' * 200})
+        convo.messages.append({'role': 'assistant', 'content': f'Answer {i} ' * 200})
+
+    with patch('helpers.AgentConvo.llm_router', LLMRouter({'utils/summary.prompt': {'model': 'gpt-4'}})):
+        # When
+        convo.compact_if_needed(prompt_path='development/task/breakdown.prompt')
+        compactions_main_model = len(convo.compactions)
+        convo.compact_if_needed(prompt_path='utils/summary.prompt')
+
+    # Then it's compacted to fit the routed model only
+    assert compactions_main_model == 0
+    assert len(convo.compactions) == 1
+    assert convo.get_token_count() < 8192
+
+
+@patch('helpers.AgentConvo.save_development_step')
+@patch('helpers.AgentConvo.get_saved_development_step', return_value=None)
+@patch('helpers.AgentConvo.create_gpt_chat_completion')
+def test_send_message_json_response(mock_completion, mock_get_saved_step, mock_save_step):
+    # Given a response which was parsed and validated by the LLM layer
+    project = create_project()
+    project.current_step = 'coding'
+    project.get_all_coded_files = lambda: []
+    convo = AgentConvo(Developer(project))
+    parsed = {'tasks': [{'type': 'command', 'command': {'command': 'npm install', 'timeout': 3000}}]}
+    response = LLMResponse('{"tasks": [{"type": "command", "command": {"command": "npm install", "timeout": 3000}}]}',
+                           parsed, validated=True)
+    mock_completion.return_value = response
+
+    # When
+    with patch('utils.function_calling.json.loads') as mock_loads, patch('helpers.AgentConvo.json.dumps') as mock_dumps:
+        result = convo.send_message('development/parse_task.prompt', {}, IMPLEMENT_TASK)
+
+    # Then the parsed response and the validated text are used as they are
+    assert result is parsed
+    assert convo.messages[-1] == {'role': 'assistant', 'content': response.text}
+    mock_loads.assert_not_called()
+    mock_dumps.assert_not_called()
+    assert mock_save_step.call_args[0][4] is response
+
+
 # def test_format_message_content_json_response():
 #     # Given
 #     project = create_project()
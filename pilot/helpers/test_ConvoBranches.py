@@ -0,0 +1,66 @@
+import gc
+import os
+
+from helpers.ConvoBranches import ConvoBranches
+
+
+def messages(count: int) -> list[dict]:
+    return [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'message {i}'} for i in range(count)]
+
+
+def test_save_and_load():
+    # Given
+    branches = ConvoBranches()
+    convo = messages(3)
+
+    # When the conversation continues after the branch was saved
+    branch = branches.save(convo, 'debug')
+    convo.append({'role': 'user', 'content': 'message 3'})
+
+    # Then the branch points to the shared messages
+    assert branch == 'debug'
+    assert 'debug' in branches
+    assert branches.keys() == ['debug']
+    assert branches['debug'].get_messages() == (convo, 3)
+    assert branches['debug'].log is convo
+
+
+def test_unreferenced_branches_garbage_collected():
+    # Given
+    branches = ConvoBranches()
+    branch = branches.save(messages(3))
+    branch_name = str(branch)
+
+    # When
+    del branch
+    gc.collect()
+
+    # Then
+    assert branch_name not in branches
+    assert len(branches) == 0
+
+
+def test_least_recently_used_branches_spilled(tmp_path):
+    # Given at most one branch in memory
+    branches = ConvoBranches(max_in_memory=1, spill_dir=str(tmp_path))
+    convo = messages(3)
+    first = branches.save(convo)
+
+    # When
+    second = branches.save(convo + messages(1))
+
+    # Then the least recently used branch is written to disk
+    assert first.log is None
+    assert second.log is not None
+    assert len(os.listdir(tmp_path)) == 1
+
+    # And read back when it's loaded
+    assert branches[first].get_messages() == (convo, 3)
+    assert os.listdir(tmp_path) == []
+
+    # And the files of garbage-collected branches are removed
+    third = branches.save(convo)
+    assert first.log is None and second.log is None
+    del first, second
+    gc.collect()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,109 @@
+from helpers.ConvoCompactor import ConvoCompactor
+from utils.token_counter import token_counter
+
+
+def file_listing(path, content):
+    return f'Here are files that are currently implemented:\n\n**{path}**:\n```\n{content}\n```\n'
+
+
+def ran_command(output):
+    return f'I ran the command `npm test`. The output was:\n\n{output}\n\nThink about this output and not any output...'
+
+
+def test_collapse_superseded_file_listings():
+    # Given the same file listed twice
+    messages = [
+        {'role': 'system', 'content': 'You are a developer'},
+        {'role': 'user', 'content': file_listing('/app.js', 'console.log("old");\n' * 50)},
+        {'role': 'assistant', 'content': 'DONE'},
+        {'role': 'user', 'content': file_listing('/app.js', 'console.log("new");\n' * 50)},
+    ]
+    compactor = ConvoCompactor(max_tokens=100_000)
+
+    # When
+    compacted, record = compactor.compact(messages, 0)
+
+    # Then only the latest listing keeps the content
+    assert '**/app.js**: (superseded, see the latest version of this file below)' in compacted[1]['content']
+    assert 'console.log("old")' not in compacted[1]['content']
+    assert compacted[3] == messages[3]
+    assert record['files_collapsed'] == ['/app.js']
+    assert record['tokens_after'] < record['tokens_before']
+    # and the original messages are left untouched
+    assert 'console.log("old")' in messages[1]['content']
+
+
+def test_trim_stale_cli_outputs():
+    # Given two command outputs
+    output = '\n'.join(f'line {i}' for i in range(100))
+    messages = [
+        {'role': 'system', 'content': 'You are a developer'},
+        {'role': 'user', 'content': 'Implement the task'},
+        {'role': 'user', 'content': ran_command(output)},
+        {'role': 'assistant', 'content': 'NEEDS_DEBUGGING'},
+        {'role': 'user', 'content': ran_command(output)},
+    ]
+    compactor = ConvoCompactor(max_tokens=token_counter.count_messages(messages) + 600, cli_output_lines=5)
+
+    # When
+    compacted, record = compactor.compact(messages, 0)
+
+    # Then the old output is trimmed and the latest is kept
+    assert 'line 4\n[... 90 lines of old output trimmed ...]\nline 95' in compacted[2]['content']
+    assert compacted[2]['content'].endswith('Think about this output and not any output...')
+    assert compacted[4] == messages[4]
+    assert record['outputs_trimmed'] == 1
+
+
+def test_evict_old_messages():
+    # Given a long conversation
+    messages = [
+        {'role': 'system', 'content': 'You are a developer'},
+        {'role': 'user', 'content': file_listing('/app.js', 'console.log("hello");')},
+    ]
+    for i in range(20):
+        messages.append({'role': 'user', 'content': f'Question {i} ' * 50})
+        messages.append({'role': 'assistant', 'content': f'Answer {i} ' * 50})
+    compactor = ConvoCompactor(max_tokens=token_counter.count_messages(messages) // 2 + 600)
+
+    # When
+    compacted, record = compactor.compact(messages, 0)
+
+    # Then the system message, the task and the latest messages are kept
+    assert compacted[:2] == messages[:2]
+    assert compacted[-2:] == messages[-2:]
+    assert compacted[2]['content'] == \
+        f'[{record["messages_evicted"]} earlier messages of this conversation were removed to fit the context window]'
+    assert record['messages_evicted'] > 0
+    assert record['tokens_after'] <= compactor.available_tokens() * compactor.target_ratio
+
+    # When compacted again, the note keeps the total count
+    compactor.max_tokens = token_counter.count_messages(compacted) // 2 + 600
+    compacted_again, record_again = compactor.compact(compacted, 0)
+
+    total = record['messages_evicted'] + record_again['messages_evicted']
+    assert compacted_again[2]['content'].startswith(f'[{total} earlier messages')
+
+
+def test_needs_compaction():
+    compactor = ConvoCompactor(max_tokens=10_600)
+
+    assert not compactor.needs_compaction(8000)
+    assert compactor.needs_compaction(9500)
+    assert compactor.needs_compaction(8000, reserved_tokens=2000)
+
+
+def test_needs_compaction_context_window(monkeypatch):
+    # The default model has a large context window
+    monkeypatch.setenv('MODEL_NAME', 'gpt-4-1106-preview')
+    compactor = ConvoCompactor()
+    assert compactor.get_context_window() == 128000
+    assert not compactor.needs_compaction(50_000)
+    assert compactor.needs_compaction(120_000)
+
+    # Unless the request is routed to a model with a smaller one
+    assert compactor.needs_compaction(50_000, model='gpt-4')
+
+    # The context window of an unknown model isn't known, the API tells if a request is too long
+    monkeypatch.setenv('MODEL_NAME', 'llama-2-70b')
+    assert not ConvoCompactor().needs_compaction(1_000_000)
@@ -414,12 +414,17 @@ class TestProjectFileLists:
     @patch('helpers.Project.DevelopmentSteps.get_or_create', return_value=('test', True))
     @patch('helpers.Project.File.get_or_create', return_value=('test', True))
     @patch('helpers.Project.FileSnapshot.get_or_create', return_value=(MagicMock(), True))
-    def test_save_files_snapshot(self, mock_snap, mock_file, mock_step):
+    @patch('helpers.Project.save_blobs', side_effect=lambda contents: [f'hash{i}' for i in range(len(contents))])
+    def test_save_files_snapshot(self, mock_blobs, mock_snap, mock_file, mock_step):
         # Given a snapshot of the files in the project
 
         # When we save the file snapshot
         self.project.save_files_snapshot('test')
 
+        # Then the snapshots point to the blobs of the contents
+        assert len(mock_blobs.call_args[0][0]) == 7
+        assert [call[1]['defaults'] for call in mock_snap.call_args_list] == [{'blob': f'hash{i}'} for i in range(7)]
+
         # Then the files should be saved to the project, but nothing from `.gpt-pilot/`
         assert mock_file.call_count == 7
         files = ['package.json', 'main.js', 'file1.js', 'file2.js', 'bar.js', 'fighters.js', 'other.js']
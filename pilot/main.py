@@ -14,7 +14,8 @@ from helpers.Project import Project
 from utils.arguments import get_arguments
 from utils.exit import exit_gpt_pilot
 from logger.logger import logger
-from database.database import database_exists, create_database, tables_exist, create_tables, get_created_apps_with_steps
+from database.database import database_exists, create_database, tables_exist, create_tables, get_created_apps_with_steps, \
+    get_llm_usage, LLM_USAGE_TOTALS, migrate_file_snapshots
 
 from utils.settings import settings, loader
 from utils.telemetry import telemetry
@@ -28,6 +29,13 @@ def init():
     if not tables_exist():
         create_tables()
 
+    # Store the contents of the file snapshots saved by older versions once, see `FileSnapshot`
+    report = migrate_file_snapshots()
+    if report is not None:
+        print(f"Moved {report['snapshots']} file snapshots to {report['blobs']} blobs, "
+              f"{report['bytes_saved'] / 1024 / 1024:.1f} MB saved "
+              f"({report['bytes_before']} bytes before, {report['bytes_after']} bytes after)")
+
     arguments = get_arguments()
 
     logger.info('Starting with args: %s', arguments)
@@ -60,6 +68,23 @@ if __name__ == "__main__":
                                 f"{'' if len(app['development_steps']) == 0 else app['development_steps'][-1]['id']:3}"
                                 f"  {app['name']}" for app in get_created_apps_with_steps()))
 
+            run_exit_fn = False
+        elif '--llm-usage' in args:
+            # Tokens and time spent on LLM requests, eg. `--llm-usage=prompt_path app_id=...`
+            group_by = args['--llm-usage'] if args['--llm-usage'] is not True else \
+                ('prompt_path' if args.get('app_id') else 'app')
+            usage = get_llm_usage(args.get('app_id'), group_by)
+            if ipc_client_instance is not None:
+                print({'llm_usage': usage}, type='info')
+            else:
+                print('----------------------------------------------------------------------------------------')
+                print('requests  prompt_tokens  completion_tokens  cached_tokens  duration  ' + group_by)
+                print('----------------------------------------------------------------------------------------')
+                print('\n'.join(f"{row['requests']:8}  {row['prompt_tokens']:13}  {row['completion_tokens']:17}  "
+                                f"{row['cached_tokens']:13}  {row['duration']:7}s  "
+                                f"{' '.join(str(row[key]) for key in row if key not in LLM_USAGE_TOTALS)}"
+                                for row in usage))
+
             run_exit_fn = False
         elif '--ux-test' in args:
             from test.ux_tests import run_test
@@ -2,7 +2,9 @@
 from utils.style import color_white_bold
 from const import common
 from const.llm import MAX_QUESTIONS, END_RESPONSE
+from database.database import save_llm_request
 from utils.llm_connection import create_gpt_chat_completion
+from utils.llm_metrics import RequestMetrics
 from utils.utils import get_sys_message, get_prompt
 from utils.questionary import styled_select, styled_text
 from logger.logger import logger
@@ -88,7 +90,9 @@ def get_additional_info_from_openai(project, messages):
     while not is_complete:
         # Obtain clarifications using the OpenAI API
         # { 'text': new_code }
-        response = create_gpt_chat_completion(messages, 'additional_info', project)
+        metrics = RequestMetrics('additional_info', None, None)
+        response = create_gpt_chat_completion(messages, 'additional_info', project, metrics=metrics)
+        save_llm_request(project, metrics)
 
         if response is not None:
             if response['text'] and response['text'].strip() == END_RESPONSE:
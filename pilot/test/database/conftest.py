@@ -0,0 +1,68 @@
+from peewee import SqliteDatabase, PostgresqlDatabase
+import pytest
+
+from database.config import (
+    DATABASE_TYPE,
+    DB_NAME,
+    DB_HOST,
+    DB_PORT,
+    DB_USER,
+    DB_PASSWORD,
+)
+from database.database import TABLES
+
+
+@pytest.fixture(autouse=True)
+def database():
+    """
+    Set up a new empty initialized test database.
+
+    In case of SQlite, the database is created in-memory. In case of PostgreSQL,
+    the database should already exist and be empty.
+
+    This fixture will create all the tables and run the test in an isolated transaction.
+    which gets rolled back after the test. The fixture also drops all the tables at the
+    end.
+    """
+    if DATABASE_TYPE == "postgres":
+        if not DB_NAME:
+            raise ValueError(
+                "PostgreSQL database name (DB_NAME) environment variable not set"
+            )
+        db = PostgresqlDatabase(
+            DB_NAME,
+            host=DB_HOST,
+            port=DB_PORT,
+            user=DB_USER,
+            password=DB_PASSWORD,
+        )
+    elif DATABASE_TYPE == "sqlite":
+        db = SqliteDatabase(":memory:")
+    else:
+        raise ValueError(f"Unexpected database type: {DATABASE_TYPE}")
+
+    db.bind(TABLES)
+
+    class PostgresRollback(Exception):
+        """
+        Mock exception to ensure rollback after each test.
+
+        Even though we drop the tables at the end of each test, if the test
+        fails due to database integrity error, we have to roll back the
+        transaction otherwise PostgreSQL will refuse any further work.
+
+        The easiest and safest is to always roll back the transaction.
+        """
+
+        pass
+
+    with db:
+        try:
+            db.create_tables(TABLES)
+            with db.atomic():
+                yield db
+                raise PostgresRollback()
+        except PostgresRollback:
+            pass
+        finally:
+            db.drop_tables(TABLES)
@@ -0,0 +1,65 @@
+from unittest.mock import Mock
+
+from database.database import save_development_step, get_saved_development_step, save_blobs, \
+    delete_unused_blobs, delete_unused_blobs_if_needed, delete_all_app_development_data
+from database.models.user import User
+from database.models.app import App
+from database.models.content_blobs import ContentBlob
+from database.models.file_snapshot import FileSnapshot
+from database.models.files import File
+from utils.content_store import content_store, hash_content
+
+
+def test_save_and_load_content_blobs():
+    # Given messages listing the same file content twice
+    app = App.create(user=User.create(email='', password=''), name='test')
+    project = Mock(args={'app_id': app.id}, checkpoints={'last_development_step': None},
+                   current_step='coding', llm_req_num=1, skip_steps=True)
+    reference = content_store.reference('console.log("Hello world");')
+    messages = [
+        {'role': 'user', 'content': f'**/src/app.js**:\n```\n{reference}\n```'},
+        {'role': 'assistant', 'content': 'DONE'},
+        {'role': 'user', 'content': f'**/src/app.js**:\n```\n{reference}\n```'},
+    ]
+
+    # When
+    step = save_development_step(project, 'development/task/breakdown.prompt', {}, messages, {'text': 'DONE'})
+
+    # Then the content is saved once
+    content_hash = hash_content('console.log("Hello world");')
+    assert [blob.hash for blob in ContentBlob.select()] == [content_hash]
+    assert step.messages == messages
+
+    # And loaded with the step when it's not in memory
+    del content_store.contents[content_hash]
+    project.checkpoints['last_development_step'] = None
+    assert get_saved_development_step(project).id == step.id
+    assert content_store.render(messages[0]['content']) == '**/src/app.js**:\n```\nconsole.log("Hello world");\n```'
+
+
+def test_delete_unused_blobs():
+    # Given blobs referenced by a file snapshot, by saved messages, and by nothing
+    content_store.saved.clear()
+    app = App.create(user=User.create(email='', password=''), name='test')
+    project = Mock(args={'app_id': app.id}, checkpoints={'last_development_step': None},
+                   current_step='coding', llm_req_num=1)
+    reference = content_store.reference('listed')
+    step = save_development_step(project, 'development/task/breakdown.prompt', {},
+                                 [{'role': 'user', 'content': f'**/a.js**:\n```\n{reference}\n```'}], {'text': 'DONE'})
+    file = File.create(app=app, name='b.js', path='', full_path='b.js')
+    snapshot_hash, unused_hash = save_blobs(['snapshot', 'unused'])
+    FileSnapshot.create(app=app, development_step=step, file=file, blob=snapshot_hash)
+
+    # When
+    assert delete_unused_blobs() == 1
+
+    # Then only the unused blob is deleted
+    assert {blob.hash for blob in ContentBlob.select()} == {hash_content('listed'), snapshot_hash}
+    assert not content_store.is_saved(unused_hash)
+
+    # And the others once the app's steps are deleted, at exit
+    delete_all_app_development_data(app)
+    assert ContentBlob.select().count() == 2
+    assert delete_unused_blobs_if_needed() == 2
+    assert ContentBlob.select().count() == 0
+    assert delete_unused_blobs_if_needed() == 0
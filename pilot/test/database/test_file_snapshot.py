@@ -1,84 +1,24 @@
 from base64 import b64decode
 
-from peewee import SqliteDatabase, PostgresqlDatabase
 import pytest
+from peewee import ForeignKeyField
 
-from database.config import (
-    DATABASE_TYPE,
-    DB_NAME,
-    DB_HOST,
-    DB_PORT,
-    DB_USER,
-    DB_PASSWORD,
-)
-from database.database import TABLES
+from database.database import migrate_file_snapshots, save_blobs
+from database.models.components.base_models import BaseModel
+from database.models.components.smart_blob_field import SmartBlobField
+from database.models.content_blobs import ContentBlob
 from database.models.user import User
 from database.models.app import App
 from database.models.file_snapshot import FileSnapshot
 from database.models.files import File
 from database.models.development_steps import DevelopmentSteps
+from utils.content_store import content_store
 
 EMPTY_PNG = b64decode(
     "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
 )
 
 
-@pytest.fixture(autouse=True)
-def database():
-    """
-    Set up a new empty initialized test database.
-
-    In case of SQlite, the database is created in-memory. In case of PostgreSQL,
-    the database should already exist and be empty.
-
-    This fixture will create all the tables and run the test in an isolated transaction.
-    which gets rolled back after the test. The fixture also drops all the tables at the
-    end.
-    """
-    if DATABASE_TYPE == "postgres":
-        if not DB_NAME:
-            raise ValueError(
-                "PostgreSQL database name (DB_NAME) environment variable not set"
-            )
-        db = PostgresqlDatabase(
-            DB_NAME,
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASSWORD,
-        )
-    elif DATABASE_TYPE == "sqlite":
-        db = SqliteDatabase(":memory:")
-    else:
-        raise ValueError(f"Unexpected database type: {DATABASE_TYPE}")
-
-    db.bind(TABLES)
-
-    class PostgresRollback(Exception):
-        """
-        Mock exception to ensure rollback after each test.
-
-        Even though we drop the tables at the end of each test, if the test
-        fails due to database integrity error, we have to roll back the
-        transaction otherwise PostgreSQL will refuse any further work.
-
-        The easiest and safest is to always roll back the transaction.
-        """
-
-        pass
-
-    with db:
-        try:
-            db.create_tables(TABLES)
-            with db.atomic():
-                yield db
-                raise PostgresRollback()
-        except PostgresRollback:
-            pass
-        finally:
-            db.drop_tables(TABLES)
-
-
 def test_create_tables(database):
     """
     Test that database tables are created for all the models.
@@ -114,3 +54,69 @@ def test_file_snapshot(content, expected_content):
     )
     from_db = FileSnapshot.get(id=fs.id)
     assert from_db.content == expected_content
+
+
+@pytest.mark.parametrize("content", ["non-ascii text: ščćž", EMPTY_PNG])
+def test_file_snapshot_blobs(content):
+    # Given two steps with the same content of a file
+    content_store.saved.clear()
+    user = User.create(email="", password="")
+    app = App.create(user=user)
+    file = File.create(app=app, name="test", path="test", full_path="test")
+    steps = [DevelopmentSteps.create(app=app, llm_response={}, prompt_path=str(i)) for i in range(2)]
+
+    # When
+    for step in steps:
+        [blob] = save_blobs([content])
+        FileSnapshot.create(app=app, development_step=step, file=file, blob=blob)
+
+    # Then the content is stored once
+    assert ContentBlob.select().count() == 1
+    assert [fs.get_content() for fs in FileSnapshot.select()] == [content, content]
+
+
+def test_migrate_file_snapshots(database):
+    # Given file snapshots saved with their contents, before the blobs
+    class LegacyFileSnapshot(BaseModel):
+        app = ForeignKeyField(App)
+        development_step = ForeignKeyField(DevelopmentSteps)
+        file = ForeignKeyField(File, null=True)
+        content = SmartBlobField()
+
+        class Meta:
+            table_name = "file_snapshot"
+
+    FileSnapshot.drop_table()
+    LegacyFileSnapshot.bind(database)
+    LegacyFileSnapshot.create_table()
+
+    user = User.create(email="", password="")
+    app = App.create(user=user)
+    files = [File.create(app=app, name=name, path="", full_path=name) for name in ("a.txt", "b.png")]
+    for i in range(3):
+        step = DevelopmentSteps.create(app=app, llm_response={}, prompt_path=str(i))
+        LegacyFileSnapshot.create(app=app, development_step=step, file=files[0], content=f"version {i // 2}".encode())
+        LegacyFileSnapshot.create(app=app, development_step=step, file=files[1], content=EMPTY_PNG)
+
+    # When
+    report = migrate_file_snapshots()
+
+    # Then each content is stored once
+    assert report == {
+        "snapshots": 6,
+        "blobs": 3,
+        "bytes_before": 3 * len("version 0") + 3 * len(EMPTY_PNG),
+        "bytes_after": 2 * len("version 0") + len(EMPTY_PNG),
+        "bytes_saved": len("version 0") + 2 * len(EMPTY_PNG),
+    }
+    assert ContentBlob.select().count() == 3
+    snapshots = (FileSnapshot.select().join(File).switch(FileSnapshot).join(DevelopmentSteps)
+                 .order_by(DevelopmentSteps.prompt_path, File.name))
+    assert [(fs.file.name, fs.get_content(), fs.content) for fs in snapshots] == [
+        ("a.txt", "version 0", None), ("b.png", EMPTY_PNG, None),
+        ("a.txt", "version 0", None), ("b.png", EMPTY_PNG, None),
+        ("a.txt", "version 1", None), ("b.png", EMPTY_PNG, None),
+    ]
+
+    # And there's nothing to do the next time
+    assert migrate_file_snapshots() is None
@@ -0,0 +1,127 @@
+from unittest.mock import Mock, patch
+
+from database.database import save_development_step, get_llm_usage
+from database.models.user import User
+from database.models.app import App
+from database.models.development_steps import DevelopmentSteps
+from database.models.llm_requests import LLMRequests
+from helpers.AgentConvo import AgentConvo
+from helpers.agents.Architect import Architect
+from helpers.test_Project import create_project
+from utils.llm_metrics import RequestMetrics
+
+
+def request_metrics(prompt_path: str, prompt_tokens: int, completion_tokens: int) -> RequestMetrics:
+    metrics = RequestMetrics('coding', prompt_path, 'gpt-4')
+    metrics.start_attempt()
+    metrics.prompt_tokens = prompt_tokens
+    metrics.completion_tokens = completion_tokens
+    metrics.finish()
+    return metrics
+
+
+def test_save_development_step_with_usage():
+    # Given
+    app = App.create(user=User.create(email='', password=''), name='test')
+    project = Mock(args={'app_id': app.id}, checkpoints={'last_development_step': None},
+                   current_step='coding', current_task=2, llm_req_num=1)
+    metrics = request_metrics('development/task/breakdown.prompt', 1000, 200)
+    metrics.usage_reported = True
+
+    # When
+    step = save_development_step(project, 'development/task/breakdown.prompt', {}, [], {'text': 'ok'},
+                                 metrics=metrics)
+
+    # Then the usage is saved to the ledger, linked to the step
+    request = LLMRequests.get(LLMRequests.development_step == step)
+    assert request.app.id == app.id
+    assert request.task == 2
+    assert (request.prompt_tokens, request.completion_tokens, request.usage_reported) == (1000, 200, True)
+
+
+def test_save_development_step_cached_response():
+    app = App.create(user=User.create(email='', password=''))
+    project = Mock(args={'app_id': app.id}, checkpoints={'last_development_step': None},
+                   current_step='coding', current_task=None, llm_req_num=1)
+
+    # The response came from the LLM cache, no request was sent
+    save_development_step(project, 'utils/summary.prompt', {}, [], {'text': 'ok'},
+                          metrics=RequestMetrics('coding', 'utils/summary.prompt', 'gpt-4'))
+
+    assert LLMRequests.select().count() == 0
+
+
+@patch('helpers.AgentConvo.create_gpt_chat_completion')
+def test_send_message_without_development_step(mock_completion):
+    # Given an agent which doesn't save development steps
+    app = App.create(user=User.create(email='', password=''), name='test')
+    project = create_project()
+    project.args['app_id'] = app.id
+    project.current_task = None
+    convo = AgentConvo(Architect(project))
+
+    def completion(*args, metrics, **kwargs):
+        metrics.start_attempt()
+        metrics.prompt_tokens = 1000
+        metrics.completion_tokens = 100
+        metrics.finish()
+        return {'text': 'ok'}
+
+    mock_completion.side_effect = completion
+
+    # When
+    convo.send_message('architecture/technologies.prompt', {'name': 'test', 'prompt': '', 'user_stories': [],
+                                                           'user_tasks': [], 'app_type': 'App'},
+                       should_log_message=False)
+
+    # Then the request is saved to the ledger all the same
+    request = LLMRequests.get()
+    assert request.development_step is None
+    assert (request.prompt_path, request.prompt_tokens, request.completion_tokens) == \
+           ('architecture/technologies.prompt', 1000, 100)
+    assert DevelopmentSteps.select().count() == 0
+
+
+def test_get_llm_usage():
+    # Given
+    user = User.create(email='', password='')
+    app = App.create(user=user, name='test')
+    other_app = App.create(user=user, name='other')
+    step = DevelopmentSteps.create(app=app, llm_response={})
+    for app_id, task, prompt_path, prompt_tokens, completion_tokens in [
+        (app, 1, 'development/task/breakdown.prompt', 1000, 500),
+        (app, 2, 'development/task/breakdown.prompt', 2000, 500),
+        (app, 2, 'dev_ops/ran_command.prompt', 300, 5),
+        (other_app, None, 'utils/summary.prompt', 100, 50),
+    ]:
+        LLMRequests.create(app=app_id, development_step=step if app_id == app else None, task=task,
+                           req_type='coding', prompt_path=prompt_path, model='gpt-4',
+                           prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, duration=1.0)
+
+    # When
+    by_app = get_llm_usage()
+    by_prompt = get_llm_usage(app.id, 'prompt_path')
+    by_task = get_llm_usage(app.id, 'task')
+
+    # Then
+    assert [(row['name'], row['requests'], row['prompt_tokens'], row['completion_tokens']) for row in by_app] == \
+           [('test', 3, 3300, 1005), ('other', 1, 100, 50)]
+    assert [(row['prompt_path'], row['requests'], row['duration']) for row in by_prompt] == \
+           [('development/task/breakdown.prompt', 2, 2.0), ('dev_ops/ran_command.prompt', 1, 1.0)]
+    assert [(row['task'], row['prompt_tokens']) for row in by_task] == [(2, 2300), (1, 1000)]
+
+
+def test_get_llm_usage_by_task():
+    # Given two apps with the same task numbers
+    user = User.create(email='', password='')
+    app = App.create(user=user, name='test')
+    other_app = App.create(user=user, name='other')
+    for app_id, prompt_tokens in [(app, 1000), (app, 500), (other_app, 100)]:
+        LLMRequests.create(app=app_id, task=1, req_type='coding', prompt_tokens=prompt_tokens, duration=1.0)
+
+    # When
+    usage = get_llm_usage(group_by='task')
+
+    # Then the tasks of each app are reported separately
+    assert [(row['name'], row['task'], row['requests'], row['prompt_tokens']) for row in usage] == \
+           [('test', 1, 2, 1500), ('other', 1, 1, 100)]
@@ -0,0 +1,219 @@
+"""
+Local stand-in for the OpenAI/OpenRouter streaming chat completions API.
+
+Replays the responses recorded by `DotGptPilot.log_chat_completion()` (`USE_GPTPILOT_FOLDER=true`),
+so the agents can be benchmarked and regression-tested offline and deterministically:
+
+    python -m test.mock_llm_server ~/.gpt-pilot/chat_log --ttft 0.5 --tokens-per-second 50
+
+and run GPT Pilot with `ENDPOINT=OPENAI OPENAI_ENDPOINT=http://127.0.0.1:8765/v1/chat/completions`.
+
+A request gets the recorded response for the same messages, or else the next recording which
+hasn't been replayed yet. Recordings may also contain an `error: {message, code}` and a `status`
+to reply with an error payload instead.
+"""
+import argparse
+import hashlib
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock, Thread
+from typing import Optional
+
+import yaml
+
+# Split responses into roughly token sized chunks: words with their trailing whitespace
+CHUNK_RE = re.compile(r'\S+\s*|\s+')
+
+
+def messages_key(messages: list[dict]) -> str:
+    messages = [{'role': message['role'], 'content': message['content']} for message in messages]
+    return hashlib.sha256(json.dumps(messages, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_recordings(path: str) -> list[dict]:
+    """
+    :param path: a `.gpt-pilot/chat_log` directory (searched recursively) or a single recording
+    :return: [{'endpoint', 'model', 'messages', 'response'}, ...] in the order they were recorded
+    """
+    path = Path(path)
+    files = [path] if path.is_file() else sorted(path.rglob('*.yaml'))
+    recordings = []
+    for file in files:
+        with open(file, 'r', encoding='utf-8') as fp:
+            recording = yaml.safe_load(fp)
+        if isinstance(recording, dict) and 'messages' in recording:
+            recordings.append(recording)
+    return recordings
+
+
+class MockLLMServer:
+    """
+    Streams recorded chat completions over HTTP, with a configurable time to first token and
+    tokens per second, so local overhead can be measured separately from the LLM latency.
+
+    >>> with MockLLMServer(load_recordings('chat_log'), ttft=0.2, tokens_per_second=100) as server:
+    ...     os.environ['OPENAI_ENDPOINT'] = server.url
+    ...     ...
+    ...     server.stats()
+    {'requests': 12, 'matched': 11, 'replayed_in_order': 1, 'unmatched': 0, 'tokens': 5310}
+    """
+
+    def __init__(self, recordings: list[dict], ttft: float = 0.0, tokens_per_second: Optional[float] = None,
+                 keep_alive: bool = False, host: str = '127.0.0.1', port: int = 0):
+        """
+        :param recordings: see `load_recordings()`
+        :param ttft: seconds before the first token is sent
+        :param tokens_per_second: streaming speed after the first token, None for no delay
+        :param keep_alive: send OpenRouter keep-alive comments while waiting for the first token
+        """
+        self.recordings = recordings
+        self.by_messages = {}
+        for i, recording in enumerate(recordings):
+            self.by_messages.setdefault(messages_key(recording['messages']), []).append(i)
+        self.replayed = set()
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.keep_alive = keep_alive
+        self.counters = {'requests': 0, 'matched': 0, 'replayed_in_order': 0, 'unmatched': 0, 'tokens': 0}
+        self.lock = Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/v1/chat/completions'
+
+    def start(self) -> 'MockLLMServer':
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
+
+    def find_recording(self, messages: list[dict]) -> Optional[dict]:
+        """
+        :return: the recording for these messages, or the next one that wasn't replayed yet
+        """
+        with self.lock:
+            self.counters['requests'] += 1
+            for i in self.by_messages.get(messages_key(messages), []):
+                if i not in self.replayed:
+                    self.replayed.add(i)
+                    self.counters['matched'] += 1
+                    return self.recordings[i]
+            for i, recording in enumerate(self.recordings):
+                if i not in self.replayed:
+                    self.replayed.add(i)
+                    self.counters['replayed_in_order'] += 1
+                    return recording
+            self.counters['unmatched'] += 1
+            return None
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                recording = server.find_recording(body.get('messages', []))
+                model = body.get('model', 'gpt-4')
+
+                if recording is None:
+                    self.send_error_payload(404, {'message': 'No recorded response left for this request',
+                                                  'code': 'not_found'})
+                elif 'error' in recording:
+                    self.send_error_payload(recording.get('status', 500), recording['error'])
+                else:
+                    self.stream(model, recording.get('response') or '')
+
+            def send_error_payload(self, status: int, error: dict):
+                payload = json.dumps({'error': error}).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def write_chunk(self, data: bytes):
+                self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+                self.wfile.flush()
+
+            def write_event(self, data: dict):
+                self.write_chunk(f'data: {json.dumps(data)}\n\n'.encode('utf-8'))
+
+            def stream(self, model: str, response: str):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+
+                started = time.monotonic()
+                if server.keep_alive:
+                    self.write_chunk(b': OPENROUTER PROCESSING\n\n')
+                time.sleep(max(server.ttft - (time.monotonic() - started), 0))
+
+                completion_id = f'chatcmpl-mock-{int(started * 1000)}'
+                chunks = CHUNK_RE.findall(response)
+                for i, content in enumerate(chunks):
+                    if i > 0 and server.tokens_per_second:
+                        time.sleep(1 / server.tokens_per_second)
+                    delta = {'role': 'assistant', 'content': content} if i == 0 else {'content': content}
+                    self.write_event({'id': completion_id, 'object': 'chat.completion.chunk', 'model': model,
+                                      'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})
+
+                self.write_event({'id': completion_id, 'object': 'chat.completion.chunk', 'model': model,
+                                  'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+                self.write_chunk(b'data: [DONE]\n\n')
+                self.write_chunk(b'')
+
+                with server.lock:
+                    server.counters['tokens'] += len(chunks)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded LLM responses over a local OpenAI-compatible API')
+    parser.add_argument('recordings', help='`.gpt-pilot/chat_log` directory or a recorded .yaml file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--ttft', type=float, default=0.0, help='seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=None)
+    parser.add_argument('--keep-alive', action='store_true', help='send OpenRouter keep-alive comments')
+    args = parser.parse_args()
+
+    server = MockLLMServer(load_recordings(args.recordings), ttft=args.ttft, tokens_per_second=args.tokens_per_second,
+                           keep_alive=args.keep_alive, host=args.host, port=args.port)
+    print(f'Replaying {len(server.recordings)} recorded responses at {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats()))
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
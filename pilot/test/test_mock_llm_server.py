@@ -0,0 +1,66 @@
+import builtins
+import time
+
+import pytest
+import yaml
+
+from helpers.Project import Project
+from helpers.exceptions import TokenLimitError
+from test.mock_llm_server import MockLLMServer, load_recordings
+from utils.custom_print import get_custom_print
+from utils.llm_connection import create_gpt_chat_completion
+
+project = Project({'app_id': 'test-app'}, current_step='test', enable_dot_pilot_gpt=False)
+MESSAGES = [{'role': 'user', 'content': 'Say hello'}]
+
+
+@pytest.fixture
+def recordings(tmp_path):
+    chat_log = tmp_path / 'chat_log'
+    (chat_log / 'task_1').mkdir(parents=True)
+    with open(chat_log / '2023-11-01_10_00_00-test.yaml', 'w') as fp:
+        yaml.safe_dump({'endpoint': 'OPENAI', 'model': 'gpt-4', 'messages': MESSAGES,
+                        'response': 'Hello there, how can I help?'}, fp)
+    with open(chat_log / 'task_1' / '2023-11-01_10_01_00-test.yaml', 'w') as fp:
+        yaml.safe_dump({'endpoint': 'OPENAI', 'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'x'}],
+                        'response': 'Something else'}, fp)
+    return load_recordings(str(chat_log))
+
+
+@pytest.fixture(autouse=True)
+def llm_env(monkeypatch):
+    builtins.print, _ = get_custom_print({})
+    monkeypatch.setenv('ENDPOINT', 'OPENAI')
+    monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+
+
+def test_load_recordings(recordings):
+    assert [recording['response'] for recording in recordings] == ['Hello there, how can I help?', 'Something else']
+
+
+def test_replay(recordings, monkeypatch):
+    with MockLLMServer(recordings, ttft=0.2, tokens_per_second=100, keep_alive=True) as server:
+        monkeypatch.setenv('OPENAI_ENDPOINT', server.url)
+
+        started = time.monotonic()
+        response = create_gpt_chat_completion(MESSAGES, 'test', project, use_cache=False)
+        elapsed = time.monotonic() - started
+        # No recording for these messages, so the next recording is replayed
+        other = create_gpt_chat_completion([{'role': 'user', 'content': 'y'}], 'test', project, use_cache=False)
+
+        assert response == {'text': 'Hello there, how can I help?'}
+        assert other == {'text': 'Something else'}
+        assert elapsed >= 0.2 + 5 / 100
+        assert server.stats() == {'requests': 2, 'matched': 1, 'replayed_in_order': 1, 'unmatched': 0, 'tokens': 8}
+
+
+def test_error_payload(monkeypatch):
+    recordings = [{'messages': MESSAGES, 'status': 400,
+                   'error': {'message': 'This model maximum context length is 8192 tokens',
+                             'code': 'context_length_exceeded'}}]
+
+    with MockLLMServer(recordings) as server:
+        monkeypatch.setenv('OPENAI_ENDPOINT', server.url)
+
+        with pytest.raises(TokenLimitError):
+            create_gpt_chat_completion(MESSAGES, 'test', project, use_cache=False)
@@ -0,0 +1,41 @@
+from utils.content_store import ContentStore, hash_content
+
+
+def test_reference_and_render():
+    # Given
+    store = ContentStore()
+    content = 'print("\\n")'
+    reference = store.reference(content)
+    message = {'role': 'user', 'content': f'**/app.py**:\n```\n{reference}\n```'}
+    plain = {'role': 'assistant', 'content': 'DONE'}
+
+    # When
+    rendered = store.render_messages([message, plain])
+
+    # Then the content is filled in, the messages are not changed
+    assert rendered == [{'role': 'user', 'content': '**/app.py**:\n```\nprint("\\n")\n```'}, plain]
+    assert rendered[1] is plain
+    assert message['content'] == f'**/app.py**:\n```\n{reference}\n```'
+    assert reference == f'<<content {hash_content(content)}>>'
+
+
+def test_render_without_references():
+    store = ContentStore()
+    messages = [{'role': 'user', 'content': 'Hello world'}]
+
+    assert store.render_messages(messages) is messages
+
+
+def test_unsaved_and_missing():
+    # Given
+    store = ContentStore()
+    saved = store.reference('saved')
+    unsaved = store.reference('unsaved')
+    store.add({hash_content('saved'): 'saved'}, saved=True)
+    missing = f'<<content {hash_content("missing")}>>'
+    messages = [{'role': 'user', 'content': f'{saved}\n{unsaved}\n{missing}'}]
+
+    # Then
+    assert store.unsaved(messages) == {hash_content('unsaved'): 'unsaved'}
+    assert store.missing(messages) == {hash_content('missing')}
+    assert store.render(missing) == missing
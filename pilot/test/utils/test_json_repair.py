@@ -0,0 +1,89 @@
+import json
+
+import pytest
+from jsonschema import ValidationError
+
+from utils.json_repair import repair_json, JsonRepairStats
+from utils.llm_connection import repair_json_response
+
+FUNCTIONS = [{
+    'name': 'save_files',
+    'description': 'Save files',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'files': {'type': 'array', 'items': {'type': 'string'}},
+            'done': {'type': 'boolean'},
+        },
+        'required': ['files'],
+    },
+}]
+
+
+@pytest.mark.parametrize('text, expected, fixes', [
+    ('{"done": True, "files": []}', {'done': True, 'files': []}, ['python_literal']),
+    ('{"a": None, "b": False}', {'a': None, 'b': False}, ['python_literal']),
+    ("{'files': ['a.js']}", {'files': ['a.js']}, ['single_quotes']),
+    ('{"code": "line 1\nline 2\ttab"}', {'code': 'line 1\nline 2\ttab'}, ['control_character']),
+    ('{"code": "it\\\'s"}', {'code': "it's"}, ['invalid_escape']),
+    ('{"files": ["a.js", "b.js",],}', {'files': ['a.js', 'b.js']}, ['trailing_comma']),
+    ('Here is the JSON:\n```json\n{"files": []}\n```\nLet me know!', {'files': []},
+     ['leading_text', 'trailing_text']),
+    ('{"files": ["a.js"}', {'files': ['a.js']}, ['missing_bracket']),
+    ('{"files": ["a.js"]]}', {'files': ['a.js']}, ['extra_bracket']),
+    ('{"files": ["a.js", "b.js"', {'files': ['a.js', 'b.js']}, ['truncated']),
+    ('{"files": [], "done": tr', {'files': []}, ['truncated']),
+    ('{"files": [], "count": 1.', {'files': [], 'count': 1}, ['truncated']),
+    ('{"files": [], "done":', {'files': []}, ['truncated']),
+    ('{"files": [], "do', {'files': []}, ['truncated_string', 'truncated']),
+    ('{"files": ["a.js", "b', {'files': ['a.js', 'b']}, ['truncated_string', 'truncated']),
+])
+def test_repair_json(text, expected, fixes):
+    repaired, applied = repair_json(text)
+
+    assert json.loads(repaired) == expected
+    assert applied == fixes
+
+
+def test_valid_json_unchanged():
+    text = '{"code": "say \\"hi\\"\\n", "list": [1, -2.5e3, true, null], "nested": {"a": []}}'
+    assert repair_json(text) == (text, [])
+
+
+def test_repair_json_response(monkeypatch):
+    stats = JsonRepairStats()
+    monkeypatch.setattr('utils.llm_connection.json_repair_stats', stats)
+
+    response = repair_json_response('{"files": ["a.js"], "done": True,}', FUNCTIONS)
+    assert response == {'text': '{"files": ["a.js"], "done": true}'}
+    assert response.parsed == {'files': ['a.js'], 'done': True}
+    assert response.validated
+    assert response.repairs == ['python_literal', 'trailing_comma']
+    # Missing brackets are closed when the LLM stopped by itself
+    assert repair_json_response('{"files": ["a.js"]', FUNCTIONS, 'stop').text == '{"files": ["a.js"]}'
+    # Valid responses are parsed once
+    assert repair_json_response('{"files": []}', FUNCTIONS).repairs == []
+
+    assert stats.stats() == {'repaired': 2, 'retried': 0,
+                             'fixes': {'python_literal': 1, 'trailing_comma': 1, 'truncated': 1}}
+
+
+@pytest.mark.parametrize('response, finish_reason', [
+    # Closing these would lose the rest of the response, the LLM is asked to continue it
+    ('{"files": ["a.js", "b', 'stop'),
+    ('{"files": ["a.js"]', 'length'),
+    # Not JSON at all
+    ('I am not sure what you mean', 'stop'),
+])
+def test_repair_json_response_not_repaired(response, finish_reason):
+    with pytest.raises(json.JSONDecodeError):
+        repair_json_response(response, FUNCTIONS, finish_reason)
+
+
+def test_repair_json_response_invalid_schema():
+    # The schema is validated after the repair
+    with pytest.raises(json.JSONDecodeError):
+        repair_json_response('{"files": "a.js", "done": True}', FUNCTIONS)
+    # A valid JSON response which doesn't match the schema is not repaired
+    with pytest.raises(ValidationError):
+        repair_json_response('{"files": "a.js"}', FUNCTIONS)
@@ -0,0 +1,108 @@
+import json
+
+import pytest
+from jsonschema import ValidationError
+
+from const.function_calls import DEBUG_STEPS_BREAKDOWN
+from utils.json_stream import StreamingJsonParser
+
+SCHEMA = DEBUG_STEPS_BREAKDOWN['definitions'][0]['parameters']
+RESPONSE = {
+    'thoughts': 'The "server" crashed \\ restart it',
+    'reasoning': 'Because',
+    'steps': [
+        {'type': 'command', 'check_if_fixed': True, 'command': {'command': 'npm start', 'timeout': 3000}},
+        {'type': 'code_change', 'check_if_fixed': False, 'code_change_description': 'Fix {the} [bug]'},
+    ],
+}
+
+
+def feed(parser, text, chunk_size):
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i + chunk_size])
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 1000])
+def test_valid_response(chunk_size):
+    # Given a valid response wrapped in a code block
+    text = '```json\n' + json.dumps(RESPONSE, indent=2) + '\n```'
+    parser = StreamingJsonParser(SCHEMA)
+
+    # When
+    feed(parser, text, chunk_size)
+
+    # Then
+    assert parser.started
+    assert parser.done
+    assert parser.num_validated > 0
+
+
+def test_chunks_are_not_copied():
+    # Given a response streamed in small chunks
+    text = json.dumps(RESPONSE, indent=2)
+    parser = StreamingJsonParser(SCHEMA)
+
+    # When
+    feed(parser, text, 3)
+
+    # Then the chunks are kept as they are, and the values are sliced across them
+    assert len(parser.chunks) == -(-len(text) // 3)
+    assert parser.text == text
+    start = text.index('"Because"')
+    assert parser.slice(start, start + len('"Because"')) == '"Because"'
+    assert parser.slice(0, len(text)) == text
+
+
+def test_invalid_value_aborts_early():
+    # Given a response with an invalid step type
+    text = json.dumps(RESPONSE, indent=2).replace('"command",', '"run",', 1)
+    parser = StreamingJsonParser(SCHEMA)
+
+    # When
+    with pytest.raises(ValidationError) as exc_info:
+        feed(parser, text, 3)
+
+    # Then it stops at the invalid value
+    assert exc_info.value.json_path == '$.steps[0].type'
+    assert parser.pos < text.index('code_change')
+
+
+def test_missing_required_property():
+    text = json.dumps({**RESPONSE, 'steps': [{'type': 'command'}]})
+    parser = StreamingJsonParser(SCHEMA)
+
+    with pytest.raises(ValidationError) as exc_info:
+        feed(parser, text, 3)
+
+    assert exc_info.value.json_path == '$.steps[0]'
+    assert exc_info.value.message == "'check_if_fixed' is a required property"
+
+
+def test_mismatched_bracket():
+    parser = StreamingJsonParser(SCHEMA)
+
+    # The rest of the response is left to `repair_json_response()`
+    feed(parser, '{"thoughts": "a", "steps": [}, "reasoning": 42}', 3)
+
+    assert parser.done
+    assert parser.error == 'Unexpected `}` in array at 28'
+    assert parser.num_validated == 1
+
+
+def test_python_booleans_are_accepted():
+    text = json.dumps(RESPONSE).replace('true', 'True').replace('false', 'False')
+    parser = StreamingJsonParser(SCHEMA)
+
+    feed(parser, text, 4)
+
+    assert parser.done
+
+
+def test_incomplete_response():
+    text = json.dumps(RESPONSE)
+    parser = StreamingJsonParser(SCHEMA)
+
+    parser.feed(text[:len(text) // 2])
+
+    assert parser.started
+    assert not parser.done
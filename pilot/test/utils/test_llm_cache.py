@@ -0,0 +1,79 @@
+import os
+import time
+
+from utils.llm_cache import LLMCache
+
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def test_key_depends_on_request():
+    key = LLMCache.key("gpt-4", "OPENAI", MESSAGES)
+
+    assert key == LLMCache.key("gpt-4", "OPENAI", [{"role": "user", "content": "Hello"}])
+    assert key != LLMCache.key("gpt-3.5-turbo", "OPENAI", MESSAGES)
+    assert key != LLMCache.key("gpt-4", "OPENROUTER", MESSAGES)
+    assert key != LLMCache.key("gpt-4", "OPENAI", MESSAGES, {"definitions": [{"name": "foo"}], "functions": {}})
+
+
+def test_get_put(tmp_path):
+    cache = LLMCache(enabled=True, cache_dir=tmp_path)
+    key = LLMCache.key("gpt-4", "OPENAI", MESSAGES)
+
+    assert cache.get(key) is None
+    cache.put(key, {"text": "Hi!"})
+
+    assert cache.get(key) == {"text": "Hi!"}
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_put_replaces_entry(tmp_path):
+    cache = LLMCache(enabled=True, cache_dir=tmp_path)
+    key = LLMCache.key("gpt-4", "OPENAI", MESSAGES)
+
+    cache.put(key, {"text": "a" * 50})
+    cache.put(key, {"text": "b" * 20})
+
+    # The size of the replaced entry isn't counted anymore
+    assert cache.size == cache.path(key).stat().st_size
+    assert cache.get(key) == {"text": "b" * 20}
+
+
+def test_ttl_expiry(tmp_path):
+    cache = LLMCache(enabled=True, cache_dir=tmp_path, ttl=60)
+    key = LLMCache.key("gpt-4", "OPENAI", MESSAGES)
+    cache.put(key, {"text": "Hi!"})
+
+    created = time.time() - 120
+    os.utime(cache.path(key), (created, created))
+
+    assert cache.get(key) is None
+    assert not cache.path(key).exists()
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = LLMCache(enabled=True, cache_dir=tmp_path, max_size=250)
+    keys = [LLMCache.key("gpt-4", "OPENAI", [{"role": "user", "content": str(i)}]) for i in range(3)]
+
+    cache.put(keys[0], {"text": "a" * 50})
+    cache.put(keys[1], {"text": "b" * 50})
+    # Mark the first entry as older than the second one, then use it
+    os.utime(cache.path(keys[0]), (time.time() - 100, time.time() - 100))
+    os.utime(cache.path(keys[1]), (time.time() - 50, time.time() - 50))
+    assert cache.get(keys[0]) is not None
+
+    cache.put(keys[2], {"text": "c" * 50})
+
+    assert cache.path(keys[0]).exists()
+    assert not cache.path(keys[1]).exists()
+    assert cache.path(keys[2]).exists()
+
+
+def test_clear(tmp_path):
+    cache = LLMCache(enabled=True, cache_dir=tmp_path)
+    key = LLMCache.key("gpt-4", "OPENAI", MESSAGES)
+    cache.put(key, {"text": "Hi!"})
+
+    cache.clear()
+
+    assert cache.get(key) is None
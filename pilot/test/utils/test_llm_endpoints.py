@@ -0,0 +1,182 @@
+import asyncio
+import time
+from unittest.mock import patch, Mock
+
+import pytest
+import requests
+
+from utils.llm_endpoints import Endpoint, EndpointError, StreamStalledError, get_endpoints, open_stream
+
+
+def delta(content: str) -> bytes:
+    return ('{"choices": [{"index": 0, "delta": {"content": "' + content + '"}}]}').encode('utf-8')
+
+
+def mock_response(status_code=200, lines=(), delay=0.0, stall_after=None):
+    def iter_lines():
+        time.sleep(delay)
+        for i, line in enumerate(lines):
+            if i == stall_after:
+                time.sleep(1)
+            yield line
+
+    response = Mock()
+    response.status_code = status_code
+    response.text = '{"error": {"message": "Server error"}}'
+    response.iter_lines.side_effect = iter_lines
+    return response
+
+
+def read_all(endpoints, responses, hedge_after=10.0):
+    """Open the stream with `responses` by endpoint name and read it to the end"""
+    async def read():
+        stream = await open_stream(endpoints, {'model': 'gpt-4', 'messages': []}, 100, hedge_after=hedge_after)
+        try:
+            return stream.endpoint.name, [line async for line in stream]
+        finally:
+            await stream.aclose()
+
+    def post(name, url, **kwargs):
+        response = responses[name]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    with patch('utils.llm_endpoints.session_pool.post', side_effect=post) as mock_post:
+        return asyncio.run(read()), mock_post
+
+
+def test_get_endpoints(monkeypatch):
+    monkeypatch.setenv('ENDPOINT', 'AZURE')
+    monkeypatch.setenv('MODEL_NAME', 'gpt-4')
+    monkeypatch.delenv('LLM_ENDPOINTS', raising=False)
+    assert [repr(endpoint) for endpoint in get_endpoints()] == ['AZURE gpt-4']
+
+    monkeypatch.setenv('LLM_ENDPOINTS', 'openai, OPENROUTER:openai/gpt-4,LOCAL:codellama')
+    assert [repr(endpoint) for endpoint in get_endpoints()] == \
+           ['OPENAI gpt-4', 'OPENROUTER openai/gpt-4', 'LOCAL codellama']
+
+
+def test_request_data(monkeypatch):
+    data = {'model': 'gpt-4', 'n': 1, 'temperature': 1, 'messages': []}
+    monkeypatch.delenv('OPENAI_ENDPOINT', raising=False)
+
+    assert Endpoint('OPENAI', 'gpt-4-1106-preview').request_data(data) == \
+           {'model': 'gpt-4-1106-preview', 'n': 1, 'temperature': 1, 'messages': [],
+            'stream_options': {'include_usage': True}}
+    # An OpenAI-compatible server may not accept `stream_options`
+    monkeypatch.setenv('OPENAI_ENDPOINT', 'http://localhost:8000/v1/chat/completions')
+    assert 'stream_options' not in Endpoint('OPENAI', 'gpt-4').request_data(data)
+    openrouter = Endpoint('OPENROUTER', 'openai/gpt-4').request_data(data)
+    assert openrouter['model'] == 'openai/gpt-4'
+    assert 'n' not in openrouter and 'temperature' not in openrouter
+    # A routed response limit is kept
+    assert Endpoint('OPENROUTER', 'openai/gpt-4').request_data({**data, 'max_tokens': 20})['max_tokens'] == 20
+    # The request data itself is left untouched
+    assert data == {'model': 'gpt-4', 'n': 1, 'temperature': 1, 'messages': []}
+
+
+def test_local_endpoint_without_api_key(monkeypatch):
+    monkeypatch.delenv('LOCAL_API_KEY', raising=False)
+    monkeypatch.setenv('LOCAL_ENDPOINT', 'http://localhost:1234/v1/chat/completions')
+
+    endpoint = Endpoint('LOCAL', 'codellama')
+
+    assert endpoint.url == 'http://localhost:1234/v1/chat/completions'
+    assert endpoint.headers() == {'Content-Type': 'application/json'}
+
+
+def test_fails_over_on_server_error(monkeypatch):
+    # Given the preferred endpoint responds with a 502 and the next one can't be reached
+    monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+    monkeypatch.setenv('OPENROUTER_API_KEY', 'secret')
+    endpoints = [Endpoint('OPENAI', 'gpt-4'), Endpoint('OPENROUTER', 'openai/gpt-4'), Endpoint('LOCAL', 'gpt-4')]
+    failed = mock_response(502)
+
+    # When
+    (name, lines), mock_post = read_all(endpoints, {
+        'OPENAI': failed,
+        'OPENROUTER': requests.ConnectionError('Connection refused'),
+        'LOCAL': mock_response(lines=[b': OPENROUTER PROCESSING', delta('Hello')]),
+    })
+
+    # Then the last endpoint answers
+    assert name == 'LOCAL'
+    assert lines == [b': OPENROUTER PROCESSING', delta('Hello')]
+    assert mock_post.call_count == 3
+    failed.close.assert_called()
+
+
+def test_client_error_does_not_fail_over(monkeypatch):
+    # Given the preferred endpoint rejects the request
+    monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+    monkeypatch.setenv('OPENROUTER_API_KEY', 'secret')
+    endpoints = [Endpoint('OPENAI', 'gpt-4'), Endpoint('OPENROUTER', 'openai/gpt-4')]
+
+    # When
+    with pytest.raises(EndpointError) as exc_info:
+        read_all(endpoints, {'OPENAI': mock_response(400), 'OPENROUTER': mock_response(lines=[delta('Hello')])})
+
+    # Then the error is raised for `retry_on_exception()` to handle
+    assert exc_info.value.status_code == 400
+    assert not exc_info.value.failover
+    assert 'API responded with status code: 400' in str(exc_info.value)
+
+
+def test_all_endpoints_fail(monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+    endpoints = [Endpoint('OPENAI', 'gpt-4'), Endpoint('LOCAL', 'gpt-4')]
+
+    with pytest.raises(EndpointError) as exc_info:
+        read_all(endpoints, {'OPENAI': mock_response(500), 'LOCAL': mock_response(503)})
+
+    assert exc_info.value.failover
+    assert exc_info.value.endpoint is endpoints[1]
+
+
+def test_hedges_slow_first_token(monkeypatch):
+    # Given the preferred endpoint is slow to send the first token
+    monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+    endpoints = [Endpoint('OPENAI', 'gpt-4'), Endpoint('LOCAL', 'gpt-4')]
+    slow = mock_response(lines=[delta('slow')], delay=1)
+    fast = mock_response(lines=[delta('fast'), delta('!')])
+
+    # When
+    (name, lines), mock_post = read_all(endpoints, {'OPENAI': slow, 'LOCAL': fast}, hedge_after=0.05)
+
+    # Then the hedged request answers first and the slow one is cancelled
+    assert name == 'LOCAL'
+    assert lines == [delta('fast'), delta('!')]
+    assert mock_post.call_count == 2
+    slow.close.assert_called()
+
+
+@patch('utils.llm_endpoints.LLM_FIRST_BYTE_TIMEOUT', 0.05)
+def test_first_byte_timeout(monkeypatch):
+    # Given an endpoint which only sends keep-alive comments
+    monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+    stalled = mock_response(lines=[b': OPENROUTER PROCESSING', delta('late')], stall_after=1)
+
+    # When
+    with pytest.raises(StreamStalledError) as exc_info:
+        read_all([Endpoint('OPENAI', 'gpt-4')], {'OPENAI': stalled})
+
+    # Then the request is cancelled
+    assert exc_info.value.failover
+    assert exc_info.value.function_buffer is None
+    stalled.close.assert_called()
+
+
+@patch('utils.llm_endpoints.LLM_IDLE_TIMEOUT', 0.05)
+def test_idle_timeout(monkeypatch):
+    # Given an endpoint which stops sending in the middle of the response
+    monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+    stalled = mock_response(lines=[delta('Hello'), delta(' world')], stall_after=1)
+
+    # When
+    with pytest.raises(StreamStalledError) as exc_info:
+        read_all([Endpoint('OPENAI', 'gpt-4')], {'OPENAI': stalled})
+
+    # Then the stream is cancelled
+    assert 'stopped sending data' in str(exc_info.value)
+    stalled.close.assert_called()
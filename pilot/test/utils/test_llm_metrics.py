@@ -0,0 +1,90 @@
+import json
+
+from utils.llm_metrics import Histogram, LLMMetrics, RequestMetrics
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in [0.1, 0.2, 0.3, 1.5, 40]:
+        histogram.add(value)
+
+    assert histogram.to_dict() == {
+        'count': 5,
+        'mean': 8.42,
+        'min': 0.1,
+        'max': 40,
+        'p50': 0.5,
+        'p90': 40,
+        'p99': 40,
+        'buckets': {'0.125': 1, '0.25': 1, '0.5': 1, '2': 1, '64': 1},
+    }
+    assert Histogram().to_dict() == {'count': 0}
+
+
+def test_histogram_merge():
+    first, second = Histogram(), Histogram()
+    first.add(1)
+    second.add(3)
+    second.add(100)
+
+    first.merge(second)
+
+    assert first.count == 3
+    assert first.min == 1 and first.max == 100
+    assert first.to_dict()['buckets'] == {'1': 1, '4': 1, '128': 1}
+
+
+def request(req_type, prompt_path, ttft, attempt_errors=(), error=None):
+    metrics = RequestMetrics(req_type, prompt_path, 'gpt-4')
+    for _ in range(len(attempt_errors) + 1):
+        metrics.start_attempt()
+    metrics.ttft = ttft
+    metrics.chunks = 10
+    metrics.chars = 40
+    metrics.attempt_errors = list(attempt_errors)
+    metrics.finish(error)
+    return metrics
+
+
+def test_summary():
+    # Given requests of two types, one of which was retried and one failed
+    metrics = LLMMetrics()
+    metrics.record(request('coding', 'development/implement_changes.prompt', 2.0, ['ValidationError']))
+    metrics.record(request('coding', 'development/task/breakdown.prompt', 4.0))
+    metrics.record(request('architecture', 'architecture/technologies.prompt', 1.0, error=ValueError()))
+
+    # When
+    by_req_type = metrics.summary(('req_type',))
+    by_prompt = metrics.summary()
+
+    # Then
+    assert set(by_req_type) == {'coding', 'architecture'}
+    assert by_req_type['coding']['requests'] == 2
+    assert by_req_type['coding']['retries'] == 1
+    assert by_req_type['coding']['errors'] == {'ValidationError': 1}
+    assert by_req_type['coding']['ttft']['mean'] == 3.0
+    assert by_req_type['coding']['connect_time'] == {'count': 0}
+    assert by_req_type['architecture']['failed'] == 1
+    assert by_prompt['coding development/task/breakdown.prompt gpt-4']['ttft']['max'] == 4.0
+
+
+def test_dump(tmp_path):
+    metrics = LLMMetrics(keep_requests=True)
+    metrics.record(request('coding', 'development/implement_changes.prompt', 2.0))
+
+    metrics.dump(tmp_path / 'metrics.json')
+
+    with open(tmp_path / 'metrics.json') as fp:
+        dumped = json.load(fp)
+    assert dumped['by_req_type']['coding']['requests'] == 1
+    assert list(dumped['by_prompt']) == ['coding development/implement_changes.prompt gpt-4']
+    assert dumped['requests'][0]['prompt_path'] == 'development/implement_changes.prompt'
+    assert dumped['requests'][0]['ttft'] == 2.0
+
+
+def test_requests_not_kept_by_default():
+    metrics = LLMMetrics()
+    metrics.record(request('coding', 'development/implement_changes.prompt', 2.0))
+
+    assert metrics.requests == []
+    assert metrics.summary(('req_type',))['coding']['requests'] == 1
@@ -0,0 +1,75 @@
+import asyncio
+from unittest.mock import patch, AsyncMock
+
+import pytest
+from requests.structures import CaseInsensitiveDict
+
+from utils.llm_rate_limiter import RateLimiter, parse_duration
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('20ms', 0.02),
+    ('1s', 1),
+    ('6m0s', 360),
+    ('1h2m3.5s', 3723.5),
+    ('2', 2),
+    ('soon', None),
+])
+def test_parse_duration(value, expected):
+    assert parse_duration(value) == expected
+
+
+def test_no_limits_known():
+    limiter = RateLimiter()
+
+    assert limiter.reserve('OPENAI', 'gpt-4', 1000) == 0
+    limiter.update('OPENAI', 'gpt-4', CaseInsensitiveDict())
+    assert limiter.reserve('OPENAI', 'gpt-4', 1000) == 0
+
+
+def test_waits_for_tokens():
+    # Given 1000 tokens left which are refilled in 6s
+    limiter = RateLimiter(max_jitter=0)
+    limiter.update('OPENAI', 'gpt-4', CaseInsensitiveDict({
+        'x-ratelimit-limit-requests': '200',
+        'x-ratelimit-remaining-requests': '199',
+        'x-ratelimit-reset-requests': '300ms',
+        'x-ratelimit-limit-tokens': '10000',
+        'x-ratelimit-remaining-tokens': '1000',
+        'x-ratelimit-reset-tokens': '6s',
+    }))
+
+    # Then the first request goes through and the second one has to wait
+    assert limiter.reserve('OPENAI', 'gpt-4', 1000) == 0
+    assert limiter.reserve('OPENAI', 'gpt-4', 1500) == pytest.approx(1, abs=0.01)
+    # Other models have their own limits
+    assert limiter.reserve('OPENAI', 'gpt-3.5-turbo', 1500) == 0
+    assert limiter.stats()['delayed'] == 1
+
+
+def test_retry_after():
+    limiter = RateLimiter(max_jitter=0.1)
+    limiter.update('OPENROUTER', 'gpt-4', {'retry-after': '2'})
+
+    wait = limiter.reserve('OPENROUTER', 'gpt-4', 100)
+
+    assert 2 * 0.99 < wait <= 2 * 1.1
+
+
+def test_ignores_invalid_headers():
+    limiter = RateLimiter()
+
+    limiter.update('OPENAI', 'gpt-4', {'x-ratelimit-remaining-tokens': 'many'})
+    limiter.update('OPENAI', 'gpt-4', None)
+
+    assert limiter.reserve('OPENAI', 'gpt-4', 100) == 0
+
+
+@patch('utils.llm_rate_limiter.asyncio.sleep', new_callable=AsyncMock)
+def test_acquire(mock_sleep):
+    limiter = RateLimiter(max_jitter=0)
+    limiter.update('OPENAI', 'gpt-4', {'retry-after-ms': '500'})
+
+    asyncio.run(limiter.acquire('OPENAI', 'gpt-4', 100))
+
+    assert mock_sleep.call_args[0][0] == pytest.approx(0.5, abs=0.01)
@@ -0,0 +1,73 @@
+from unittest.mock import patch, AsyncMock
+
+from utils.llm_connection import create_gpt_chat_completion
+from utils.llm_endpoints import get_endpoints
+from utils.llm_routing import LLMRouter, Route, DEFAULT_ROUTE
+
+
+def messages(count: int) -> list[dict]:
+    return [{'role': 'system', 'content': 'You are a developer'}] + \
+        [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'message {i}'} for i in range(count)]
+
+
+def test_route_precedence():
+    router = LLMRouter({
+        'dev_ops/ran_command.prompt': {'max_tokens': 10},
+        'coding': {'model': 'gpt-4-1106-preview'},
+        '*': {'model': 'gpt-3.5-turbo-16k'},
+    }, fast_model='gpt-3.5-turbo')
+
+    # LLM_ROUTES overrides the fast route
+    assert repr(router.route('coding', 'dev_ops/ran_command.prompt')) == \
+           'dev_ops/ran_command.prompt (max_tokens=10)'
+    assert router.route('coding', 'utils/summary.prompt').model == 'gpt-3.5-turbo'
+    assert router.route('coding', 'development/implement_changes.prompt').model == 'gpt-4-1106-preview'
+    assert router.route('architecture', None).model == 'gpt-3.5-turbo-16k'
+
+    assert LLMRouter().route('coding', 'dev_ops/ran_command.prompt') is DEFAULT_ROUTE
+
+
+def test_invalid_routes_ignored(tmp_path):
+    assert LLMRouter.load('{"coding": ') == {}
+    assert LLMRouter.load(str(tmp_path / 'missing.json')) == {}
+
+    path = tmp_path / 'routes.json'
+    path.write_text('{"coding": {"model": "gpt-4"}, "debug": {"temperature": 0}}')
+    router = LLMRouter(LLMRouter.load(str(path)))
+
+    assert router.route('coding').model == 'gpt-4'
+    assert router.route('debug') is DEFAULT_ROUTE
+
+
+def test_trim():
+    convo = messages(6)
+
+    assert Route('all').trim(convo) == convo
+    assert Route('recent', context=2).trim(convo) == [convo[0], convo[1], convo[5], convo[6]]
+    assert Route('short', context=2).trim(convo[:3]) == convo[:3]
+
+
+def test_routed_endpoints(monkeypatch):
+    monkeypatch.setenv('LLM_ENDPOINTS', 'OPENAI')
+    assert [repr(endpoint) for endpoint in get_endpoints('OPENROUTER,LOCAL:codellama', 'openai/gpt-3.5-turbo')] == \
+           ['OPENROUTER openai/gpt-3.5-turbo', 'LOCAL codellama']
+
+
+@patch('utils.llm_connection.astream_gpt_completion', new_callable=AsyncMock, return_value={'text': 'DONE'})
+@patch('utils.llm_connection.llm_router', LLMRouter({}, fast_model='gpt-3.5-turbo'))
+def test_create_gpt_chat_completion_routed(mock_astream, monkeypatch):
+    monkeypatch.setenv('MODEL_NAME', 'gpt-4')
+    convo = messages(6)
+
+    # When
+    response = create_gpt_chat_completion(convo, 'coding', None, use_cache=False,
+                                          prompt_path='dev_ops/ran_command.prompt', stable_prefix_tokens=100)
+
+    # Then the request goes to the fast model, with the trimmed conversation
+    assert response == {'text': 'DONE'}
+    gpt_data = mock_astream.call_args[0][0]
+    assert gpt_data['model'] == 'gpt-3.5-turbo'
+    assert gpt_data['max_tokens'] == 20
+    assert gpt_data['messages'] == [convo[0], convo[1], convo[5], convo[6]]
+    assert gpt_data['metrics'].route == 'dev_ops/ran_command.prompt'
+    assert gpt_data['metrics'].stable_prefix_tokens is None
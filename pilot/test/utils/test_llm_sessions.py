@@ -0,0 +1,68 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from utils.llm_sessions import SessionPool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    server.shutdown()
+    server.server_close()
+
+
+def test_session_pool_reuses_connection(server_url):
+    pool = SessionPool(pool_size=2, keep_alive=True)
+
+    for _ in range(3):
+        response = pool.post("OPENAI", server_url, json={"messages": []})
+        assert response.json() == {"ok": True}
+
+    key = SessionPool.session_key("OPENAI", server_url)
+    assert pool.stats() == {key: {"requests": 3, "connections": 1, "reused": 2}}
+    pool.close()
+    assert pool.stats() == {}
+
+
+def test_session_pool_without_keep_alive(server_url):
+    pool = SessionPool(pool_size=2, keep_alive=False)
+
+    for _ in range(2):
+        pool.post("OPENAI", server_url, json={"messages": []})
+
+    key = SessionPool.session_key("OPENAI", server_url)
+    assert pool.stats()[key]["requests"] == 2
+    assert pool.stats()[key]["reused"] == 0
+    pool.close()
+
+
+def test_session_pool_separate_sessions_per_endpoint():
+    pool = SessionPool()
+
+    openai = pool.get("OPENAI", "https://api.openai.com/v1/chat/completions")
+    openrouter = pool.get("OPENROUTER", "https://openrouter.ai/api/v1/chat/completions")
+
+    assert openai is not openrouter
+    assert pool.get("OPENAI", "https://api.openai.com/v1/chat/completions") is openai
+    pool.close()
@@ -0,0 +1,59 @@
+import asyncio
+import builtins
+from unittest.mock import Mock, patch
+
+from utils.stream_output import StreamPrinter, StreamStats
+
+
+def test_coalesces_deltas_until_line_break():
+    # Given
+    stats = StreamStats()
+    printer = StreamPrinter(interval=60, stats=stats)
+    mock_print = Mock()
+
+    with patch.object(builtins, 'print', mock_print):
+        # When
+        for content in ['def ', 'foo', '():\n', '    return ', '42']:
+            printer.write(content)
+        assert mock_print.call_count == 1
+        printer.close()
+
+    # Then
+    assert [call.args[0] for call in mock_print.call_args_list] == ['def foo():\n', '    return 42']
+    assert mock_print.call_args.kwargs == {'type': 'stream', 'end': '', 'flush': True}
+    assert stats.stats() == {'deltas': 5, 'writes': 2}
+
+
+@patch('utils.stream_output.time.monotonic')
+def test_flushes_after_interval(mock_monotonic):
+    mock_monotonic.side_effect = [0, 0.01, 0.02, 0.05, 0.05, 0.06]
+    printer = StreamPrinter(interval=0.04, stats=StreamStats())
+    mock_print = Mock()
+
+    with patch.object(builtins, 'print', mock_print):
+        printer.write('a')
+        printer.write('b')
+        printer.write('c')
+        printer.write('d')
+
+    assert [call.args[0] for call in mock_print.call_args_list] == ['abc']
+    assert printer.buffer == ['d']
+
+
+def test_flushes_partial_line_on_timer():
+    # Given a partial line and no more deltas for a while
+    printer = StreamPrinter(interval=0.01, stats=StreamStats())
+    mock_print = Mock()
+
+    async def stream():
+        printer.write('Thinking')
+        assert mock_print.call_count == 0
+        await asyncio.sleep(0.05)
+
+    # When
+    with patch.object(builtins, 'print', mock_print):
+        asyncio.run(stream())
+
+    # Then it's printed without waiting for the next delta
+    assert [call.args[0] for call in mock_print.call_args_list] == ['Thinking']
+    assert printer.timer is None
@@ -0,0 +1,64 @@
+from unittest.mock import patch, Mock
+
+from utils.token_counter import TokenCounter, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, get_context_window
+
+
+def create_counter():
+    encoder = Mock()
+    encoder.encode.side_effect = lambda text, **kwargs: text.split()
+    counter = TokenCounter()
+    counter.encoder = encoder
+    counter.encoder_loaded = True
+    return counter, encoder
+
+
+def test_count_is_memoized():
+    counter, encoder = create_counter()
+
+    assert counter.count('Hello big world') == 3
+    assert counter.count('Hello big world') == 3
+    assert counter.count('') == 0
+
+    assert encoder.encode.call_count == 1
+    assert counter.stats() == {'hits': 1, 'misses': 1}
+
+
+def test_count_messages():
+    counter, encoder = create_counter()
+    messages = [
+        {'role': 'system', 'content': 'You are a developer'},
+        {'role': 'user', 'content': 'Hello world'},
+    ]
+
+    assert counter.count_messages(messages) == 2 * TOKENS_PER_MESSAGE + 2 + 4 + 2 + TOKENS_PER_REPLY
+
+
+def test_count_evicts_oldest_entries():
+    counter, encoder = create_counter()
+    counter.max_entries = 2
+
+    counter.count('one')
+    counter.count('two')
+    counter.count('three')
+    counter.count('one')
+
+    assert encoder.encode.call_count == 4
+
+
+@patch('utils.token_counter.tiktoken.get_encoding', side_effect=Exception('offline'))
+def test_count_without_tokenizer(mock_get_encoding):
+    counter = TokenCounter()
+
+    assert counter.count('a' * 10) == 3
+    assert counter.count('b' * 10) == 3
+    assert mock_get_encoding.call_count == 1
+
+
+def test_get_context_window():
+    assert get_context_window('gpt-4') == 8192
+    assert get_context_window('gpt-4-1106-preview') == 128000
+    assert get_context_window('openai/gpt-4-32k-0613') == 32768
+    assert get_context_window('llama-2-70b') is None
+
+    with patch('utils.token_counter.LLM_CONTEXT_WINDOW', 4096):
+        assert get_context_window('gpt-4-1106-preview') == 4096
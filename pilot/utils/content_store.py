@@ -0,0 +1,141 @@
+import hashlib
+import re
+from threading import Lock
+from typing import Iterable, Optional, Union
+
+from logger.logger import logger
+
+# Stands for a file content in the messages until they're sent, see `ContentStore.reference()`
+CONTENT_REFERENCE = '<<content {}>>'
+CONTENT_REFERENCE_RE = re.compile(r'<<content ([0-9a-f]{64})>>')
+
+
+def encode_content(content: Union[str, bytes]) -> bytes:
+    return content.encode('utf-8', errors='surrogatepass') if isinstance(content, str) else content
+
+
+def hash_content(content: Union[str, bytes]) -> str:
+    return hashlib.sha256(encode_content(content)).hexdigest()
+
+
+class ContentStore:
+    """
+    File contents listed in the conversations, by hash, so each version of a file is held once however
+    many messages list it.
+
+    Messages hold a short reference to the content instead of the content itself (see `components/files_list.prompt`),
+    the full text is filled in when a request is sent. The database keeps the contents once as well, in the
+    `content_blobs` table (see `save_content_blobs()` and `load_content_blobs()` in `database/database.py`).
+
+    This class is a singleton, use the `content_store` global variable to access it:
+
+    >>> from utils.content_store import content_store
+    >>> reference = content_store.reference('console.log("Hello world");')
+    >>> reference
+    '<<content 3f1c...>>'
+    >>> content_store.render(f'**/src/app.js**:\\n```\\n{reference}\\n```')
+    '**/src/app.js**:\\n```\\nconsole.log("Hello world");\\n```'
+    """
+
+    def __init__(self):
+        self.contents: dict[str, str] = {}
+        # Hashes of the contents which are in the database
+        self.saved: set[str] = set()
+        self.lock = Lock()
+
+    def reference(self, content: str) -> str:
+        """
+        :param content: file content
+        :return: the reference to put in messages instead of the content
+        """
+        content_hash = hash_content(content)
+        with self.lock:
+            self.contents.setdefault(content_hash, content)
+        return CONTENT_REFERENCE.format(content_hash)
+
+    def get(self, content_hash: str) -> Optional[str]:
+        with self.lock:
+            return self.contents.get(content_hash)
+
+    def add(self, contents: dict[str, str], saved: bool = False):
+        """
+        :param contents: {hash: content}
+        :param saved: True if the contents are in the database
+        """
+        with self.lock:
+            self.contents.update(contents)
+            if saved:
+                self.saved.update(contents)
+
+    def mark_saved(self, hashes: Iterable[str]):
+        """
+        Record contents as saved in the database without holding them in memory, see `save_blobs()`
+        """
+        with self.lock:
+            self.saved.update(hashes)
+
+    def mark_unsaved(self, hashes: Iterable[str]):
+        """
+        Record contents as deleted from the database, see `delete_unused_blobs()`
+        """
+        with self.lock:
+            self.saved.difference_update(hashes)
+
+    def is_saved(self, content_hash: str) -> bool:
+        with self.lock:
+            return content_hash in self.saved
+
+    def unsaved(self, messages: Iterable[dict]) -> dict[str, str]:
+        """
+        :return: {hash: content} of the contents referenced in `messages` which are not in the database yet
+        """
+        hashes = {content_hash for message in messages for content_hash in self.references(message['content'])}
+        with self.lock:
+            return {content_hash: self.contents[content_hash] for content_hash in hashes - self.saved
+                    if content_hash in self.contents}
+
+    def missing(self, messages: Iterable[dict]) -> set[str]:
+        """
+        :return: hashes of the contents referenced in `messages` which are not in memory
+        """
+        hashes = {content_hash for message in messages for content_hash in self.references(message['content'])}
+        with self.lock:
+            return hashes - self.contents.keys()
+
+    @staticmethod
+    def references(text: str) -> list[str]:
+        if '<<content ' not in text:
+            return []
+        return CONTENT_REFERENCE_RE.findall(text)
+
+    def render(self, text: str) -> str:
+        """
+        :return: `text` with the references replaced by the contents
+        """
+        if '<<content ' not in text:
+            return text
+
+        def replace(match):
+            content = self.get(match.group(1))
+            if content is None:
+                logger.warning(f'Content {match.group(1)} not found, sending the reference instead')
+                return match.group(0)
+            return content
+
+        return CONTENT_REFERENCE_RE.sub(replace, text)
+
+    def render_message(self, message: dict) -> dict:
+        content = self.render(message['content'])
+        return message if content is message['content'] else {**message, 'content': content}
+
+    def render_messages(self, messages: list[dict]) -> list[dict]:
+        """
+        :return: `messages` with the references replaced by the contents, `messages` itself if there are none
+        """
+        rendered = [self.render_message(message) for message in messages]
+        if all(message is original for message, original in zip(rendered, messages)):
+            return messages
+        return rendered
+
+
+content_store = ContentStore()
@@ -60,7 +60,7 @@ class DotGptPilot:
 
                 yaml.safe_dump(data, file, width=120, indent=2, default_flow_style=False, sort_keys=False)
 
-    def log_chat_completion_json(self, endpoint: str, model: str, req_type: str, functions: dict, json_response: str):
+    def log_chat_completion_json(self, endpoint: str, model: str, req_type: str, functions: dict, response):
         if not USE_GPTPILOT_FOLDER:
             return
         if self.log_chat_completions:
@@ -71,7 +71,8 @@ class DotGptPilot:
                     'endpoint': endpoint,
                     'model': model,
                     'functions': functions,
-                    'response': json.loads(json_response),
+                    # Already parsed, see `LLMResponse.parsed`
+                    'response': response,
                 }
 
                 json.dump(data, file, indent=2)
@@ -3,8 +3,18 @@ import os
 import hashlib
 import requests
 
+from const.llm import LLM_METRICS_FILE
+from database.database import delete_unused_blobs_if_needed
 from helpers.cli import terminate_running_processes
+from logger.logger import logger
 from utils.questionary import styled_text
+from utils.llm_cache import llm_cache
+from utils.json_repair import json_repair_stats
+from utils.llm_endpoints import failover_stats
+from utils.llm_metrics import llm_metrics
+from utils.llm_rate_limiter import rate_limiter
+from utils.llm_sessions import session_pool
+from utils.stream_output import stream_stats
 
 from utils.telemetry import telemetry
 
@@ -95,6 +105,7 @@ def ask_user_email(project, path_id, ask_feedback):
 
 def exit_gpt_pilot(project, ask_feedback=True):
     terminate_running_processes()
+    delete_unused_blobs_if_needed()
     path_id = get_path_id()
 
     send_telemetry(path_id)
@@ -109,7 +120,26 @@ def exit_gpt_pilot(project, ask_feedback=True):
 
     telemetry.set("num_commands", project.command_runs_count if project is not None else 0)
     telemetry.set("num_inputs", project.user_inputs_count if project is not None else 0)
+    telemetry.set("llm_metrics", llm_metrics.summary(('req_type',)))
 
     telemetry.send()
 
+    logger.info('LLM connection reuse: %s', session_pool.stats())
+    logger.info('LLM rate limiting: %s', rate_limiter.stats())
+    logger.info('LLM hedging and failover: %s', failover_stats.stats())
+    logger.info('LLM stream output: %s', stream_stats.stats())
+    if project is not None and project.ipc_client_instance is not None:
+        # One socket write (`sendall()`) per message, see `IPCClient.send()`
+        logger.info('IPC messages sent: %d', project.ipc_client_instance.num_messages)
+    logger.info('LLM JSON repairs and retries: %s', json_repair_stats.stats())
+    logger.info('LLM request metrics: %s', llm_metrics.summary(('req_type',)))
+    if LLM_METRICS_FILE:
+        try:
+            llm_metrics.dump(LLM_METRICS_FILE)
+        except OSError as err:
+            logger.error(f'Unable to write the LLM request metrics to {LLM_METRICS_FILE}: {err}')
+    if llm_cache.enabled:
+        logger.info('LLM response cache: %s', llm_cache.stats())
+    session_pool.close()
+
     print('Exit', type='exit')
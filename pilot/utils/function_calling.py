@@ -1,7 +1,18 @@
+import hashlib
 import json
 import re
+from collections import OrderedDict
+from threading import Lock
 from typing import Union, TypeVar, List, Dict, Literal, Optional, TypedDict, Callable
 
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+from const import function_calls as function_call_sets
+from const.llm import LLM_JSON_TRANSPORT
+from .llm_response import LLMResponse
+from .token_counter import token_counter
+
 JsonTypeBase = Union[str, int, float, bool, None, List["JsonType"], Dict[str, "JsonType"]]
 JsonType = TypeVar("JsonType", bound=JsonTypeBase)
 
@@ -34,28 +45,42 @@ class FunctionCallSet(TypedDict):
     functions: dict[str, Callable]
 
 
-def add_function_calls_to_request(gpt_data, function_calls: Union[FunctionCallSet, None]):
+def add_function_calls_to_request(gpt_data, function_calls: Union[FunctionCallSet, None],
+                                  transport: Optional[str] = None):
+    """
+    Advise the LLM of the JSON response schema we are expecting.
+
+    :param gpt_data: request data, with 'model' and 'messages'
+    :param function_calls: (optional) {'definitions': [{ 'name': str }, ...]}
+    :param transport: (optional) 'prompt', 'tools' or 'json_object', instead of `LLM_JSON_TRANSPORT`
+    """
     if function_calls is None:
         return
-
-    model: str = gpt_data['model']
-    is_instruct = 'llama' in model or 'anthropic' in model
+    transport = transport or LLM_JSON_TRANSPORT
 
     gpt_data['functions'] = function_calls['definitions']
-
-    prompter = JsonPrompter(is_instruct)
-
-    if len(function_calls['definitions']) > 1:
-        function_call = None
-    else:
-        function_call = function_calls['definitions'][0]['name']
+    compiled = schema_registry.get(function_calls['definitions'])
+
+    # Instruct models and function selection only work with the schema in the prompt
+    if compiled.tools is not None and not is_instruct_model(gpt_data['model']):
+        if transport == 'tools':
+            # The response is streamed as the arguments of the tool call, see `astream_gpt_completion()`
+            gpt_data['tools'] = compiled.tools
+            gpt_data['tool_choice'] = compiled.tool_choice
+            return
+        if transport == 'json_object':
+            gpt_data['response_format'] = {'type': 'json_object'}
 
     gpt_data['messages'].append({
         'role': 'user',
-        'content': prompter.prompt('', function_calls['definitions'], function_call)
+        'content': compiled.prompt(gpt_data['model'])
     })
 
 
+def is_instruct_model(model: str) -> bool:
+    return 'llama' in model or 'anthropic' in model
+
+
 def parse_agent_response(response, function_calls: Union[FunctionCallSet, None]):
     """
     Post-processes the response from the agent.
@@ -67,6 +92,9 @@ def parse_agent_response(response, function_calls: Union[FunctionCallSet, None])
     Returns: The post-processed response.
     """
     if function_calls:
+        if isinstance(response, LLMResponse) and response.validated:
+            # Already parsed by `astream_gpt_completion()`
+            return response.parsed
         text = response['text']
         return json.loads(text)
 
@@ -198,3 +226,135 @@ class JsonPrompter:
             return f"[INST] <<SYS>>\n{system}\n\n{data}\n<</SYS>>\n\n{prompt} [/INST]"
         else:
             return f"{system}\n\n{data}\n\n{prompt}"
+
+
+class CompiledFunctionCalls:
+    """
+    Everything derived from a set of function definitions that is needed for every request:
+    the JSON schema validator, the rendered prompt and its token count.
+
+    Use `schema_registry.get(definitions)` instead of creating these directly.
+    """
+
+    def __init__(self, definitions: list[FunctionType]):
+        self.definitions = definitions
+        self.schema = definitions[0]['parameters'] if definitions else None
+        self.validator = None
+        if self.schema is not None:
+            validator_cls = validator_for(self.schema)
+            validator_cls.check_schema(self.schema)
+            self.validator = validator_cls(self.schema)
+
+        # Validators for parts of the schema, shared by every `StreamingJsonParser` for this schema
+        self.subschema_validators = {}
+
+        function_call = definitions[0]['name'] if len(definitions) == 1 else None
+        # For the native tool calling transport, see `add_function_calls_to_request()`
+        self.tools = [{'type': 'function', 'function': definitions[0]}] if function_call else None
+        self.tool_choice = {'type': 'function', 'function': {'name': function_call}} if function_call else None
+        self.prompts = {
+            is_instruct: JsonPrompter(is_instruct).prompt('', definitions, function_call)
+            for is_instruct in (False, True)
+        }
+        self.prompt_tokens = {}
+
+    def prompt(self, model: str) -> str:
+        """
+        :param model: model name, eg. 'gpt-4'
+        :return: the prompt describing the expected JSON response
+        """
+        return self.prompts[is_instruct_model(model)]
+
+    def num_tokens(self, model: str) -> int:
+        """
+        :param model: model name, eg. 'gpt-4'
+        :return: number of tokens in the prompt
+        """
+        is_instruct = is_instruct_model(model)
+        if is_instruct not in self.prompt_tokens:
+            self.prompt_tokens[is_instruct] = token_counter.count(self.prompts[is_instruct])
+        return self.prompt_tokens[is_instruct]
+
+    def validate(self, instance):
+        """
+        Same as `jsonschema.validate()`, without building a new validator.
+
+        :raises ValidationError: if the instance doesn't match the schema of the first function
+        """
+        if self.validator is None:
+            return
+        error = best_match(self.validator.iter_errors(instance))
+        if error is not None:
+            raise error
+
+
+class SchemaRegistry:
+    """
+    Compiled function definitions, so the schema validators and prompts aren't rebuilt for every request.
+
+    Every `FunctionCallSet` in `const/function_calls.py` is compiled when this module is imported.
+    Sets which are built at runtime (eg. in `Developer.install_technology()`) are compiled on first
+    use and cached by the hash of their content.
+
+    This class is a singleton, use the `schema_registry` global variable to access it:
+
+    >>> from utils.function_calling import schema_registry
+    >>> compiled = schema_registry.get(IMPLEMENT_TASK['definitions'])
+    >>> compiled.prompt('gpt-4')
+    >>> compiled.validate(json.loads(response))
+    """
+
+    def __init__(self, max_dynamic: int = 128):
+        self.max_dynamic = max_dynamic
+        # id(definitions) -> compiled definitions, for the sets that live as long as the process
+        self.static: dict[int, CompiledFunctionCalls] = {}
+        # content hash -> compiled definitions, least recently used are evicted first
+        self.dynamic: OrderedDict[str, CompiledFunctionCalls] = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def digest(definitions: list[FunctionType]) -> str:
+        return hashlib.sha256(json.dumps(definitions, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def register(self, definitions: list[FunctionType]) -> CompiledFunctionCalls:
+        """
+        Compile a set of function definitions which is never modified, eg. from `const/function_calls.py`.
+        """
+        compiled = CompiledFunctionCalls(definitions)
+        self.static[id(definitions)] = compiled
+        return compiled
+
+    def register_module(self, module):
+        """
+        Compile every `FunctionCallSet` defined in a module.
+        """
+        for value in vars(module).values():
+            if isinstance(value, dict) and isinstance(value.get('definitions'), list):
+                self.register(value['definitions'])
+
+    def get(self, definitions: list[FunctionType]) -> CompiledFunctionCalls:
+        """
+        :param definitions: function definitions, eg. `function_calls['definitions']`
+        :return: the compiled definitions
+        """
+        compiled = self.static.get(id(definitions))
+        if compiled is not None and compiled.definitions is definitions:
+            return compiled
+
+        key = self.digest(definitions)
+        with self.lock:
+            compiled = self.dynamic.get(key)
+            if compiled is not None:
+                self.dynamic.move_to_end(key)
+                return compiled
+
+        compiled = CompiledFunctionCalls(definitions)
+        with self.lock:
+            self.dynamic[key] = compiled
+            if len(self.dynamic) > self.max_dynamic:
+                self.dynamic.popitem(last=False)
+        return compiled
+
+
+schema_registry = SchemaRegistry()
+schema_registry.register_module(function_call_sets)
@@ -0,0 +1,190 @@
+import re
+from threading import Lock
+
+# Valid characters after a backslash in a JSON string
+JSON_ESCAPES = '"\\/bfnrtu'
+PYTHON_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+CLOSING = {'{': '}', '[': ']'}
+WORD_RE = re.compile(r'[A-Za-z_]+')
+# A string in key position at the end of a truncated object, with no value
+DANGLING_KEY_RE = re.compile(r'([{,])\s*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+# A value cut off in the middle
+PARTIAL_LITERAL_RE = re.compile(r'(?<=[:\[,\s])(t|tr|tru|f|fa|fal|fals|n|nu|nul)$')
+PARTIAL_NUMBER_RE = re.compile(r'(?<=\d)[.eE][-+]?$|(?<=[:\[,\s])-$')
+
+
+def repair_json(text: str) -> tuple[str, list[str]]:
+    """
+    Fix the common faults of JSON written by LLMs, in a single pass over the text:
+
+      - text before or after the JSON value, eg. "Here is the JSON: ```json ..." (`leading_text`, `trailing_text`)
+      - Python literals `True`, `False` and `None` (`python_literal`)
+      - single quoted strings (`single_quotes`)
+      - raw new lines and other control characters inside strings (`control_character`)
+      - invalid escapes, eg. `\\'` (`invalid_escape`)
+      - trailing commas before `}` or `]` (`trailing_comma`)
+      - mismatched closing brackets (`missing_bracket`, `extra_bracket`)
+      - a truncated response: an unterminated string (`truncated_string`), a key without a value,
+        a partial value or unclosed brackets (`truncated`)
+
+    The result is not guaranteed to be valid JSON, it still has to be parsed and validated.
+
+    >>> repair_json('{"done": True, "files": [\\'a.js\\',]}')
+    ('{"done": true, "files": ["a.js"]}', ['python_literal', 'single_quotes', 'trailing_comma'])
+
+    :param text: the JSON response
+    :return: the repaired text and the names of the fixes, in the order they were applied (empty if none)
+    """
+    fixes = []
+
+    def fix(name: str):
+        if name not in fixes:
+            fixes.append(name)
+
+    start = min((i for i in (text.find('{'), text.find('[')) if i >= 0), default=-1)
+    if start < 0:
+        return text, fixes
+    if text[:start].strip():
+        fix('leading_text')
+
+    out = []
+    stack = []
+    quote = None  # the quote character of the string being read, if any
+    pos = start
+    end = len(text)
+
+    while pos < end:
+        char = text[pos]
+
+        if quote is not None:
+            if char == '\\':
+                if pos + 1 >= end:
+                    # Truncated after the backslash
+                    pos += 1
+                    continue
+                escaped = text[pos + 1]
+                if escaped in JSON_ESCAPES:
+                    out.append(text[pos:pos + 2])
+                else:
+                    fix('invalid_escape')
+                    out.append(escaped if escaped != '"' else '\\"')
+                pos += 2
+                continue
+            if char == quote:
+                out.append('"')
+                quote = None
+            elif char == '"':
+                # A double quote inside a single quoted string
+                out.append('\\"')
+            elif char < ' ':
+                fix('control_character')
+                out.append({'\n': '\\n', '\r': '\\r', '\t': '\\t'}.get(char, f'\\u{ord(char):04x}'))
+            else:
+                out.append(char)
+            pos += 1
+            continue
+
+        if char == '"' or char == "'":
+            if char == "'":
+                fix('single_quotes')
+            quote = char
+            out.append('"')
+        elif char in '{[':
+            stack.append(char)
+            out.append(char)
+        elif char in '}]':
+            if strip_trailing_comma(out):
+                fix('trailing_comma')
+            if stack and CLOSING[stack[-1]] == char:
+                stack.pop()
+                out.append(char)
+            elif any(CLOSING[opening] == char for opening in stack):
+                # Close the brackets the LLM forgot to close
+                fix('missing_bracket')
+                while CLOSING[stack[-1]] != char:
+                    out.append(CLOSING[stack.pop()])
+                stack.pop()
+                out.append(char)
+            else:
+                fix('extra_bracket')
+            if not stack:
+                pos += 1
+                break
+        else:
+            match = WORD_RE.match(text, pos) if char.isalpha() else None
+            if match:
+                word = match.group()
+                if word in PYTHON_LITERALS:
+                    fix('python_literal')
+                    word = PYTHON_LITERALS[word]
+                out.append(word)
+                pos = match.end()
+                continue
+            out.append(char)
+        pos += 1
+
+    if text[pos:].strip(' \t\r\n`'):
+        fix('trailing_text')
+
+    if quote is not None or stack:
+        repaired = ''.join(out)
+        if quote is not None:
+            fix('truncated_string')
+            repaired += '"'
+        fix('truncated')
+        repaired = complete_truncated(repaired.rstrip(), stack)
+        return repaired, fixes
+
+    return ''.join(out), fixes
+
+
+def strip_trailing_comma(out: list[str]) -> bool:
+    """Remove a comma (and the white space after it) from the end of the output"""
+    i = len(out) - 1
+    while i >= 0 and out[i] in (' ', '\t', '\r', '\n'):
+        i -= 1
+    if i >= 0 and out[i] == ',':
+        del out[i:]
+        return True
+    return False
+
+
+def complete_truncated(text: str, stack: list[str]) -> str:
+    """Drop the value which was cut off and close the open objects and arrays"""
+    text = PARTIAL_LITERAL_RE.sub('', text)
+    text = PARTIAL_NUMBER_RE.sub('', text).rstrip()
+    if stack[-1] == '{':
+        text = DANGLING_KEY_RE.sub(r'\1', text)
+    text = text.rstrip().rstrip(',')
+    return text + ''.join(CLOSING[opening] for opening in reversed(stack))
+
+
+class JsonRepairStats:
+    """
+    Counts the invalid JSON responses repaired locally, by fix, and the ones sent back to the LLM to retry.
+
+    This class is a singleton, use the `json_repair_stats` global variable to access it.
+    """
+
+    def __init__(self):
+        self.repaired = 0
+        self.retried = 0
+        self.fixes: dict[str, int] = {}
+        self.lock = Lock()
+
+    def add_repair(self, fixes: list[str]):
+        with self.lock:
+            self.repaired += 1
+            for name in fixes:
+                self.fixes[name] = self.fixes.get(name, 0) + 1
+
+    def add_retry(self):
+        with self.lock:
+            self.retried += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'repaired': self.repaired, 'retried': self.retried, 'fixes': dict(self.fixes)}
+
+
+json_repair_stats = JsonRepairStats()
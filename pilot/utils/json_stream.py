@@ -0,0 +1,244 @@
+import json
+import re
+from bisect import bisect_right
+from typing import Optional, Union
+
+from jsonschema.validators import validator_for
+
+from logger.logger import logger
+
+# Characters which end a string, or need attention inside one
+STRING_SPECIAL_RE = re.compile(r'["\\]')
+CLOSING = {'}': 'object', ']': 'array'}
+
+
+class Frame:
+    """An object or array which is still being streamed"""
+
+    def __init__(self, kind: str, start: int, path: list[Union[str, int]]):
+        self.kind = kind
+        self.start = start
+        self.path = path
+        self.key: Optional[str] = None
+        self.index = 0
+        self.expect_key = kind == 'object'
+
+
+class StreamingJsonParser:
+    """
+    Incremental JSON parser for streamed LLM responses.
+
+    Fed with the response chunk by chunk, it tracks the structure of the JSON object and validates
+    every value against the matching part of the JSON schema as soon as the value is complete,
+    so we can stop streaming a response that is bound to be rejected by `assert_json_schema()`.
+
+    >>> compiled = schema_registry.get(function_calls['definitions'])
+    >>> parser = StreamingJsonParser(compiled.schema, compiled.subschema_validators)
+    >>> for chunk in stream:
+    ...     parser.feed(chunk)  # raises ValidationError as soon as a value doesn't match the schema
+
+    Any text before the first `{` or `[` (eg. "```json") and after the end of the JSON object is ignored,
+    that is left to `clean_json_response()`. Validation only covers the parts of the schema reachable
+    through `properties` and `items`, the complete response is still validated at the end.
+
+    Mismatched brackets stop the incremental parsing (see `error`) without failing the stream,
+    `repair_json_response()` may still fix the complete response.
+    """
+
+    def __init__(self, schema: Optional[dict], validators: Optional[dict] = None):
+        """
+        :param schema: JSON schema of the expected response
+        :param validators: (optional) cache of validators for parts of the schema, shared between parsers
+        """
+        self.schema = schema
+        # The response so far, as received: copying it into one string for every chunk would take
+        # quadratic time on long responses, the values are sliced from the chunks when they're complete
+        self.chunks: list[str] = []
+        self.offsets: list[int] = []
+        self.length = 0
+        self.pos = 0
+        self.stack: list[Frame] = []
+        self.started = False
+        self.done = False
+        # Why the response can't be parsed incrementally, if it can't
+        self.error: Optional[str] = None
+        self.in_string = False
+        self.escape = False
+        self.string_is_key = False
+        self.token_start: Optional[int] = None
+        self.validators = {} if validators is None else validators
+        self.num_validated = 0
+
+    def feed(self, chunk: str):
+        """
+        :param chunk: the next part of the response
+        :raises ValidationError: if a complete value doesn't match the schema
+        """
+        if not chunk or self.done:
+            return
+
+        base = self.length
+        self.chunks.append(chunk)
+        self.offsets.append(base)
+        self.length += len(chunk)
+
+        # Only the new chunk is scanned, `pos` is relative to it
+        text = chunk
+        end = len(text)
+        pos = self.pos - base
+
+        while pos < end and not self.done:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    pos += 1
+                    continue
+                match = STRING_SPECIAL_RE.search(text, pos)
+                if match is None:
+                    pos = end
+                    break
+                pos = match.start()
+                if text[pos] == '\\':
+                    self.escape = True
+                else:
+                    self.in_string = False
+                    self.end_string(base + pos + 1)
+                pos += 1
+                continue
+
+            char = text[pos]
+            if not self.started:
+                if char in '{[':
+                    self.started = True
+                    self.open(char, base + pos)
+                pos += 1
+                continue
+
+            if char in ' \t\r\n':
+                self.end_token(base + pos)
+            elif char == '"':
+                self.end_token(base + pos)
+                self.in_string = True
+                self.string_is_key = self.stack[-1].expect_key
+                self.token_start = base + pos
+            elif char in '{[':
+                self.end_token(base + pos)
+                self.open(char, base + pos)
+            elif char in '}]':
+                self.end_token(base + pos)
+                self.close(char, base + pos)
+            elif char == ':':
+                self.end_token(base + pos)
+                self.stack[-1].expect_key = False
+            elif char == ',':
+                self.end_token(base + pos)
+                frame = self.stack[-1]
+                if frame.kind == 'object':
+                    frame.expect_key = True
+                else:
+                    frame.index += 1
+            elif self.token_start is None:
+                # number, true, false or null
+                self.token_start = base + pos
+            pos += 1
+
+        self.pos = base + pos
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.chunks)
+
+    def slice(self, start: int, end: int) -> str:
+        """
+        :return: the response from `start` to `end`, like `self.text[start:end]`
+        """
+        i = bisect_right(self.offsets, start) - 1
+        parts = []
+        while i < len(self.chunks) and self.offsets[i] < end:
+            offset = self.offsets[i]
+            parts.append(self.chunks[i][max(start - offset, 0):end - offset])
+            i += 1
+        return ''.join(parts)
+
+    def open(self, char: str, pos: int):
+        path = self.value_path() if self.stack else []
+        self.stack.append(Frame('object' if char == '{' else 'array', pos, path))
+
+    def close(self, char: str, pos: int):
+        frame = self.stack.pop()
+        if frame.kind != CLOSING[char]:
+            # Stop here and leave it to the final parse, eg. `repair_json()` closes a missing `]`
+            self.error = f'Unexpected `{char}` in {frame.kind} at {pos}'
+            logger.info(f'Stopped parsing the streamed JSON: {self.error}')
+            self.done = True
+            return
+        if frame.path:
+            self.complete(frame.path, self.slice(frame.start, pos + 1))
+        if not self.stack:
+            self.done = True
+
+    def end_string(self, end: int):
+        value = self.slice(self.token_start, end)
+        self.token_start = None
+        if self.string_is_key:
+            try:
+                self.stack[-1].key = json.loads(value)
+            except json.JSONDecodeError:
+                self.stack[-1].key = value[1:-1]
+        else:
+            self.complete(self.value_path(), value)
+
+    def end_token(self, end: int):
+        """End a number or literal value"""
+        if self.token_start is None:
+            return
+        value = self.slice(self.token_start, end)
+        self.token_start = None
+        self.complete(self.value_path(), value)
+
+    def value_path(self) -> list[Union[str, int]]:
+        frame = self.stack[-1]
+        return frame.path + [frame.key if frame.kind == 'object' else frame.index]
+
+    def subschema(self, path: list[Union[str, int]]) -> Optional[dict]:
+        schema = self.schema
+        for key in path:
+            if not isinstance(schema, dict) or '$ref' in schema:
+                return None
+            if isinstance(key, int):
+                schema = schema.get('items')
+            else:
+                schema = schema.get('properties', {}).get(key)
+        if not isinstance(schema, dict) or '$ref' in schema:
+            return None
+        return schema
+
+    def complete(self, path: list[Union[str, int]], value_text: str):
+        """Validate a complete value against its part of the schema"""
+        if not path or self.schema is None:
+            # The complete response is validated by `assert_json_schema()`
+            return
+
+        schema = self.subschema(path)
+        if not schema:
+            return
+
+        if value_text in ('True', 'False'):
+            # See `clean_json_response()`
+            value_text = value_text.lower()
+        try:
+            value = json.loads(value_text)
+        except json.JSONDecodeError:
+            # Let the final parse report (or heal) it
+            return
+
+        validator = self.validators.get(id(schema))
+        if validator is None:
+            validator = self.validators[id(schema)] = validator_for(self.schema)(schema)
+
+        self.num_validated += 1
+        error = next(validator.iter_errors(value), None)
+        if error is not None:
+            error.path.extendleft(reversed(path))
+            logger.warning(f'Invalid JSON streamed from LLM at {error.json_path}, aborting: {error.message}')
+            raise error
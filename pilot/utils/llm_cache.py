@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import time
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+
+from .settings import config_path
+
+log = getLogger(__name__)
+
+
+class LLMCache:
+    """
+    Content-addressed on-disk cache of LLM responses.
+
+    Responses are keyed on a digest of the model, endpoint, messages and
+    function-call definitions of a request, so re-running the same prompts
+    (e2e tests, re-planning after `load_branch`, re-driving a project from a
+    known state) doesn't pay the full LLM latency and cost again.
+
+    This class is a singleton, use the `llm_cache` global variable to access it:
+
+    >>> from utils.llm_cache import llm_cache
+
+    To look up or store a response:
+
+    >>> key = llm_cache.key(model, endpoint, messages, function_calls)
+    >>> llm_cache.get(key)
+    >>> llm_cache.put(key, {'text': 'DONE'})
+
+    The cache is disabled by default, enable it with `LLM_CACHE=true`.
+    Other settings (environment variables):
+    * LLM_CACHE_DIR - where to store the responses (default: `llm_cache` in the config directory)
+    * LLM_CACHE_MAX_SIZE_MB - least recently used entries are evicted above this size (default: 256)
+    * LLM_CACHE_TTL - entries older than this many seconds are ignored (default: no expiry)
+
+    Note: only complete, successful responses should be stored.
+    """
+
+    def __init__(self, enabled: bool = False, cache_dir: Optional[str] = None, max_size: int = 256 * 1024 * 1024,
+                 ttl: Optional[float] = None):
+        self.enabled = enabled
+        self.cache_dir = Path(cache_dir) if cache_dir else config_path.parent / 'llm_cache'
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.size = None
+        self.lock = Lock()
+
+    @classmethod
+    def from_env(cls) -> 'LLMCache':
+        ttl = os.getenv('LLM_CACHE_TTL')
+        return cls(
+            enabled=os.getenv('LLM_CACHE', 'false').lower() == 'true',
+            cache_dir=os.getenv('LLM_CACHE_DIR'),
+            max_size=int(float(os.getenv('LLM_CACHE_MAX_SIZE_MB', 256)) * 1024 * 1024),
+            ttl=float(ttl) if ttl else None,
+        )
+
+    @staticmethod
+    def key(model: str, endpoint: str, messages: list[dict], function_calls: Optional[dict] = None) -> str:
+        """
+        Compute the cache key for a request.
+
+        :param model: model name
+        :param endpoint: endpoint name and URL
+        :param messages: [{ "role": "system"|"assistant"|"user", "content": string }, ... ]
+        :param function_calls: (optional) {'definitions': [{ 'name': str }, ...]}
+        :return: hex digest identifying the request
+        """
+        request = {
+            'model': model,
+            'endpoint': endpoint,
+            'messages': messages,
+            'functions': function_calls['definitions'] if function_calls else None,
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}.json'
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Look up a cached response.
+
+        :param key: cache key, see `LLMCache.key()`
+        :return: the cached response, or None on a miss
+        """
+        path = self.path(key)
+        try:
+            stat = path.stat()
+            if self.ttl is not None and time.time() - stat.st_mtime > self.ttl:
+                self._remove(path, stat.st_size)
+                raise FileNotFoundError(path)
+
+            with open(path, 'r', encoding='utf-8') as fp:
+                response = json.load(fp)['response']
+
+            # Touch the file so the least recently used entries get evicted first
+            os.utime(path, (time.time(), stat.st_mtime))
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            log.debug(f'LLM cache miss: {key}')
+            return None
+
+        self.hits += 1
+        log.debug(f'LLM cache hit: {key}')
+        return response
+
+    def put(self, key: str, response: dict):
+        """
+        Store a response in the cache, evicting old entries if needed.
+
+        :param key: cache key, see `LLMCache.key()`
+        :param response: complete LLM response, eg. {'text': str}
+        """
+        data = json.dumps({'created_at': time.time(), 'response': response}).encode('utf-8')
+        path = self.path(key)
+
+        with self.lock:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                self._ensure_size()
+                tmp_path = path.with_suffix('.tmp')
+                with open(tmp_path, 'wb') as fp:
+                    fp.write(data)
+                # The entry may be replaced, eg. by another process sending the same request
+                try:
+                    old_size = path.stat().st_size
+                except FileNotFoundError:
+                    old_size = 0
+                os.replace(tmp_path, path)
+            except OSError as err:
+                log.warning(f'Unable to store LLM response in cache: {err}')
+                return
+
+            self.size += len(data) - old_size
+            if self.size > self.max_size:
+                self._evict()
+
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self.lock:
+            for path in self._entries():
+                self._remove(path, 0)
+            self.size = 0
+
+    def _entries(self) -> list[Path]:
+        if not self.cache_dir.is_dir():
+            return []
+        return list(self.cache_dir.glob('*.json'))
+
+    def _ensure_size(self):
+        if self.size is None:
+            self.size = sum(path.stat().st_size for path in self._entries())
+
+    def _evict(self):
+        # Evict least recently used (by access time) entries until we're under 90% of the limit
+        entries = sorted(((path.stat(), path) for path in self._entries()), key=lambda entry: entry[0].st_atime)
+        for stat, path in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            self._remove(path, stat.st_size)
+
+    def _remove(self, path: Path, size: int):
+        try:
+            path.unlink()
+        except OSError:
+            return
+        if self.size is not None:
+            self.size -= size
+
+
+llm_cache = LLMCache.from_env()
@@ -1,58 +1,67 @@
+import asyncio
+import functools
 import re
-import requests
 import os
 import sys
 import time
 import json
-import tiktoken
 from prompt_toolkit.styles import Style
 
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from utils.style import color_red
-from typing import List
-from const.llm import MAX_GPT_MODEL_TOKENS
+from typing import List, Optional
+from const.llm import LLM_FAILOVER_RETRIES, MAX_GPT_MODEL_TOKENS, MIN_TOKENS_FOR_GPT_RESPONSE
 from const.messages import AFFIRMATIVE_ANSWERS
 from logger.logger import logger, logging
-from helpers.exceptions import TokenLimitError, ApiKeyNotDefinedError
+from helpers.exceptions import TokenLimitError
 from utils.utils import fix_json, get_prompt
-from utils.function_calling import add_function_calls_to_request, FunctionCallSet, FunctionType
+from utils.function_calling import add_function_calls_to_request, schema_registry, FunctionCallSet, FunctionType
 from utils.questionary import styled_text
 
+from .llm_cache import llm_cache
+from .llm_metrics import llm_metrics, RequestMetrics
+from .llm_endpoints import get_endpoint_url, get_endpoints, open_stream, EndpointError, StreamStalledError, \
+    KEEP_ALIVE_LINE
+from .llm_rate_limiter import rate_limiter
+from .llm_response import LLMResponse
+from .llm_routing import llm_router, DEFAULT_ROUTE
+from .stream_output import StreamPrinter
 from .telemetry import telemetry
+from .json_repair import repair_json, json_repair_stats
+from .json_stream import StreamingJsonParser
+from .token_counter import token_counter, get_context_window
 
 def get_tokens_in_messages(messages: List[str]) -> int:
-    tokenizer = tiktoken.get_encoding("cl100k_base")  # GPT-4 tokenizer
-    tokenized_messages = [tokenizer.encode(message['content']) for message in messages]
-    return sum(len(tokens) for tokens in tokenized_messages)
+    return sum(token_counter.count(message['content']) for message in messages)
 
 
 def num_tokens_from_functions(functions):
     """Return the number of tokens used by a list of functions."""
-    encoding = tiktoken.get_encoding("cl100k_base")
+    count = token_counter.count
 
     num_tokens = 0
     for function in functions:
-        function_tokens = len(encoding.encode(function['name']))
-        function_tokens += len(encoding.encode(function['description']))
+        function_tokens = count(function['name'])
+        function_tokens += count(function['description'])
 
         if 'parameters' in function:
             parameters = function['parameters']
             if 'properties' in parameters:
                 for propertiesKey in parameters['properties']:
-                    function_tokens += len(encoding.encode(propertiesKey))
+                    function_tokens += count(propertiesKey)
                     v = parameters['properties'][propertiesKey]
                     for field in v:
                         if field == 'type':
                             function_tokens += 2
-                            function_tokens += len(encoding.encode(v['type']))
+                            function_tokens += count(v['type'])
                         elif field == 'description':
                             function_tokens += 2
-                            function_tokens += len(encoding.encode(v['description']))
+                            function_tokens += count(v['description'])
                         elif field == 'enum':
                             function_tokens -= 3
                             for o in v['enum']:
                                 function_tokens += 3
-                                function_tokens += len(encoding.encode(o))
+                                function_tokens += count(o)
                 function_tokens += 11
 
         num_tokens += function_tokens
@@ -61,8 +70,32 @@ def num_tokens_from_functions(functions):
     return num_tokens
 
 
+def assert_messages_fit(messages: List[dict], model: Optional[str] = None) -> int:
+    """
+    Pre-flight check that a request leaves enough room for the response, so we don't wait
+    for the API to reject it with `context_length_exceeded`.
+    :param messages: [{ "role": "system"|"assistant"|"user", "content": string }, ... ]
+    :param model: (optional) the model the request is sent to, see `get_context_window()`
+    :return: number of tokens in the messages
+    :raises TokenLimitError: if the messages don't fit in the context window of the model
+    """
+    num_tokens = token_counter.count_messages(messages)
+    context_window = get_context_window(model)
+    if context_window is None:
+        # Unknown model, the API tells if the request is too long
+        return num_tokens
+
+    if num_tokens + MIN_TOKENS_FOR_GPT_RESPONSE > context_window:
+        logger.warning(f'Request with {num_tokens} tokens does not leave {MIN_TOKENS_FOR_GPT_RESPONSE} tokens '
+                       f'for the response (context window of {model}: {context_window}), not sending it')
+        raise TokenLimitError(num_tokens, context_window)
+    return num_tokens
+
+
 def create_gpt_chat_completion(messages: List[dict], req_type, project,
-                               function_calls: FunctionCallSet = None):
+                               function_calls: FunctionCallSet = None, use_cache: bool = True,
+                               prompt_path: Optional[str] = None, stable_prefix_tokens: Optional[int] = None,
+                               metrics: Optional[RequestMetrics] = None):
     """
     Called from:
       - AgentConvo.send_message() - these calls often have `function_calls`, usually from `pilot/const/function_calls.py`
@@ -70,52 +103,123 @@ def create_gpt_chat_completion(messages: List[dict], req_type, project,
       - prompts.get_additional_info_from_openai()
       - prompts.get_additional_info_from_user() after the user responds to each
             "Please check this message and say what needs to be changed... {message}"
+
+    Blocking wrapper around `acreate_gpt_chat_completion()`, must not be called from a running event loop.
     :param messages: [{ "role": "system"|"assistant"|"user", "content": string }, ... ]
     :param req_type: 'project_description' etc. See common.STEPS
     :param project: project
     :param function_calls: (optional) {'definitions': [{ 'name': str }, ...]}
         see `IMPLEMENT_CHANGES` etc. in `pilot/const/function_calls.py`
+    :param use_cache: (optional) set to False to bypass the LLM response cache (see `utils/llm_cache.py`)
+    :param prompt_path: (optional) the prompt the last message was made from, to tag the request metrics with
+    :param stable_prefix_tokens: (optional) tokens at the start of `messages` which are unchanged since the
+        previous request of the conversation, see `AgentConvo.get_stable_prefix_tokens()`
+    :param metrics: (optional) to measure the request with, eg. to save its token usage with the development step
     :return: {'text': new_code}
         or if `function_calls` param provided
              {'function_calls': {'name': str, arguments: {...}}}
     """
+    return asyncio.run(acreate_gpt_chat_completion(messages, req_type, project, function_calls, use_cache,
+                                                   prompt_path, stable_prefix_tokens, metrics))
+
+
+async def acreate_gpt_chat_completion(messages: List[dict], req_type, project,
+                                      function_calls: FunctionCallSet = None, use_cache: bool = True,
+                                      prompt_path: Optional[str] = None, stable_prefix_tokens: Optional[int] = None,
+                                      metrics: Optional[RequestMetrics] = None, stream_output: bool = True,
+                                      interactive_retry: bool = True):
+    """
+    Awaitable version of `create_gpt_chat_completion()`.
+
+    Every call works on its own copy of `messages` and keeps its retry state in its own request data,
+    so several requests can be in flight at once, eg:
+
+    >>> responses = await asyncio.gather(
+    ...     acreate_gpt_chat_completion(messages_a, 'coding', project),
+    ...     acreate_gpt_chat_completion(messages_b, 'coding', project))
+
+    :param messages: [{ "role": "system"|"assistant"|"user", "content": string }, ... ]
+    :param req_type: 'project_description' etc. See common.STEPS
+    :param project: project
+    :param function_calls: (optional) {'definitions': [{ 'name': str }, ...]}
+    :param use_cache: (optional) set to False to bypass the LLM response cache (see `utils/llm_cache.py`)
+    :param prompt_path: (optional) the prompt the last message was made from, to tag the request metrics with
+    :param stable_prefix_tokens: (optional) tokens at the start of `messages` unchanged since the previous request
+    :param metrics: (optional) to measure the request with
+    :param stream_output: (optional) set to False to not print the response while it's streamed, eg. when
+        several responses are streamed at once, see `AgentConvo.fork_join()`
+    :param interactive_retry: (optional) set to False to raise the error instead of asking the user whether to
+        retry a failed request, eg. when several requests are sent at once
+    :return: {'text': new_code}
+    """
+
+    # Small classification prompts may go to a faster model, see `utils/llm_routing.py`
+    route = llm_router.route(req_type, prompt_path)
+    if route is not DEFAULT_ROUTE:
+        logger.info(f'Routing {req_type} request ({prompt_path}) to {route}')
+    messages = route.trim(list(messages))
 
     gpt_data = {
-        'model': os.getenv('MODEL_NAME', 'gpt-4'),
+        'model': route.get_model(),
         'n': 1,
         'temperature': 1,
         'top_p': 1,
         'presence_penalty': 0,
         'frequency_penalty': 0,
-        'messages': messages,
+        # The JSON schema and any retry messages are only added to this request's copy
+        'messages': list(messages),
         'stream': True
     }
-
-    # delete some keys if using "OpenRouter" API
-    if os.getenv('ENDPOINT') == 'OPENROUTER':
-        keys_to_delete = ['n', 'max_tokens', 'temperature', 'top_p', 'presence_penalty', 'frequency_penalty']
-        for key in keys_to_delete:
-            if key in gpt_data:
-                del gpt_data[key]
+    if route.max_tokens:
+        gpt_data['max_tokens'] = route.max_tokens
+    if route.endpoint:
+        gpt_data['endpoints'] = route.endpoint
+    if not stream_output:
+        gpt_data['stream_output'] = False
+    if not interactive_retry:
+        gpt_data['interactive_retry'] = False
+
+    cache_key = None
+    if use_cache and llm_cache.enabled:
+        endpoint = route.endpoint or os.getenv('ENDPOINT')
+        cache_key = llm_cache.key(gpt_data['model'], f'{endpoint} {get_endpoint_url(endpoint, gpt_data["model"])}',
+                                  messages, function_calls)
+        response = llm_cache.get(cache_key)
+        if response is not None:
+            logger.info(f'Using cached LLM response for {req_type}')
+            return response
 
     # Advise the LLM of the JSON response schema we are expecting
-    messages_length = len(messages)
     add_function_calls_to_request(gpt_data, function_calls)
-
+    num_tokens = assert_messages_fit(gpt_data['messages'], gpt_data['model'])
+
+    metrics = gpt_data['metrics'] = metrics or RequestMetrics(req_type, prompt_path, gpt_data['model'])
+    metrics.model = gpt_data['model']
+    metrics.route = route.name
+    metrics.prompt_tokens = num_tokens
+    # A trimmed context no longer starts with the prefix sent before
+    metrics.stable_prefix_tokens = stable_prefix_tokens if route.context is None else None
     try:
-        response = stream_gpt_completion(gpt_data, req_type, project)
+        response = await astream_gpt_completion(gpt_data, req_type, project)
+        metrics.finish()
 
-        # Remove JSON schema and any added retry messages
-        while len(messages) > messages_length:
-            messages.pop()
+        # Only cache complete responses: a validated JSON response or a text response which finished normally
+        if cache_key is not None and response and (function_calls or gpt_data.get('finish_reason') == 'stop'):
+            llm_cache.put(cache_key, response)
         return response
     except TokenLimitError as e:
+        metrics.finish(e)
         raise e
     except Exception as e:
+        metrics.finish(e)
         logger.error(f'The request to {os.getenv("ENDPOINT")} API failed: %s', e)
+        if not interactive_retry:
+            raise
         print(f'The request to {os.getenv("ENDPOINT")} API failed. Here is the error message:')
         print(e)
         return {}   # https://github.com/Pythagora-io/gpt-pilot/issues/130 - may need to revisit how we handle this
+    finally:
+        llm_metrics.record(metrics)
 
 
 def delete_last_n_lines(n):
@@ -150,115 +254,204 @@ def get_tokens_in_messages_from_openai_error(error_message):
         return None
 
 
-def retry_on_exception(func):
-    def update_error_count(args):
-        function_error_count = 1 if 'function_error' not in args[0] else args[0]['function_error_count'] + 1
-        args[0]['function_error_count'] = function_error_count
+class RetryState:
+    """
+    Decides how to recover from the errors of a single LLM request.
+
+    The state sent back to the LLM (`function_error`, `function_buffer` and `function_error_count`) lives in
+    the request data, which is created for every request, so concurrent requests never share it.
+    """
+
+    def __init__(self, data: dict, project):
+        self.data = data
+        self.project = project
+        self.wait_duration_ms = None
+        self.num_failovers = 0
+        self.num_stalls = 0
+
+    def update_error_count(self) -> int:
+        function_error_count = 1 if 'function_error' not in self.data else self.data['function_error_count'] + 1
+        self.data['function_error_count'] = function_error_count
         return function_error_count
 
-    def set_function_error(args, err_str: str):
+    def set_function_error(self, err_str: str):
         logger.info(err_str)
 
-        args[0]['function_error'] = err_str
-        if 'function_buffer' in args[0]:
-            del args[0]['function_buffer']
+        self.data['function_error'] = err_str
+        if 'function_buffer' in self.data:
+            del self.data['function_buffer']
+
+    def handle(self, e: Exception) -> Optional[float]:
+        """
+        :param e: the exception raised by the request
+        :return: seconds to wait before retrying (0 to retry immediately), or None if the user should be asked
+        :raises TokenLimitError: if the context length was exceeded
+        """
+        # Convert exception to string
+        err_str = str(e)
+        if 'metrics' in self.data:
+            self.data['metrics'].attempt_errors.append(type(e).__name__)
+
+        if isinstance(e, json.JSONDecodeError):
+            # codellama-34b-instruct seems to send incomplete JSON responses.
+            # We ask for the rest of the JSON object for the following errors:
+            # - 'Expecting value' (error if `e.pos` not at the end of the doc: True instead of true)
+            # - "Expecting ':' delimiter"
+            # - 'Expecting property name enclosed in double quotes'
+            # - 'Unterminated string starting at'
+            if e.msg.startswith('Expecting') or e.msg == 'Unterminated string starting at':
+                if e.msg == 'Expecting value' and len(e.doc) > e.pos:
+                    # Note: clean_json_response() should heal True/False boolean values
+                    err_str = re.split(r'[},\\n]', e.doc[e.pos:])[0]
+                    err_str = f'Invalid value: `{err_str}`'
+                else:
+                    # if e.msg == 'Unterminated string starting at' or len(e.doc) == e.pos:
+                    logger.info('Received incomplete JSON response from LLM. Asking for the rest...')
+                    self.data['function_buffer'] = e.doc
+                    if 'function_error' in self.data:
+                        del self.data['function_error']
+                    json_repair_stats.add_retry()
+                    return 0
+
+            # TODO: (if it ever comes up) e.msg == 'Extra data' -> trim the response
+            # 'Invalid control character at', 'Invalid \\escape', 'Invalid control character',
+            # or `Expecting value` with `pos` before the end of `e.doc`
+            function_error_count = self.update_error_count()
+            logger.warning('Received invalid character in JSON response from LLM. Asking to retry...')
+            logger.info(f'  received: {e.doc}')
+            self.set_function_error(err_str)
+            if function_error_count < 3:
+                json_repair_stats.add_retry()
+                return 0
+        elif isinstance(e, ValidationError):
+            function_error_count = self.update_error_count()
+            logger.warning('Received invalid JSON response from LLM. Asking to retry...')
+            # eg:
+            # json_path: '$.type'
+            # message:   "'command' is not one of ['automated_test', 'command_test', 'manual_test', 'no_test']"
+            self.set_function_error(f'at {e.json_path} - {e.message}')
+            # Attempt retry if the JSON schema is invalid, but avoid getting stuck in a loop
+            if function_error_count < 3:
+                json_repair_stats.add_retry()
+                return 0
+        if "context_length_exceeded" in err_str:
+            # If the specific error "context_length_exceeded" is present, simply return without retry
+            raise TokenLimitError(get_tokens_in_messages_from_openai_error(err_str), MAX_GPT_MODEL_TOKENS)
+        if "rate_limit_exceeded" in err_str:
+            # Extracting the duration from the error string
+            match = re.search(r"Please try again in (\d+)ms.", err_str)
+            if not match:
+                return 0
+            if self.wait_duration_ms is None:
+                self.wait_duration_ms = int(match.group(1))
+            elif self.wait_duration_ms < 6000:
+                # waiting 6ms isn't usually long enough - exponential back-off until about 6 seconds
+                self.wait_duration_ms *= 2
+            logger.debug(f'Rate limited. Waiting {self.wait_duration_ms}ms...')
+            # Jitter, so requests limited at the same time don't all retry together
+            return rate_limiter.jitter(self.wait_duration_ms / 1000)
+        if isinstance(e, StreamStalledError) and self.num_stalls < LLM_FAILOVER_RETRIES:
+            self.num_stalls += 1
+            if e.function_buffer:
+                logger.warning(f'{err_str}. Asking for the rest of the JSON response...')
+                self.data['function_buffer'] = e.function_buffer
+                if 'function_error' in self.data:
+                    del self.data['function_error']
+            else:
+                logger.warning(f'{err_str}. Retrying...')
+            return 0
+        if isinstance(e, EndpointError) and e.failover and self.num_failovers < LLM_FAILOVER_RETRIES:
+            # Every endpoint had a server or connection error, back off before trying them all again
+            self.num_failovers += 1
+            wait = rate_limiter.jitter(2 ** self.num_failovers)
+            logger.warning(f'{err_str}. Retrying in {wait:.1f}s...')
+            return wait
+
+        print(color_red('There was a problem with request to openai API:'))
+        print(err_str)
+        logger.error(f'There was a problem with request to openai API: {err_str}')
+        return None
+
+    def ask_to_retry(self) -> bool:
+        """
+        :return: True if the user wants to make the same request again
+        """
+        print('yes/no', type='button')
+        user_message = styled_text(
+            self.project,
+            'Do you want to try make the same request again? If yes, just press ENTER. Otherwise, type "no".',
+            style=Style.from_dict({
+                'question': '#FF0000 bold',
+                'answer': '#FF910A bold'
+            })
+        )
+
+        # TODO: take user's input into consideration - send to LLM?
+        # https://github.com/Pythagora-io/gpt-pilot/issues/122
+        return user_message.lower() in AFFIRMATIVE_ANSWERS
+
 
+def retry_on_exception(func):
+    """
+    Retry `func(data, req_type, project)` on invalid JSON responses, rate limiting and API errors.
+
+    Works for both regular and `async` functions. Async functions wait with `asyncio.sleep()` and ask
+    the user in a worker thread, so other requests on the event loop keep streaming in the meantime,
+    or raise the error if the request data has `interactive_retry` set to False.
+    """
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            retry = RetryState(args[0], args[2])
+
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    wait = retry.handle(e)
+                    if wait is None:
+                        if not retry.data.get('interactive_retry', True):
+                            raise
+                        if not await asyncio.to_thread(retry.ask_to_retry):
+                            return {}
+                    elif wait:
+                        await asyncio.sleep(wait)
+
+        return async_wrapper
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        wait_duration_ms = None
+        retry = RetryState(args[0], args[2])
 
         while True:
             try:
-                # spinner_stop(spinner)
                 return func(*args, **kwargs)
             except Exception as e:
-                # Convert exception to string
-                err_str = str(e)
-
-                if isinstance(e, json.JSONDecodeError):
-                    # codellama-34b-instruct seems to send incomplete JSON responses.
-                    # We ask for the rest of the JSON object for the following errors:
-                    # - 'Expecting value' (error if `e.pos` not at the end of the doc: True instead of true)
-                    # - "Expecting ':' delimiter"
-                    # - 'Expecting property name enclosed in double quotes'
-                    # - 'Unterminated string starting at'
-                    if e.msg.startswith('Expecting') or e.msg == 'Unterminated string starting at':
-                        if e.msg == 'Expecting value' and len(e.doc) > e.pos:
-                            # Note: clean_json_response() should heal True/False boolean values
-                            err_str = re.split(r'[},\\n]', e.doc[e.pos:])[0]
-                            err_str = f'Invalid value: `{err_str}`'
-                        else:
-                            # if e.msg == 'Unterminated string starting at' or len(e.doc) == e.pos:
-                            logger.info('Received incomplete JSON response from LLM. Asking for the rest...')
-                            args[0]['function_buffer'] = e.doc
-                            if 'function_error' in args[0]:
-                                del args[0]['function_error']
-                            continue
-
-                    # TODO: (if it ever comes up) e.msg == 'Extra data' -> trim the response
-                    # 'Invalid control character at', 'Invalid \\escape', 'Invalid control character',
-                    # or `Expecting value` with `pos` before the end of `e.doc`
-                    function_error_count = update_error_count(args)
-                    logger.warning('Received invalid character in JSON response from LLM. Asking to retry...')
-                    logger.info(f'  received: {e.doc}')
-                    set_function_error(args, err_str)
-                    if function_error_count < 3:
-                        continue
-                elif isinstance(e, ValidationError):
-                    function_error_count = update_error_count(args)
-                    logger.warning('Received invalid JSON response from LLM. Asking to retry...')
-                    # eg:
-                    # json_path: '$.type'
-                    # message:   "'command' is not one of ['automated_test', 'command_test', 'manual_test', 'no_test']"
-                    set_function_error(args, f'at {e.json_path} - {e.message}')
-                    # Attempt retry if the JSON schema is invalid, but avoid getting stuck in a loop
-                    if function_error_count < 3:
-                        continue
-                if "context_length_exceeded" in err_str:
-                    # If the specific error "context_length_exceeded" is present, simply return without retry
-                    # spinner_stop(spinner)
-                    raise TokenLimitError(get_tokens_in_messages_from_openai_error(err_str), MAX_GPT_MODEL_TOKENS)
-                if "rate_limit_exceeded" in err_str:
-                    # Extracting the duration from the error string
-                    match = re.search(r"Please try again in (\d+)ms.", err_str)
-                    if match:
-                        # spinner = spinner_start(colored("Rate limited. Waiting...", 'yellow'))
-                        if wait_duration_ms is None:
-                            wait_duration_ms = int(match.group(1))
-                        elif wait_duration_ms < 6000:
-                            # waiting 6ms isn't usually long enough - exponential back-off until about 6 seconds
-                            wait_duration_ms *= 2
-                        logger.debug(f'Rate limited. Waiting {wait_duration_ms}ms...')
-                        time.sleep(wait_duration_ms / 1000)
-                    continue
-
-                print(color_red('There was a problem with request to openai API:'))
-                # spinner_stop(spinner)
-                print(err_str)
-                logger.error(f'There was a problem with request to openai API: {err_str}')
-
-                project = args[2]
-                print('yes/no', type='button')
-                user_message = styled_text(
-                    project,
-                    'Do you want to try make the same request again? If yes, just press ENTER. Otherwise, type "no".',
-                    style=Style.from_dict({
-                        'question': '#FF0000 bold',
-                        'answer': '#FF910A bold'
-                    })
-                )
-
-                # TODO: take user's input into consideration - send to LLM?
-                # https://github.com/Pythagora-io/gpt-pilot/issues/122
-                if user_message.lower() not in AFFIRMATIVE_ANSWERS:
-                    return {}
+                wait = retry.handle(e)
+                if wait is None:
+                    if not retry.ask_to_retry():
+                        return {}
+                elif wait:
+                    time.sleep(wait)
 
     return wrapper
 
 
-@retry_on_exception
 def stream_gpt_completion(data, req_type, project):
     """
-    Called from create_gpt_chat_completion()
+    Blocking wrapper around `astream_gpt_completion()`.
+    :param data:
+    :param req_type: 'project_description' etc. See common.STEPS
+    :param project: NEEDED FOR WRAPPER FUNCTION retry_on_exception
+    :return: {'text': str} or {'function_calls': {'name': str, arguments: '{...}'}}
+    """
+    return asyncio.run(astream_gpt_completion(data, req_type, project))
+
+
+@retry_on_exception
+async def astream_gpt_completion(data, req_type, project):
+    """
+    Called from acreate_gpt_chat_completion()
     :param data:
     :param req_type: 'project_description' etc. See common.STEPS
     :param project: NEEDED FOR WRAPPER FUNCTION retry_on_exception
@@ -270,25 +463,46 @@ def stream_gpt_completion(data, req_type, project):
     except OSError:
         terminal_width = 50
     lines_printed = 2
+    request_data = data
+    finish_reason = None
     gpt_response = ''
     buffer = ''  # A buffer to accumulate incoming data
     expecting_json = None
     received_json = False
+    json_parser = None
 
     if 'functions' in data:
         expecting_json = data['functions']
+        # Validate the JSON while it's streamed, to stop as soon as the response can't be valid
+        compiled = schema_registry.get(expecting_json)
+        json_parser = StreamingJsonParser(compiled.schema, compiled.subschema_validators)
         if 'function_buffer' in data:
             incomplete_json = get_prompt('utils/incomplete_json.prompt', {'received_json': data['function_buffer']})
             data['messages'].append({'role': 'user', 'content': incomplete_json})
             gpt_response = data['function_buffer']
+            json_parser.feed(gpt_response)
             received_json = True
         elif 'function_error' in data:
             invalid_json = get_prompt('utils/invalid_json.prompt', {'invalid_reason': data['function_error']})
             data['messages'].append({'role': 'user', 'content': invalid_json})
             received_json = True
 
-        # Don't send the `functions` parameter to Open AI, but don't remove it from `data` in case we need to retry
-        data = {key: value for key, value in data.items() if not key.startswith('function')}
+    # Measured across retries, see `acreate_gpt_chat_completion()`
+    metrics = data.get('metrics') or RequestMetrics(req_type, None, data.get('model'))
+    metrics.start_attempt()
+    # Configure for the selected ENDPOINT, or the LLM_ENDPOINTS (or routed endpoints) to hedge and fail over between
+    endpoints = get_endpoints(data.get('endpoints'), data.get('model'))
+
+    # Don't send the `functions` parameter or the request state to Open AI,
+    # but don't remove them from `data` in case we need to retry
+    continuing_json = 'function_buffer' in data
+    data = {key: value for key, value in data.items()
+            if not key.startswith('function') and key not in ('finish_reason', 'metrics', 'endpoints', 'stream_output',
+                                                           'interactive_retry')}
+    if continuing_json:
+        # The rest of the JSON is requested as text, a new tool call would start the JSON from scratch
+        data.pop('tools', None)
+        data.pop('tool_choice', None)
 
     def return_result(result_data, lines_printed):
         if buffer:
@@ -301,9 +515,7 @@ def stream_gpt_completion(data, req_type, project):
     # spinner = spinner_start(yellow("Waiting for OpenAI API response..."))
     # print(yellow("Stream response from OpenAI:"))
 
-    # Configure for the selected ENDPOINT
-    model = os.getenv('MODEL_NAME', 'gpt-4')
-    endpoint = os.getenv('ENDPOINT')
+    model = endpoints[0].model
 
     # This will be set many times but we don't care, as there are no side-effects to it.
     telemetry.set("model", model)
@@ -313,109 +525,130 @@ def stream_gpt_completion(data, req_type, project):
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug('\n'.join([f"{message['role']}: {message['content']}" for message in data['messages']]))
 
-    if endpoint == 'AZURE':
-        # If yes, get the AZURE_ENDPOINT from .ENV file
-        endpoint_url = os.getenv('AZURE_ENDPOINT') + '/openai/deployments/' + model + '/chat/completions?api-version=2023-05-15'
-        headers = {
-            'Content-Type': 'application/json',
-            'api-key': get_api_key_or_throw('AZURE_API_KEY')
-        }
-    elif endpoint == 'OPENROUTER':
-        # If so, send the request to the OpenRouter API endpoint
-        endpoint_url = os.getenv('OPENROUTER_ENDPOINT', 'https://openrouter.ai/api/v1/chat/completions')
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + get_api_key_or_throw('OPENROUTER_API_KEY'),
-            'HTTP-Referer': 'https://github.com/Pythagora-io/gpt-pilot',
-            'X-Title': 'GPT Pilot'
-        }
-        data['max_tokens'] = MAX_GPT_MODEL_TOKENS
-        data['model'] = model
-    else:
-        # If not, send the request to the OpenAI endpoint
-        endpoint_url = os.getenv('OPENAI_ENDPOINT', 'https://api.openai.com/v1/chat/completions')
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + get_api_key_or_throw('OPENAI_API_KEY')
-        }
-        data['model'] = model
-
-    response = requests.post(
-        endpoint_url,
-        headers=headers,
-        json=data,
-        stream=True
-    )
-
-    if response.status_code != 200:
-        project.dot_pilot_gpt.log_chat_completion(endpoint, model, req_type, data['messages'], response.text)
-        logger.info(f'problem with request (status {response.status_code}): {response.text}')
-        raise Exception(f"API responded with status code: {response.status_code}. Response text: {response.text}")
+    attempt_started_at = time.monotonic()
+    prompt_tokens = token_counter.count_messages(data['messages'])
+    try:
+        stream = await open_stream(endpoints, data, prompt_tokens + MIN_TOKENS_FOR_GPT_RESPONSE)
+    except EndpointError as e:
+        if e.response_text is not None:
+            project.dot_pilot_gpt.log_chat_completion(e.endpoint.name, e.endpoint.model, req_type, data['messages'],
+                                                      e.response_text)
+        raise
+    endpoint = stream.endpoint.name
+    model = stream.endpoint.model
+    metrics.endpoint = endpoint
+    metrics.model = model
+    metrics.connect_time = stream.connected_at - stream.sent_at
+    metrics.ttft = stream.first_token_at - attempt_started_at
+    response_start = len(gpt_response)
+    usage = None
 
     # function_calls = {'name': '', 'arguments': ''}
 
-    for line in response.iter_lines():
-        # Ignore keep-alive new lines
-        if line and line != b': OPENROUTER PROCESSING':
-            line = line.decode("utf-8")  # decode the bytes to string
+    stream_printer = StreamPrinter() if request_data.get('stream_output', True) else None
+    try:
+        async for line in stream:
+            # Ignore keep-alive new lines
+            if line and line != KEEP_ALIVE_LINE:
+                line = line.decode("utf-8")  # decode the bytes to string
 
-            if line.startswith('data: '):
-                line = line[6:]  # remove the 'data: ' prefix
+                if line.startswith('data: '):
+                    line = line[6:]  # remove the 'data: ' prefix
 
-            # Check if the line is "[DONE]" before trying to parse it as JSON
-            if line == "[DONE]":
-                continue
+                # Check if the line is "[DONE]" before trying to parse it as JSON
+                if line == "[DONE]":
+                    continue
 
-            try:
-                json_line = json.loads(line)
+                try:
+                    json_line = json.loads(line)
 
-                if len(json_line['choices']) == 0:
-                    continue
+                    if json_line.get('usage'):
+                        # Only sent by some providers, see `Endpoint.request_data()`
+                        usage = json_line['usage']
+                        metrics.cached_tokens = (usage.get('prompt_tokens_details') or {}).get(
+                            'cached_tokens', metrics.cached_tokens)
 
-                if 'error' in json_line:
-                    logger.error(f'Error in LLM response: {json_line}')
-                    raise ValueError(f'Error in LLM response: {json_line["error"]["message"]}')
+                    if len(json_line['choices']) == 0:
+                        continue
 
-                choice = json_line['choices'][0]
+                    if 'error' in json_line:
+                        logger.error(f'Error in LLM response: {json_line}')
+                        raise ValueError(f'Error in LLM response: {json_line["error"]["message"]}')
 
-                # if 'finish_reason' in choice and choice['finish_reason'] == 'function_call':
-                #     function_calls['arguments'] = load_data_to_json(function_calls['arguments'])
-                #     return return_result({'function_calls': function_calls}, lines_printed)
+                    choice = json_line['choices'][0]
+                    finish_reason = choice.get('finish_reason') or finish_reason
 
-                json_line = choice['delta']
+                    # if 'finish_reason' in choice and choice['finish_reason'] == 'function_call':
+                    #     function_calls['arguments'] = load_data_to_json(function_calls['arguments'])
+                    #     return return_result({'function_calls': function_calls}, lines_printed)
 
-            except json.JSONDecodeError as e:
-                logger.error(f'Unable to decode line: {line} {e.msg}')
-                continue  # skip to the next line
+                    json_line = choice['delta']
 
-            # handle the streaming response
-            # if 'function_call' in json_line:
-            #     if 'name' in json_line['function_call']:
-            #         function_calls['name'] = json_line['function_call']['name']
-            #         print(f'Function call: {function_calls["name"]}')
-            #
-            #     if 'arguments' in json_line['function_call']:
-            #         function_calls['arguments'] += json_line['function_call']['arguments']
-            #         print(json_line['function_call']['arguments'], type='stream', end='', flush=True)
+                except json.JSONDecodeError as e:
+                    logger.error(f'Unable to decode line: {line} {e.msg}')
+                    continue  # skip to the next line
+
+                # handle the streaming response
+                # if 'function_call' in json_line:
+                #     if 'name' in json_line['function_call']:
+                #         function_calls['name'] = json_line['function_call']['name']
+                #         print(f'Function call: {function_calls["name"]}')
+                #
+                #     if 'arguments' in json_line['function_call']:
+                #         function_calls['arguments'] += json_line['function_call']['arguments']
+                #         print(json_line['function_call']['arguments'], type='stream', end='', flush=True)
 
-            if 'content' in json_line:
                 content = json_line.get('content')
+                if json_line.get('tool_calls'):
+                    # With `LLM_JSON_TRANSPORT=tools` the JSON response is streamed as the tool call arguments
+                    content = ''.join(tool_call.get('function', {}).get('arguments') or ''
+                                      for tool_call in json_line['tool_calls'])
                 if content:
+                    if json_parser:
+                        json_parser.feed(content)
                     buffer += content  # accumulate the data
 
                     # If you detect a natural breakpoint (e.g., line break or end of a response object), print & count:
                     if buffer.endswith('\n'):
                         if expecting_json and not received_json:
-                            received_json = assert_json_response(buffer, lines_printed > 2)
+                            received_json = json_parser.started or assert_json_response(buffer, lines_printed > 2)
 
                         # or some other condition that denotes a breakpoint
                         lines_printed += count_lines_based_on_width(buffer, terminal_width)
                         buffer = ""  # reset the buffer
 
                     gpt_response += content
-                    print(content, type='stream', end='', flush=True)
-
-    print('\n', type='stream')
+                    if stream_printer:
+                        stream_printer.write(content)
+                    metrics.chunks += 1
+                    metrics.chars += len(content)
+    except StreamStalledError as e:
+        if json_parser and json_parser.started:
+            # Continue the JSON response from where it stalled
+            e.function_buffer = gpt_response
+        raise
+    finally:
+        if stream_printer:
+            stream_printer.close()
+        # Stop reading the response if we gave up on it (eg. the JSON is invalid)
+        await stream.aclose()
+
+        # The tokens of failed attempts are spent too
+        if usage:
+            prompt_tokens = metrics.prompt_tokens = usage.get('prompt_tokens', prompt_tokens)
+            completion_tokens = usage.get('completion_tokens', 0)
+            metrics.usage_reported = True
+        else:
+            completion_tokens = token_counter.count(gpt_response[response_start:])
+        metrics.completion_tokens += completion_tokens
+        telemetry.inc("num_llm_tokens", prompt_tokens + completion_tokens)
+
+    if stream_printer:
+        print('\n', type='stream')
+    request_data['finish_reason'] = finish_reason
+    stream_time = time.monotonic() - stream.first_token_at
+    if stream_time > 0:
+        metrics.tokens_per_second = completion_tokens / stream_time
 
     # if function_calls['arguments'] != '':
     #     logger.info(f'Response via function call: {function_calls["arguments"]}')
@@ -425,20 +658,14 @@ def stream_gpt_completion(data, req_type, project):
     project.dot_pilot_gpt.log_chat_completion(endpoint, model, req_type, data['messages'], gpt_response)
 
     if expecting_json:
-        gpt_response = clean_json_response(gpt_response)
-        assert_json_schema(gpt_response, expecting_json)
+        # Parsed and validated once, the parsed response is passed along with the text
+        response = repair_json_response(clean_json_response(gpt_response), expecting_json, finish_reason)
         # Note, we log JSON separately from the YAML log above incase the JSON is invalid and an error is raised
-        project.dot_pilot_gpt.log_chat_completion_json(endpoint, model, req_type, expecting_json, gpt_response)
+        project.dot_pilot_gpt.log_chat_completion_json(endpoint, model, req_type, expecting_json, response.parsed)
+        return return_result(response, lines_printed)
 
     new_code = postprocessing(gpt_response, req_type)  # TODO add type dynamically
-    return return_result({'text': new_code}, lines_printed)
-
-
-def get_api_key_or_throw(env_key: str):
-    api_key = os.getenv(env_key)
-    if api_key is None:
-        raise ApiKeyNotDefinedError(env_key)
-    return api_key
+    return return_result(LLMResponse(new_code), lines_printed)
 
 
 def assert_json_response(response: str, or_fail=True) -> bool:
@@ -459,13 +686,56 @@ def clean_json_response(response: str) -> str:
 
 
 def assert_json_schema(response: str, functions: list[FunctionType]) -> True:
-    for function in functions:
-        schema = function['parameters']
-        parsed = json.loads(response)
-        validate(parsed, schema)
+    if functions:
+        load_json_response(response, functions)
         return True
 
 
+def load_json_response(response: str, functions: list[FunctionType]):
+    """
+    :return: the parsed response
+    :raises json.JSONDecodeError: if the response is invalid JSON
+    :raises ValidationError: if the response doesn't match the schema of the first function
+    """
+    parsed = json.loads(response)
+    schema_registry.get(functions).validate(parsed)
+    return parsed
+
+
+def repair_json_response(response: str, functions: list[FunctionType],
+                         finish_reason: Optional[str] = None) -> LLMResponse:
+    """
+    Validate the JSON response, repairing it locally if it isn't valid JSON (see `utils/json_repair.py`)
+    so we don't need another round trip to the LLM.
+
+    A response cut off in the middle of a string, or by the response length limit, isn't repaired:
+    closing it would lose the rest of the response, `RetryState` asks the LLM to continue it instead.
+
+    :param response: the JSON response
+    :param functions: function definitions, the first one's parameters are the schema of the response
+    :param finish_reason: (optional) why the LLM stopped, eg. 'stop' or 'length'
+    :return: the validated response, repaired if needed, with its parsed value
+    :raises json.JSONDecodeError: if the response is invalid JSON and couldn't be repaired
+    :raises ValidationError: if the response doesn't match the schema
+    """
+    try:
+        return LLMResponse(response, load_json_response(response, functions), validated=True)
+    except json.JSONDecodeError as e:
+        repaired, fixes = repair_json(response)
+        if not fixes or 'truncated_string' in fixes or (finish_reason == 'length' and 'truncated' in fixes):
+            raise
+
+        try:
+            parsed = load_json_response(repaired, functions)
+        except (json.JSONDecodeError, ValidationError) as repair_error:
+            logger.info(f'Unable to repair the JSON response ({", ".join(fixes)}): {repair_error}')
+            raise e
+
+    json_repair_stats.add_repair(fixes)
+    logger.info(f'Repaired the JSON response locally: {", ".join(fixes)}')
+    return LLMResponse(repaired, parsed, validated=True, repairs=fixes)
+
+
 def postprocessing(gpt_response: str, req_type) -> str:
     return gpt_response
 
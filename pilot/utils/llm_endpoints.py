@@ -0,0 +1,425 @@
+import asyncio
+import os
+import threading
+import time
+from logging import getLogger
+from threading import Lock
+from typing import Optional
+from urllib.parse import urlparse
+
+import requests
+
+from const.llm import LLM_CONNECT_TIMEOUT, LLM_FIRST_BYTE_TIMEOUT, LLM_HEDGE_AFTER, LLM_IDLE_TIMEOUT, \
+    MAX_GPT_MODEL_TOKENS
+from helpers.exceptions import ApiKeyNotDefinedError
+
+from .llm_rate_limiter import rate_limiter
+from .llm_sessions import session_pool
+
+log = getLogger(__name__)
+
+# OpenRouter sends these while the model is still working on the first token
+KEEP_ALIVE_LINE = b': OPENROUTER PROCESSING'
+
+# Request parameters which OpenRouter doesn't accept
+OPENROUTER_IGNORED_KEYS = ['n', 'max_tokens', 'temperature', 'top_p', 'presence_penalty', 'frequency_penalty']
+
+
+def get_endpoint_url(endpoint: str, model: str) -> str:
+    """
+    :param endpoint: 'OPENAI', 'AZURE', 'OPENROUTER' or 'LOCAL' (see `ENDPOINT` in .env)
+    :param model: model name, used as the deployment name for Azure
+    :return: chat completions URL for the endpoint
+    """
+    if endpoint == 'AZURE':
+        # If yes, get the AZURE_ENDPOINT from .ENV file
+        return os.getenv('AZURE_ENDPOINT') + '/openai/deployments/' + model + '/chat/completions?api-version=2023-05-15'
+    elif endpoint == 'OPENROUTER':
+        # If so, send the request to the OpenRouter API endpoint
+        return os.getenv('OPENROUTER_ENDPOINT', 'https://openrouter.ai/api/v1/chat/completions')
+    elif endpoint == 'LOCAL':
+        # A local OpenAI-compatible server, eg. llama.cpp or `python -m test.mock_llm_server`
+        return os.getenv('LOCAL_ENDPOINT', 'http://127.0.0.1:8080/v1/chat/completions')
+    else:
+        # If not, send the request to the OpenAI endpoint
+        return os.getenv('OPENAI_ENDPOINT', 'https://api.openai.com/v1/chat/completions')
+
+
+def get_api_key_or_throw(env_key: str):
+    api_key = os.getenv(env_key)
+    if api_key is None:
+        raise ApiKeyNotDefinedError(env_key)
+    return api_key
+
+
+class Endpoint:
+    """
+    An LLM endpoint and the model to request from it.
+    """
+
+    def __init__(self, name: Optional[str], model: str):
+        self.name = name or 'OPENAI'
+        self.model = model
+
+    def __repr__(self):
+        return f'{self.name} {self.model}'
+
+    @property
+    def url(self) -> str:
+        return get_endpoint_url(self.name, self.model)
+
+    def headers(self) -> dict[str, str]:
+        """
+        :raises ApiKeyNotDefinedError: if the API key for the endpoint is not set
+        """
+        if self.name == 'AZURE':
+            return {
+                'Content-Type': 'application/json',
+                'api-key': get_api_key_or_throw('AZURE_API_KEY')
+            }
+        elif self.name == 'OPENROUTER':
+            return {
+                'Content-Type': 'application/json',
+                'Authorization': 'Bearer ' + get_api_key_or_throw('OPENROUTER_API_KEY'),
+                'HTTP-Referer': 'https://github.com/Pythagora-io/gpt-pilot',
+                'X-Title': 'GPT Pilot'
+            }
+        elif self.name == 'LOCAL':
+            api_key = os.getenv('LOCAL_API_KEY')
+            headers = {'Content-Type': 'application/json'}
+            if api_key:
+                headers['Authorization'] = 'Bearer ' + api_key
+            return headers
+        else:
+            return {
+                'Content-Type': 'application/json',
+                'Authorization': 'Bearer ' + get_api_key_or_throw('OPENAI_API_KEY')
+            }
+
+    def request_data(self, data: dict) -> dict:
+        """
+        :param data: request data, without the request state (`function_buffer` etc.)
+        :return: copy of `data` for this endpoint
+        """
+        data = dict(data)
+        if self.name == 'OPENROUTER':
+            max_tokens = data.get('max_tokens', MAX_GPT_MODEL_TOKENS)
+            for key in OPENROUTER_IGNORED_KEYS:
+                data.pop(key, None)
+            data['max_tokens'] = max_tokens
+        elif self.name == 'OPENAI' and urlparse(self.url).hostname == 'api.openai.com':
+            # Report the token usage in the last chunk of the stream. Other servers set as `OPENAI_ENDPOINT`
+            # may reject the parameter, their usage is counted locally
+            data['stream_options'] = {'include_usage': True}
+        data['model'] = self.model
+        return data
+
+
+def get_endpoints(config: Optional[str] = None, model: Optional[str] = None) -> list[Endpoint]:
+    """
+    The endpoints to send LLM requests to, in order of preference.
+
+    `LLM_ENDPOINTS` is a comma separated list of endpoint names, each optionally followed by the model
+    to request from it, eg. `OPENAI,AZURE:gpt-4-deployment,OPENROUTER:openai/gpt-4,LOCAL:codellama`.
+    Without a model, `MODEL_NAME` is used. Without `LLM_ENDPOINTS`, only `ENDPOINT` is used.
+
+    :param config: (optional) endpoints in the `LLM_ENDPOINTS` format, eg. from a route (see `utils/llm_routing.py`)
+    :param model: (optional) model for the endpoints which don't name one, instead of `MODEL_NAME`
+    """
+    model = model or os.getenv('MODEL_NAME', 'gpt-4')
+    config = config or os.getenv('LLM_ENDPOINTS')
+    if not config:
+        return [Endpoint(os.getenv('ENDPOINT'), model)]
+
+    endpoints = []
+    for entry in config.split(','):
+        name, _, endpoint_model = entry.strip().partition(':')
+        if name:
+            endpoints.append(Endpoint(name.upper(), endpoint_model or model))
+    return endpoints
+
+
+class EndpointError(Exception):
+    """
+    A request to an LLM endpoint failed before anything was streamed.
+
+    `failover` is set for server errors (5xx) and connection errors, which other endpoints
+    (or the same endpoint a bit later) are unlikely to run into as well.
+    """
+
+    def __init__(self, endpoint: Endpoint, message: str, status_code: Optional[int] = None,
+                 response_text: Optional[str] = None):
+        super().__init__(message)
+        self.endpoint = endpoint
+        self.status_code = status_code
+        self.response_text = response_text
+
+    @property
+    def failover(self) -> bool:
+        return self.status_code is None or self.status_code >= 500
+
+
+class StreamStalledError(EndpointError):
+    """
+    An endpoint stopped sending data: no first token within `LLM_FIRST_BYTE_TIMEOUT_MS`, nothing for
+    `LLM_IDLE_TIMEOUT_MS` in the middle of the response, or the connection was dropped.
+
+    `function_buffer` is set by `astream_gpt_completion()` to the JSON received so far, if any,
+    so the request can be continued rather than started from scratch.
+    """
+
+    def __init__(self, endpoint: Endpoint, message: str):
+        super().__init__(endpoint, message)
+        self.function_buffer: Optional[str] = None
+
+
+async def aiter_lines(response):
+    """
+    Iterate over the lines of a streamed `requests` response without blocking the event loop.
+
+    The (blocking) response body is read in a background thread and handed over through a queue.
+    The response is closed when the iteration ends.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def put(item) -> bool:
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+            return True
+        except RuntimeError:
+            # The event loop is closed, nobody is reading anymore
+            return False
+
+    def read():
+        try:
+            for line in response.iter_lines():
+                if not put(line):
+                    return
+        except Exception as err:
+            put(err)
+        finally:
+            put(done)
+
+    threading.Thread(target=read, daemon=True).start()
+
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stop the reader if the stream is abandoned (eg. the LLM did not respond with JSON)
+        response.close()
+
+
+class EndpointStream:
+    """
+    A streamed response which has started answering: the lines read up to the first token, and the rest.
+
+    Iterating raises `StreamStalledError` if no line arrives for `LLM_IDLE_TIMEOUT_MS`.
+    `sent_at`, `connected_at` (response headers received) and `first_token_at` are `time.monotonic()` values.
+    """
+
+    def __init__(self, endpoint: Endpoint, response: requests.Response, first_lines: list[bytes], lines,
+                 sent_at: float, connected_at: float, first_token_at: float):
+        self.endpoint = endpoint
+        self.response = response
+        self.first_lines = first_lines
+        self.lines = lines
+        self.sent_at = sent_at
+        self.connected_at = connected_at
+        self.first_token_at = first_token_at
+
+    async def __aiter__(self):
+        for line in self.first_lines:
+            yield line
+        while True:
+            try:
+                line = await asyncio.wait_for(self.lines.__anext__(), LLM_IDLE_TIMEOUT)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                failover_stats.inc('idle_timeouts')
+                raise StreamStalledError(self.endpoint,
+                                         f'{self.endpoint} stopped sending data for {LLM_IDLE_TIMEOUT}s') from None
+            except requests.RequestException as err:
+                failover_stats.inc('dropped')
+                raise StreamStalledError(self.endpoint, f'{self.endpoint} dropped the connection: {err}') from err
+            yield line
+
+    async def aclose(self):
+        await self.lines.aclose()
+
+    def close(self):
+        self.response.close()
+
+
+class FailoverStats:
+    """
+    Counts the hedged, failed over and stalled LLM requests.
+
+    This class is a singleton, use the `failover_stats` global variable to access it.
+    """
+
+    def __init__(self):
+        self.counters = {'requests': 0, 'hedged': 0, 'failed_over': 0, 'answered_by_fallback': 0,
+                         'first_byte_timeouts': 0, 'idle_timeouts': 0, 'dropped': 0}
+        self.lock = Lock()
+
+    def inc(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
+
+
+failover_stats = FailoverStats()
+
+
+async def post(endpoint: Endpoint, data: dict) -> requests.Response:
+    """
+    Send the request in a worker thread. If we stop waiting for it, the response is closed once it arrives.
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(
+        session_pool.post,
+        endpoint.name,
+        endpoint.url,
+        headers=endpoint.headers(),
+        json=endpoint.request_data(data),
+        stream=True,
+        # The socket level timeouts are a backstop, stalls are detected by `start_stream()` and `EndpointStream`
+        timeout=(LLM_CONNECT_TIMEOUT, max(LLM_FIRST_BYTE_TIMEOUT, LLM_IDLE_TIMEOUT))
+    ))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(close_result)
+        raise
+
+
+def close_result(task: asyncio.Future):
+    """Close the response or stream of an abandoned task"""
+    if not task.cancelled() and task.exception() is None:
+        task.result().close()
+
+
+async def start_stream(endpoint: Endpoint, data: dict, num_tokens: int) -> EndpointStream:
+    """
+    Send the request to `endpoint` and wait for the first token of the response.
+
+    :raises EndpointError: if the endpoint can't be reached, responds with an error or drops the connection
+    :raises StreamStalledError: if the first token doesn't arrive within `LLM_FIRST_BYTE_TIMEOUT_MS`
+    """
+    # Wait here rather than get a `rate_limit_exceeded` error
+    await rate_limiter.acquire(endpoint.name, endpoint.model, num_tokens)
+
+    try:
+        return await asyncio.wait_for(wait_for_first_token(endpoint, data), LLM_FIRST_BYTE_TIMEOUT)
+    except asyncio.TimeoutError:
+        failover_stats.inc('first_byte_timeouts')
+        raise StreamStalledError(endpoint, f'No response from {endpoint} within {LLM_FIRST_BYTE_TIMEOUT}s') from None
+
+
+async def wait_for_first_token(endpoint: Endpoint, data: dict) -> EndpointStream:
+    sent_at = time.monotonic()
+    try:
+        response = await post(endpoint, data)
+    except requests.RequestException as err:
+        raise EndpointError(endpoint, f'Unable to connect to {endpoint.name}: {err}') from err
+    connected_at = time.monotonic()
+    rate_limiter.update(endpoint.name, endpoint.model, response.headers)
+
+    if response.status_code != 200:
+        log.info(f'problem with request to {endpoint} (status {response.status_code}): {response.text}')
+        response.close()
+        raise EndpointError(endpoint,
+                            f"API responded with status code: {response.status_code}. Response text: {response.text}",
+                            response.status_code, response.text)
+
+    lines = aiter_lines(response)
+    first_lines = []
+    try:
+        async for line in lines:
+            first_lines.append(line)
+            if line and line != KEEP_ALIVE_LINE:
+                break
+    except requests.RequestException as err:
+        await lines.aclose()
+        raise EndpointError(endpoint, f'{endpoint.name} dropped the connection: {err}') from err
+    except BaseException:
+        await lines.aclose()
+        raise
+    return EndpointStream(endpoint, response, first_lines, lines, sent_at, connected_at, time.monotonic())
+
+
+async def open_stream(endpoints: list[Endpoint], data: dict, num_tokens: int,
+                      hedge_after: float = LLM_HEDGE_AFTER) -> EndpointStream:
+    """
+    Send a streamed request to the first endpoint, hedged and failed over to the next ones.
+
+    If the first token doesn't arrive within `hedge_after` seconds (`LLM_HEDGE_AFTER_MS`), the same request is
+    also sent to the next endpoint and whichever starts answering first is used, the other one is cancelled.
+    When an endpoint fails with a server or connection error, the next endpoint is tried straight away.
+
+    >>> stream = await open_stream(get_endpoints(), data, num_tokens)
+    >>> async for line in stream:
+    ...     ...
+    >>> await stream.aclose()
+
+    :param endpoints: see `get_endpoints()`
+    :param data: request data
+    :param num_tokens: estimated number of tokens the request will use, for the rate limiter
+    :param hedge_after: seconds to wait for the first token before hedging
+    :return: the first stream to answer
+    :raises EndpointError: if no endpoint answered, the error of the preferred endpoint which wasn't a failover
+    """
+    failover_stats.inc('requests')
+    remaining = list(endpoints)
+    pending: dict[asyncio.Task, Endpoint] = {}
+    errors: list[EndpointError] = []
+
+    def start_next():
+        endpoint = remaining.pop(0)
+        pending[asyncio.create_task(start_stream(endpoint, data, num_tokens))] = endpoint
+
+    start_next()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=hedge_after if remaining else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                log.warning(f'No response from {", ".join(map(str, pending.values()))} after {hedge_after}s, '
+                            f'also sending the request to {remaining[0]}')
+                failover_stats.inc('hedged')
+                start_next()
+                continue
+
+            for task in done:
+                endpoint = pending.pop(task)
+                try:
+                    stream = task.result()
+                except EndpointError as err:
+                    errors.append(err)
+                    if err.failover and remaining:
+                        log.warning(f'{err}, failing over to {remaining[0]}')
+                        failover_stats.inc('failed_over')
+                        start_next()
+                    continue
+
+                if endpoint is not endpoints[0]:
+                    failover_stats.inc('answered_by_fallback')
+                return stream
+    finally:
+        # The losers, and any other task which finished at the same time as the winner
+        for task in pending:
+            task.add_done_callback(close_result)
+            task.cancel()
+
+    raise next((err for err in errors if not err.failover), errors[-1])
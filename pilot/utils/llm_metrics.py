@@ -0,0 +1,261 @@
+import json
+import time
+from bisect import bisect_left
+from logging import getLogger
+from threading import Lock
+from typing import Optional
+
+from const.llm import LLM_METRICS_FILE
+
+log = getLogger(__name__)
+
+# Exponential bucket boundaries, from 1/32 up to 2**19: fine enough for seconds, characters and tokens/sec
+BUCKET_BOUNDS = [2 ** exponent for exponent in range(-5, 20)]
+
+# The measurements aggregated into histograms
+HISTOGRAMS = ['connect_time', 'ttft', 'duration', 'chunks', 'chars', 'tokens_per_second',
+              'prompt_tokens', 'stable_prefix_tokens', 'cached_tokens', 'completion_tokens']
+
+# The tags measurements are aggregated by
+TAGS = ('req_type', 'prompt_path', 'model')
+
+
+class Histogram:
+    """
+    Distribution of a measurement, in fixed exponential buckets so histograms can be merged.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def add(self, value: float):
+        self.counts[bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: 'Histogram'):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """
+        :param p: percentile, eg. 90
+        :return: upper bound of the bucket containing the percentile (capped to the largest value seen)
+        """
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(BUCKET_BOUNDS[i], self.max) if i < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self) -> dict:
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': round(self.sum / self.count, 3),
+            'min': round(self.min, 3),
+            'max': round(self.max, 3),
+            'p50': round(self.percentile(50), 3),
+            'p90': round(self.percentile(90), 3),
+            'p99': round(self.percentile(99), 3),
+            # {upper bound: count}, the last bucket has no upper bound
+            'buckets': {str(BUCKET_BOUNDS[i]) if i < len(BUCKET_BOUNDS) else 'inf': count
+                        for i, count in enumerate(self.counts) if count},
+        }
+
+
+class RequestMetrics:
+    """
+    Measurements of a single LLM request, across all of its attempts.
+
+    Created by `acreate_gpt_chat_completion()` and updated by `astream_gpt_completion()` as the request proceeds.
+    All times are in seconds.
+    """
+
+    def __init__(self, req_type: str, prompt_path: Optional[str], model: str):
+        self.req_type = req_type
+        self.prompt_path = prompt_path
+        self.model = model
+        self.endpoint: Optional[str] = None
+        # See `utils/llm_routing.py`
+        self.route: Optional[str] = None
+        self.started_at = time.monotonic()
+        self.attempts = 0
+        # Tokens in the request, and how many of them were unchanged since the previous request of the
+        # conversation (ie. could be served from the provider's prompt cache)
+        self.prompt_tokens: Optional[int] = None
+        self.stable_prefix_tokens: Optional[int] = None
+        # Prompt tokens the provider reports it served from its cache, if it does
+        self.cached_tokens: Optional[int] = None
+        # Tokens in the responses of all the attempts, including the ones which failed
+        self.completion_tokens = 0
+        # Whether the provider reported the token usage, else the token counts are local estimates
+        self.usage_reported = False
+        # Of the last attempt
+        self.connect_time: Optional[float] = None
+        self.ttft: Optional[float] = None
+        self.duration: Optional[float] = None
+        self.chunks = 0
+        self.chars = 0
+        self.tokens_per_second: Optional[float] = None
+        # Class names of the errors of every failed attempt, and of the error the request failed with
+        self.attempt_errors: list[str] = []
+        self.error: Optional[str] = None
+
+    @property
+    def retries(self) -> int:
+        return max(self.attempts - 1, 0)
+
+    def start_attempt(self):
+        self.attempts += 1
+        self.connect_time = None
+        self.ttft = None
+        self.chunks = 0
+        self.chars = 0
+        self.tokens_per_second = None
+
+    def finish(self, error: Optional[Exception] = None):
+        self.duration = time.monotonic() - self.started_at
+        if error is not None:
+            self.error = type(error).__name__
+
+    def to_dict(self) -> dict:
+        return {
+            'req_type': self.req_type,
+            'prompt_path': self.prompt_path,
+            'model': self.model,
+            'endpoint': self.endpoint,
+            'route': self.route,
+            'prompt_tokens': self.prompt_tokens,
+            'stable_prefix_tokens': self.stable_prefix_tokens,
+            'cached_tokens': self.cached_tokens,
+            'completion_tokens': self.completion_tokens,
+            'usage_reported': self.usage_reported,
+            'attempts': self.attempts,
+            'retries': self.retries,
+            'connect_time': self.connect_time,
+            'ttft': self.ttft,
+            'duration': self.duration,
+            'chunks': self.chunks,
+            'chars': self.chars,
+            'tokens_per_second': self.tokens_per_second,
+            'attempt_errors': self.attempt_errors,
+            'error': self.error,
+        }
+
+
+class LLMMetrics:
+    """
+    Latency and throughput of the LLM requests, by request type (`req_type`), prompt and model.
+
+    Every request records its connect time, time to first token (`ttft`), total duration, number of
+    streamed chunks and characters, tokens per second, retries and errors, so slow steps can be traced
+    to the provider (connect time, ttft, tokens per second), to the prompt size (ttft by prompt) or to
+    retries and local processing (duration). The prompt size and its stable prefix (unchanged since the
+    previous request, so cacheable by the provider) show what the conversation layout saves.
+
+    This class is a singleton, use the `llm_metrics` global variable to access it:
+
+    >>> from utils.llm_metrics import llm_metrics
+    >>> llm_metrics.record(request_metrics)
+
+    To aggregate the histograms by some of the tags:
+
+    >>> llm_metrics.summary(('req_type',))
+    {'coding': {'requests': 12, 'retries': 1, 'failed': 0, 'errors': {'ValidationError': 1},
+                'ttft': {'count': 12, 'mean': 1.2, 'p50': 1.0, ...}, ...}}
+
+    To write all the histograms and the individual requests to a file (see `LLM_METRICS_FILE`):
+
+    >>> llm_metrics.dump('llm_metrics.json')
+
+    The individual requests are only kept when they're going to be dumped (`keep_requests`),
+    the histograms take the same memory however many requests were made.
+    """
+
+    def __init__(self, keep_requests: bool = False):
+        # (req_type, prompt_path, model) -> {'requests', 'retries', 'failed', 'errors' and a Histogram per measurement}
+        self.groups: dict[tuple, dict] = {}
+        self.keep_requests = keep_requests
+        self.requests: list[dict] = []
+        self.lock = Lock()
+
+    @staticmethod
+    def new_group() -> dict:
+        group = {'requests': 0, 'retries': 0, 'failed': 0, 'errors': {}}
+        group.update({name: Histogram() for name in HISTOGRAMS})
+        return group
+
+    @staticmethod
+    def merge_group(group: dict, other: dict):
+        group['requests'] += other['requests']
+        group['retries'] += other['retries']
+        group['failed'] += other['failed']
+        for error, count in other['errors'].items():
+            group['errors'][error] = group['errors'].get(error, 0) + count
+        for name in HISTOGRAMS:
+            group[name].merge(other[name])
+
+    def record(self, metrics: RequestMetrics):
+        key = (metrics.req_type, metrics.prompt_path, metrics.model)
+        with self.lock:
+            group = self.groups.setdefault(key, self.new_group())
+            group['requests'] += 1
+            group['retries'] += metrics.retries
+            group['failed'] += metrics.error is not None
+            for error in metrics.attempt_errors:
+                group['errors'][error] = group['errors'].get(error, 0) + 1
+            for name in HISTOGRAMS:
+                value = getattr(metrics, name)
+                if value is not None:
+                    group[name].add(value)
+            if self.keep_requests:
+                self.requests.append(metrics.to_dict())
+
+        log.debug(f'LLM request metrics: {metrics.to_dict()}')
+
+    def summary(self, group_by: tuple = TAGS) -> dict:
+        """
+        :param group_by: tags to aggregate by, any of 'req_type', 'prompt_path' and 'model'
+        :return: {"tag values separated by spaces": {'requests', 'retries', 'failed', 'errors', histograms...}}
+        """
+        merged = {}
+        with self.lock:
+            for key, group in self.groups.items():
+                tags = dict(zip(TAGS, key))
+                name = ' '.join(str(tags[tag]) for tag in group_by)
+                self.merge_group(merged.setdefault(name, self.new_group()), group)
+
+        return {
+            name: {key: value.to_dict() if isinstance(value, Histogram) else value for key, value in group.items()}
+            for name, group in merged.items()
+        }
+
+    def dump(self, path: str):
+        with self.lock:
+            requests = list(self.requests)
+        with open(path, 'w', encoding='utf-8') as fp:
+            json.dump({
+                'by_req_type': self.summary(('req_type',)),
+                'by_prompt': self.summary(('req_type', 'prompt_path', 'model')),
+                'requests': requests,
+            }, fp, indent=2)
+
+
+llm_metrics = LLMMetrics(keep_requests=bool(LLM_METRICS_FILE))
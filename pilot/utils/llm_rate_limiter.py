@@ -0,0 +1,191 @@
+import asyncio
+import random
+import re
+import time
+from collections.abc import Mapping
+from logging import getLogger
+from threading import Lock
+from typing import Optional
+
+log = getLogger(__name__)
+
+# eg. "20ms", "1s", "6m0s", "1h30m"
+DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """
+    :param value: duration from a `x-ratelimit-reset-*` header, eg. "6m0s", or a number of seconds
+    :return: seconds, or None if the value can't be parsed
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+class Bucket:
+    """
+    Token bucket for one limit (requests or tokens per minute) of an endpoint and model.
+    """
+
+    def __init__(self):
+        # Unknown until the endpoint tells us its limits
+        self.capacity: Optional[float] = None
+        self.available = 0.0
+        self.rate = 0.0
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def set(self, limit: Optional[float], remaining: float, reset: Optional[float], now: float):
+        """
+        :param limit: `x-ratelimit-limit-*`, the size of the bucket
+        :param remaining: `x-ratelimit-remaining-*`
+        :param reset: `x-ratelimit-reset-*` in seconds, the time until the bucket is full again
+        :param now: `time.monotonic()`
+        """
+        self.capacity = limit if limit else max(remaining, self.capacity or 0)
+        self.available = remaining
+        if reset and self.capacity > remaining:
+            self.rate = (self.capacity - remaining) / reset
+        else:
+            # The limits are per minute
+            self.rate = self.capacity / 60
+        self.updated_at = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """
+        Take `amount` from the bucket, going into debt if needed.
+
+        :return: seconds to wait until the debt is paid off
+        """
+        if self.capacity is None:
+            return 0
+        self.refill(now)
+        # Never wait for more than a full bucket, or we'd wait forever
+        self.available -= min(amount, self.capacity)
+        if self.available >= 0:
+            return 0
+        return -self.available / self.rate if self.rate > 0 else 60
+
+
+class RateLimiter:
+    """
+    Client-side rate limiter for the LLM endpoints, shared by all requests in the process.
+
+    Every response updates a requests and a tokens bucket for its endpoint and model from the
+    `x-ratelimit-*` headers, and a 429's `retry-after` header blocks the endpoint for a while.
+    Requests then wait before they are sent instead of failing with `rate_limit_exceeded`.
+
+    This class is a singleton, use the `rate_limiter` global variable to access it:
+
+    >>> from utils.llm_rate_limiter import rate_limiter
+
+    Before sending a request (waits if needed), and after receiving the response:
+
+    >>> await rate_limiter.acquire('OPENAI', 'gpt-4', num_tokens)
+    >>> rate_limiter.update('OPENAI', 'gpt-4', response.headers)
+
+    Waits are stretched by up to `max_jitter` (10% by default), so concurrent requests
+    that were limited together don't all retry at the same moment.
+    """
+
+    def __init__(self, max_jitter: float = 0.1):
+        self.max_jitter = max_jitter
+        # "{endpoint} {model}" -> {'requests': Bucket, 'tokens': Bucket}
+        self.buckets: dict[str, dict[str, Bucket]] = {}
+        # "{endpoint} {model}" -> time.monotonic() until which we shouldn't send requests
+        self.blocked_until: dict[str, float] = {}
+        self.num_delayed = 0
+        self.total_delay = 0.0
+        self.lock = Lock()
+
+    @staticmethod
+    def key(endpoint: Optional[str], model: str) -> str:
+        return f'{endpoint or "OPENAI"} {model}'
+
+    def jitter(self, seconds: float) -> float:
+        """
+        :return: `seconds` stretched by a random amount of up to `max_jitter`
+        """
+        return seconds * random.uniform(1, 1 + self.max_jitter)
+
+    def update(self, endpoint: Optional[str], model: str, headers: Mapping):
+        """
+        Update the limits from the headers of a response.
+
+        :param endpoint: endpoint name, eg. 'OPENAI'
+        :param model: model name
+        :param headers: response headers
+        """
+        if not isinstance(headers, Mapping):
+            return
+
+        key = self.key(endpoint, model)
+        now = time.monotonic()
+        with self.lock:
+            buckets = self.buckets.setdefault(key, {'requests': Bucket(), 'tokens': Bucket()})
+            for name, bucket in buckets.items():
+                remaining = headers.get(f'x-ratelimit-remaining-{name}')
+                if remaining is None:
+                    continue
+                try:
+                    limit = headers.get(f'x-ratelimit-limit-{name}')
+                    reset = headers.get(f'x-ratelimit-reset-{name}')
+                    bucket.set(float(limit) if limit else None, float(remaining),
+                               parse_duration(reset) if reset else None, now)
+                except ValueError:
+                    log.debug(f'Unable to parse rate limit headers for {key}: {dict(headers)}')
+
+            retry_after = headers.get('retry-after-ms')
+            retry_after = float(retry_after) / 1000 if retry_after else headers.get('retry-after')
+            if retry_after:
+                seconds = parse_duration(str(retry_after))
+                if seconds:
+                    log.debug(f'{key} asked us to retry after {seconds}s')
+                    self.blocked_until[key] = max(self.blocked_until.get(key, 0), now + seconds)
+
+    def reserve(self, endpoint: Optional[str], model: str, num_tokens: int) -> float:
+        """
+        Reserve capacity for a request.
+
+        :param endpoint: endpoint name, eg. 'OPENAI'
+        :param model: model name
+        :param num_tokens: estimated number of tokens the request will use
+        :return: seconds to wait before sending the request
+        """
+        key = self.key(endpoint, model)
+        now = time.monotonic()
+        with self.lock:
+            wait = max(self.blocked_until.get(key, 0) - now, 0)
+            buckets = self.buckets.get(key)
+            if buckets is not None:
+                wait = max(wait, buckets['requests'].reserve(1, now), buckets['tokens'].reserve(num_tokens, now))
+            if wait > 0:
+                wait = self.jitter(wait)
+                self.num_delayed += 1
+                self.total_delay += wait
+        return wait
+
+    async def acquire(self, endpoint: Optional[str], model: str, num_tokens: int):
+        """
+        Wait until a request can be sent without exceeding the rate limits.
+        """
+        wait = self.reserve(endpoint, model, num_tokens)
+        if wait > 0:
+            log.info(f'Waiting {wait:.2f}s to stay within the rate limits of {self.key(endpoint, model)}')
+            await asyncio.sleep(wait)
+
+    def stats(self) -> dict:
+        return {'delayed': self.num_delayed, 'total_delay': round(self.total_delay, 3)}
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,34 @@
+from typing import Any, Optional
+
+
+class LLMResponse(dict):
+    """
+    Response of an LLM request: `{'text': str}`, the format callers and the database already use.
+
+    A JSON response (when the request has `function_calls`) is parsed and validated against the schema once,
+    in `astream_gpt_completion()`, and carries the parsed value along, so `AgentConvo`, the logs and the
+    database don't need to parse or serialize it again.
+
+    >>> response = create_gpt_chat_completion(messages, 'coding', project, IMPLEMENT_CHANGES)
+    >>> response.text       # the JSON text, as validated (after any local repair)
+    >>> response.parsed     # the parsed JSON
+    >>> response.validated  # True if `parsed` matches the schema
+
+    Responses loaded from the database or the LLM cache are plain dicts, `parse_agent_response()` parses those.
+    """
+
+    def __init__(self, text: str, parsed: Any = None, validated: bool = False, repairs: Optional[list[str]] = None):
+        """
+        :param text: the response text
+        :param parsed: (optional) the parsed JSON response
+        :param validated: (optional) whether `parsed` was validated against the schema of the response
+        :param repairs: (optional) fixes applied to make the response valid JSON, see `utils/json_repair.py`
+        """
+        super().__init__(text=text)
+        self.parsed = parsed
+        self.validated = validated
+        self.repairs = repairs or []
+
+    @property
+    def text(self) -> str:
+        return self['text']
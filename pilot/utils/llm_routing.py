@@ -0,0 +1,132 @@
+import json
+import os
+from logging import getLogger
+from typing import Optional
+
+from const.llm import LLM_FAST_MODEL, LLM_ROUTES
+
+log = getLogger(__name__)
+
+# Small classification and summary prompts which don't need the large model
+FAST_ROUTES = {
+    # Respond with DONE or NEEDS_DEBUGGING
+    'dev_ops/ran_command.prompt': {'max_tokens': 20, 'context': 2},
+    # Respond with YES or NO
+    'dev_ops/should_rerun_command.prompt': {'max_tokens': 20, 'context': 2},
+    'utils/summary.prompt': {},
+    'development/feature_summary.prompt': {},
+}
+
+
+class Route:
+    """
+    How to send the LLM requests for a prompt or request type.
+
+    All settings are optional, by default the request is sent as usual:
+      - model: the model to use instead of `MODEL_NAME`
+      - endpoint: endpoint(s) to use instead of `ENDPOINT`/`LLM_ENDPOINTS`, in the `LLM_ENDPOINTS` format
+      - max_tokens: limit for the length of the response
+      - context: keep only the system message, the first user message (usually the task)
+        and the last `context` messages of the conversation
+    """
+
+    def __init__(self, name: str, model: Optional[str] = None, endpoint: Optional[str] = None,
+                 max_tokens: Optional[int] = None, context: Optional[int] = None):
+        self.name = name
+        self.model = model
+        self.endpoint = endpoint
+        self.max_tokens = max_tokens
+        self.context = context
+
+    def __repr__(self):
+        settings = ', '.join(f'{key}={value}' for key, value in (
+            ('model', self.model), ('endpoint', self.endpoint),
+            ('max_tokens', self.max_tokens), ('context', self.context)) if value is not None)
+        return f'{self.name} ({settings or "defaults"})'
+
+    def get_model(self) -> str:
+        """
+        :return: the model the requests are sent to
+        """
+        return self.model or os.getenv('MODEL_NAME', 'gpt-4')
+
+    def trim(self, messages: list[dict]) -> list[dict]:
+        """
+        :param messages: [{ "role": "system"|"assistant"|"user", "content": string }, ... ]
+        :return: the messages to send, according to the `context` policy
+        """
+        if self.context is None:
+            return messages
+
+        start = 1 if messages and messages[0]['role'] == 'system' else 0
+        head = messages[:start + 1]
+        tail = messages[max(len(head), len(messages) - self.context):]
+        return head + tail
+
+
+DEFAULT_ROUTE = Route('default')
+
+
+class LLMRouter:
+    """
+    Routing table for the LLM requests, by prompt path or request type (`req_type`).
+
+    The table is read from `LLM_ROUTES` (a JSON object or the path to a JSON file), eg:
+
+        {
+            "dev_ops/ran_command.prompt": {"model": "gpt-3.5-turbo", "max_tokens": 20, "context": 2},
+            "architecture": {"endpoint": "OPENROUTER:anthropic/claude-2"},
+            "*": {"model": "gpt-4-1106-preview"}
+        }
+
+    A request is routed by its prompt path, else by its request type, else by "*". If `LLM_FAST_MODEL` is set,
+    the small classification and summary prompts in `FAST_ROUTES` are routed to it, unless `LLM_ROUTES` says
+    otherwise. See `Route` for the settings.
+
+    This class is a singleton, use the `llm_router` global variable to access it:
+
+    >>> from utils.llm_routing import llm_router
+    >>> llm_router.route('coding', 'dev_ops/ran_command.prompt')
+    dev_ops/ran_command.prompt (model=gpt-3.5-turbo, max_tokens=20, context=2)
+    """
+
+    def __init__(self, routes: Optional[dict[str, dict]] = None, fast_model: Optional[str] = None):
+        """
+        :param routes: {prompt path, req_type or "*": {setting: value}}
+        :param fast_model: (optional) model for the prompts in `FAST_ROUTES`
+        """
+        self.routes: dict[str, Route] = {}
+        if fast_model:
+            for name, settings in FAST_ROUTES.items():
+                self.routes[name] = Route(name, model=fast_model, **settings)
+        for name, settings in (routes or {}).items():
+            try:
+                self.routes[name] = Route(name, **settings)
+            except TypeError as err:
+                log.error(f'Ignoring the LLM_ROUTES route for {name}, invalid settings: {err}')
+
+    @staticmethod
+    def load(config: Optional[str]) -> dict[str, dict]:
+        """
+        :param config: JSON object, or the path to a JSON file
+        :return: routes, empty if the config is missing or invalid
+        """
+        if not config:
+            return {}
+        try:
+            if config.lstrip().startswith('{'):
+                return json.loads(config)
+            with open(config, 'r', encoding='utf-8') as fp:
+                return json.load(fp)
+        except (OSError, ValueError) as err:
+            log.error(f'Ignoring the LLM_ROUTES routing table, unable to load it: {err}')
+            return {}
+
+    def route(self, req_type: Optional[str], prompt_path: Optional[str] = None) -> Route:
+        for name in (prompt_path, req_type, '*'):
+            if name in self.routes:
+                return self.routes[name]
+        return DEFAULT_ROUTE
+
+
+llm_router = LLMRouter(LLMRouter.load(LLM_ROUTES), LLM_FAST_MODEL)
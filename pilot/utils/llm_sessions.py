@@ -0,0 +1,153 @@
+from logging import getLogger
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from const.llm import LLM_POOL_SIZE, LLM_KEEP_ALIVE
+
+log = getLogger(__name__)
+
+
+class CountingAdapter(HTTPAdapter):
+    """
+    HTTP adapter that counts requests sent and TCP connections opened.
+    """
+
+    def __init__(self, **kwargs):
+        self.num_requests = 0
+        self.num_connections = 0
+        self.counter_lock = Lock()
+        super().__init__(**kwargs)
+
+    def count_connection(self):
+        with self.counter_lock:
+            self.num_connections += 1
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+        pool_classes = {}
+
+        for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items():
+            class CountingConnection(pool_cls.ConnectionCls):
+                def connect(self):
+                    adapter.count_connection()
+                    return super().connect()
+
+            pool_classes[scheme] = type(pool_cls.__name__, (pool_cls,), {'ConnectionCls': CountingConnection})
+
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+    def send(self, request, **kwargs):
+        with self.counter_lock:
+            self.num_requests += 1
+        return super().send(request, **kwargs)
+
+
+class SessionPool:
+    """
+    Process-wide pool of keep-alive HTTP sessions for the LLM endpoints.
+
+    Each endpoint (OPENAI, AZURE, OPENROUTER or a custom `OPENAI_ENDPOINT`)
+    gets its own `requests.Session`, so the TCP+TLS handshake is paid once
+    per run instead of once per prompt.
+
+    This class is a singleton, use the `session_pool` global variable to access it:
+
+    >>> from utils.llm_sessions import session_pool
+
+    To send a request over the pooled session for an endpoint:
+
+    >>> session_pool.post('OPENAI', url, headers=headers, json=data, stream=True)
+
+    To see how many requests reused an already open connection:
+
+    >>> session_pool.stats()
+    {'OPENAI api.openai.com': {'requests': 12, 'connections': 1, 'reused': 11}}
+
+    The pool size and keep-alive behaviour are configured with the
+    `LLM_POOL_SIZE` and `LLM_KEEP_ALIVE` environment variables.
+    """
+
+    def __init__(self, pool_size: int = LLM_POOL_SIZE, keep_alive: bool = LLM_KEEP_ALIVE):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.sessions: dict[str, requests.Session] = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def session_key(endpoint: str, url: str) -> str:
+        """
+        Build the key identifying the session for an endpoint.
+
+        :param endpoint: endpoint name, eg. 'OPENAI'
+        :param url: URL the request will be sent to
+        :return: endpoint name and host, eg. 'OPENAI api.openai.com'
+        """
+        return f'{endpoint} {urlsplit(url).netloc}'
+
+    def get(self, endpoint: str, url: str) -> requests.Session:
+        """
+        Get (or create) the pooled session for an endpoint.
+
+        :param endpoint: endpoint name, eg. 'OPENAI'
+        :param url: URL the request will be sent to
+        :return: the session for the endpoint
+        """
+        key = self.session_key(endpoint, url)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                log.debug(f'Opening HTTP session for {key} (pool size {self.pool_size})')
+                session = requests.Session()
+                adapter = CountingAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                if not self.keep_alive:
+                    session.headers['Connection'] = 'close'
+                self.sessions[key] = session
+            return session
+
+    def post(self, endpoint: str, url: str, **kwargs) -> requests.Response:
+        """
+        Send a POST request over the pooled session for an endpoint.
+
+        :param endpoint: endpoint name, eg. 'OPENAI'
+        :param url: URL to send the request to
+        :param kwargs: passed through to `requests.Session.post()`
+        :return: the response
+        """
+        return self.get(endpoint, url).post(url, **kwargs)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """
+        Connection reuse counters for every session in the pool.
+
+        :return: {session_key: {'requests': int, 'connections': int, 'reused': int}}
+        """
+        stats = {}
+        with self.lock:
+            for key, session in self.sessions.items():
+                adapter = session.get_adapter('https://')
+                num_requests = adapter.num_requests
+                num_connections = adapter.num_connections
+                stats[key] = {
+                    'requests': num_requests,
+                    'connections': num_connections,
+                    'reused': max(num_requests - num_connections, 0),
+                }
+        return stats
+
+    def close(self):
+        """
+        Close all pooled sessions and their connections.
+        """
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+session_pool = SessionPool()
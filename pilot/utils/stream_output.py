@@ -0,0 +1,91 @@
+import asyncio
+import time
+from threading import Lock
+from typing import Optional
+
+from const.llm import STREAM_FLUSH_INTERVAL
+
+
+class StreamStats:
+    """
+    Counts the streamed LLM deltas and the writes (terminal writes or IPC messages) they turned into.
+
+    This class is a singleton, use the `stream_stats` global variable to access it.
+    """
+
+    def __init__(self):
+        self.deltas = 0
+        self.writes = 0
+        self.lock = Lock()
+
+    def add(self, deltas: int, writes: int):
+        with self.lock:
+            self.deltas += deltas
+            self.writes += writes
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {'deltas': self.deltas, 'writes': self.writes}
+
+
+stream_stats = StreamStats()
+
+
+class StreamPrinter:
+    """
+    Coalesces the deltas of a streamed LLM response before printing them.
+
+    Printing every delta costs a terminal write, or a JSON message to the external process
+    when running with `--external-log-process-port`. Instead, the deltas are buffered and
+    printed at line breaks, or when `interval` seconds (`STREAM_FLUSH_INTERVAL_MS`) have
+    passed since the last print. When written to from a running event loop, a timer flushes
+    a partial line even if no other delta arrives, otherwise it waits for the next write.
+
+    >>> printer = StreamPrinter()
+    >>> for content in deltas:
+    ...     printer.write(content)
+    >>> printer.close()
+    """
+
+    def __init__(self, interval: float = STREAM_FLUSH_INTERVAL, stats: StreamStats = stream_stats):
+        self.interval = interval
+        self.stats = stats
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.deltas = 0
+        self.writes = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def write(self, content: str):
+        self.buffer.append(content)
+        self.deltas += 1
+        if '\n' in content or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.schedule_flush()
+
+    def schedule_flush(self) -> Optional[asyncio.TimerHandle]:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not streaming from an event loop, the next write flushes the buffer
+            return None
+        delay = max(self.interval - (time.monotonic() - self.last_flush), 0)
+        return loop.call_later(delay, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.buffer:
+            print(''.join(self.buffer), type='stream', end='', flush=True)
+            self.buffer = []
+            self.writes += 1
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Print what's left in the buffer and add the counts to `stream_stats`.
+        """
+        self.flush()
+        self.stats.add(self.deltas, self.writes)
@@ -82,6 +82,8 @@ class Telemetry:
             "num_llm_requests": 0,
             # Number of tokens used for LLM requests
             "num_llm_tokens": 0,
+            # LLM request latency and throughput histograms by request type (see utils/llm_metrics.py)
+            "llm_metrics": None,
             # Number of development steps
             "num_steps": 0,
             # Number of commands run during development
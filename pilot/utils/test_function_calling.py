@@ -1,6 +1,10 @@
-from const.function_calls import ARCHITECTURE
+import pytest
+from jsonschema import ValidationError
+
+from const.function_calls import ARCHITECTURE, IMPLEMENT_TASK, DEV_STEPS
 from utils.llm_connection import clean_json_response
-from .function_calling import parse_agent_response, JsonPrompter
+from .function_calling import parse_agent_response, JsonPrompter, SchemaRegistry, schema_registry, \
+    add_function_calls_to_request
 
 
 class TestFunctionCalling:
@@ -154,3 +158,86 @@ Here is the schema for the expected JSON object:
 <</SYS>>
 
 Create a web-based chat app [/INST]'''
+
+
+class TestAddFunctionCallsToRequest:
+    @staticmethod
+    def request(model='gpt-4'):
+        return {'model': model, 'messages': [{'role': 'user', 'content': 'Create a web-based chat app'}]}
+
+    def test_prompt(self):
+        gpt_data = self.request()
+
+        add_function_calls_to_request(gpt_data, ARCHITECTURE, 'prompt')
+
+        assert gpt_data['functions'] is ARCHITECTURE['definitions']
+        assert gpt_data['messages'][-1]['content'] == schema_registry.get(ARCHITECTURE['definitions']).prompt('gpt-4')
+        assert 'tools' not in gpt_data and 'response_format' not in gpt_data
+
+    def test_tools(self):
+        gpt_data = self.request()
+
+        add_function_calls_to_request(gpt_data, ARCHITECTURE, 'tools')
+
+        # The schema is only sent as the tool
+        assert len(gpt_data['messages']) == 1
+        assert gpt_data['tools'] == [{'type': 'function', 'function': ARCHITECTURE['definitions'][0]}]
+        assert gpt_data['tool_choice'] == {'type': 'function', 'function': {'name': 'process_technologies'}}
+
+    def test_json_object(self):
+        gpt_data = self.request()
+
+        add_function_calls_to_request(gpt_data, ARCHITECTURE, 'json_object')
+
+        assert gpt_data['response_format'] == {'type': 'json_object'}
+        assert len(gpt_data['messages']) == 2
+
+    @pytest.mark.parametrize('model, function_calls', [
+        ('meta-llama/codellama-34b-instruct', ARCHITECTURE),
+        ('anthropic/claude-2', ARCHITECTURE),
+        ('gpt-4', DEV_STEPS),
+    ])
+    def test_falls_back_to_prompt(self, model, function_calls):
+        gpt_data = self.request(model)
+
+        add_function_calls_to_request(gpt_data, function_calls, 'tools')
+
+        assert 'tools' not in gpt_data
+        assert len(gpt_data['messages']) == 2
+
+
+class TestSchemaRegistry:
+    def test_function_call_sets_are_precompiled(self):
+        # When
+        compiled = schema_registry.get(IMPLEMENT_TASK['definitions'])
+
+        # Then
+        assert compiled is schema_registry.get(IMPLEMENT_TASK['definitions'])
+        assert compiled.prompt('gpt-4') == JsonPrompter(False).prompt('', IMPLEMENT_TASK['definitions'], 'parse_development_task')
+        assert compiled.prompt('meta-llama/codellama-34b-instruct').startswith('[INST] <<SYS>>')
+        assert compiled.num_tokens('gpt-4') > 0
+
+    def test_dynamic_sets_are_cached_by_content(self):
+        # Given
+        registry = SchemaRegistry()
+
+        def definitions(technology):
+            return [{
+                'name': 'execute_command',
+                'description': f'Check if {technology} is installed',
+                'parameters': {'type': 'object', 'properties': {'command': {'type': 'string'}}},
+            }]
+
+        # When
+        compiled = registry.get(definitions('node'))
+
+        # Then
+        assert registry.get(definitions('node')) is compiled
+        assert registry.get(definitions('python')) is not compiled
+
+    def test_validate(self):
+        compiled = schema_registry.get(ARCHITECTURE['definitions'])
+
+        compiled.validate({'technologies': ['Node.js']})
+        with pytest.raises(ValidationError):
+            compiled.validate({'technologies': 'Node.js'})
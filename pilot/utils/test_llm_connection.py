@@ -1,20 +1,27 @@
+import asyncio
 import builtins
+import time
 from json import JSONDecodeError
 
 import pytest
-from unittest.mock import call, patch, Mock
+import requests
+from unittest.mock import call, patch, AsyncMock, Mock
 from dotenv import load_dotenv
 from jsonschema import ValidationError
 from const.function_calls import ARCHITECTURE, DEVELOPMENT_PLAN
 from helpers.AgentConvo import AgentConvo
 from helpers.Project import Project
+from helpers.exceptions import TokenLimitError
 from helpers.agents.Architect import Architect
 from helpers.agents.TechLead import TechLead
 from utils.function_calling import parse_agent_response, FunctionType
 from test.test_utils import assert_non_empty_string
 from test.mock_questionary import MockQuestionary
-from utils.llm_connection import create_gpt_chat_completion, stream_gpt_completion, \
+from utils.llm_connection import create_gpt_chat_completion, acreate_gpt_chat_completion, stream_gpt_completion, \
     assert_json_response, assert_json_schema, clean_json_response, retry_on_exception
+from utils.llm_cache import LLMCache
+from utils.llm_endpoints import EndpointError
+from utils.llm_metrics import LLMMetrics, RequestMetrics
 from main import get_custom_print
 
 load_dotenv()
@@ -364,9 +371,10 @@ class TestLlmConnection:
     def setup_method(self):
         builtins.print, ipc_client_instance = get_custom_print({})
 
-    @patch('utils.llm_connection.requests.post')
-    @patch('utils.llm_connection.time.sleep')
-    def test_rate_limit_error(self, mock_sleep, mock_post, monkeypatch):
+    @patch('utils.llm_endpoints.session_pool.post')
+    @patch('utils.llm_connection.asyncio.sleep', new_callable=AsyncMock)
+    @patch('utils.llm_rate_limiter.random.uniform', side_effect=lambda a, b: a)
+    def test_rate_limit_error(self, mock_uniform, mock_sleep, mock_post, monkeypatch):
         monkeypatch.setenv('OPENAI_API_KEY', 'secret')
 
         error_text = '''{
@@ -391,14 +399,13 @@ class TestLlmConnection:
         mock_post.side_effect = [error_response, error_response, error_response, error_response, error_response,
                                  error_response, error_response, error_response, error_response, error_response,
                                  error_response, error_response, mock_response]
-        wrapper = retry_on_exception(stream_gpt_completion)
         data = {
             'model': 'gpt-4',
             'messages': [{'role': 'user', 'content': 'testing'}]
         }
 
         # When
-        response = wrapper(data, 'test', project)
+        response = stream_gpt_completion(data, 'test', project)
 
         # Then
         assert response == {'text': 'DONE'}
@@ -408,7 +415,101 @@ class TestLlmConnection:
                                              call(6.144), call(6.144)]
         # mock_sleep.call
 
-    @patch('utils.llm_connection.requests.post')
+    @patch('utils.llm_endpoints.session_pool.post')
+    @patch('utils.llm_connection.asyncio.sleep', new_callable=AsyncMock)
+    @patch('utils.llm_rate_limiter.random.uniform', side_effect=lambda a, b: a)
+    @patch('utils.llm_connection.styled_text')
+    def test_server_error_retried_without_asking(self, mock_styled_text, mock_uniform, mock_sleep, mock_post,
+                                                 monkeypatch):
+        # Given the only endpoint can't be reached, then responds with a server error
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+        monkeypatch.setenv('ENDPOINT', 'OPENAI')
+        monkeypatch.delenv('LLM_ENDPOINTS', raising=False)
+        error_response = Mock()
+        error_response.status_code = 503
+        error_response.text = 'Service Unavailable'
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.iter_lines.return_value = [
+            b'{"choices": [{"index": 0, "delta": {"role": "assistant", "content": "DONE"}}]}'
+        ]
+        mock_post.side_effect = [requests.ConnectionError('Connection reset'), error_response, mock_response]
+        data = {
+            'model': 'gpt-4',
+            'messages': [{'role': 'user', 'content': 'testing'}]
+        }
+
+        # When
+        response = stream_gpt_completion(data, 'test', project)
+
+        # Then the request is retried with back-off instead of asking the user
+        assert response == {'text': 'DONE'}
+        assert mock_sleep.call_args_list == [call(2), call(4)]
+        mock_styled_text.assert_not_called()
+
+    @patch('utils.llm_endpoints.session_pool.post')
+    @patch('utils.llm_connection.styled_text')
+    def test_acreate_gpt_chat_completion_not_interactive(self, mock_styled_text, mock_post, monkeypatch):
+        # Given a request which fails with an error the user would be asked about
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+        monkeypatch.setenv('ENDPOINT', 'OPENAI')
+        monkeypatch.delenv('LLM_ENDPOINTS', raising=False)
+        error_response = Mock()
+        error_response.status_code = 400
+        error_response.text = 'Bad Request'
+        mock_post.return_value = error_response
+
+        # When
+        with pytest.raises(EndpointError):
+            asyncio.run(acreate_gpt_chat_completion([{'role': 'user', 'content': 'testing'}], 'test', project,
+                                                    use_cache=False, interactive_retry=False))
+
+        # Then the error is raised instead of asking the user whether to retry
+        mock_styled_text.assert_not_called()
+        assert 'interactive_retry' not in mock_post.call_args.kwargs['json']
+
+    @patch('utils.llm_endpoints.session_pool.post')
+    @patch('utils.llm_endpoints.LLM_IDLE_TIMEOUT', 0.05)
+    def test_stalled_json_response_continued(self, mock_post, monkeypatch):
+        # Given a JSON response which stalls half way
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+        monkeypatch.setenv('ENDPOINT', 'OPENAI')
+        monkeypatch.delenv('LLM_ENDPOINTS', raising=False)
+
+        def stream(*deltas, stall=False):
+            def iter_lines():
+                for delta in deltas:
+                    yield ('{"choices": [{"index": 0, "delta": {"content": "' + delta + '"}}]}').encode()
+                if stall:
+                    time.sleep(1)
+            response = Mock()
+            response.status_code = 200
+            response.iter_lines.side_effect = iter_lines
+            return response
+
+        stalled = stream('{\\"foo\\": ', '\\"ba', stall=True)
+        mock_post.side_effect = [stalled, stream('r\\"}')]
+        data = {
+            'model': 'gpt-4',
+            'messages': [{'role': 'user', 'content': 'testing'}],
+            'functions': [{
+                'name': 'test',
+                'description': 'test',
+                'parameters': {'type': 'object', 'properties': {'foo': {'type': 'string'}}},
+            }],
+        }
+
+        # When
+        response = stream_gpt_completion(data, 'test', project)
+
+        # Then the stalled stream is cancelled and the LLM is asked for the rest of the JSON
+        assert response == {'text': '{"foo": "bar"}'}
+        stalled.close.assert_called()
+        assert data['function_buffer'] == '{"foo": "ba'
+        assert 'function_error' not in data
+        assert mock_post.call_count == 2
+
+    @patch('utils.llm_endpoints.session_pool.post')
     def test_stream_gpt_completion(self, mock_post, monkeypatch):
         # Given streaming JSON response
         monkeypatch.setenv('OPENAI_API_KEY', 'secret')
@@ -429,7 +530,7 @@ class TestLlmConnection:
 
         mock_post.return_value = mock_response
 
-        with patch('utils.llm_connection.requests.post', return_value=mock_response):
+        with patch('utils.llm_endpoints.session_pool.post', return_value=mock_response):
             # When
             response = stream_gpt_completion({
                 'model': 'gpt-4',
@@ -439,6 +540,282 @@ class TestLlmConnection:
             # Then
             assert response == {'text': '{\n  "foo": "bar",\n  "prompt": "Hello",\n  "choices": []\n}'}
 
+    @patch('utils.llm_endpoints.session_pool.post')
+    def test_create_gpt_chat_completion_cache(self, mock_post, monkeypatch, tmp_path):
+        # Given a response which finished normally
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+        monkeypatch.setenv('ENDPOINT', 'OPENAI')
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.iter_lines.return_value = [
+            b'{"choices": [{"index": 0, "delta": {"role": "assistant", "content": "DONE"}}]}',
+            b'{"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}',
+        ]
+        mock_post.return_value = mock_response
+        messages = [{'role': 'user', 'content': 'testing'}]
+
+        with patch('utils.llm_connection.llm_cache', LLMCache(enabled=True, cache_dir=tmp_path)) as cache:
+            # When the same request is sent twice
+            first = create_gpt_chat_completion(messages, 'test', project)
+            second = create_gpt_chat_completion(messages, 'test', project)
+            # Or the cache is bypassed
+            third = create_gpt_chat_completion(messages, 'test', project, use_cache=False)
+
+        # Then the 2nd response comes from the cache
+        assert first == second == third == {'text': 'DONE'}
+        assert mock_post.call_count == 2
+        assert cache.stats() == {'hits': 1, 'misses': 1}
+
+    @patch('utils.llm_endpoints.session_pool.post')
+    def test_create_gpt_chat_completion_metrics(self, mock_post, monkeypatch):
+        # Given a JSON response which is invalid the first time
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+        monkeypatch.setenv('ENDPOINT', 'OPENAI')
+        monkeypatch.setenv('MODEL_NAME', 'gpt-4')
+        monkeypatch.delenv('LLM_ENDPOINTS', raising=False)
+
+        def stream(*deltas):
+            response = Mock()
+            response.status_code = 200
+            response.iter_lines.return_value = [
+                ('{"choices": [{"index": 0, "delta": {"content": "' + delta + '"}}]}').encode() for delta in deltas
+            ]
+            return response
+
+        mock_post.side_effect = [stream('{\\"foo\\": 42}'), stream('{\\"foo\\": ', '\\"bar\\"}')]
+        function_calls = {'definitions': [{
+            'name': 'foo',
+            'description': 'foo',
+            'parameters': {'type': 'object', 'properties': {'foo': {'type': 'string'}}},
+        }], 'functions': {}}
+
+        # When
+        with patch('utils.llm_connection.llm_metrics', LLMMetrics(keep_requests=True)) as metrics:
+            create_gpt_chat_completion([{'role': 'user', 'content': 'testing'}], 'coding', project,
+                                       function_calls, use_cache=False, prompt_path='development/test.prompt')
+
+        # Then the request is measured, tagged by request type, prompt and model
+        summary = metrics.summary()['coding development/test.prompt gpt-4']
+        assert summary['requests'] == 1
+        assert summary['retries'] == 1
+        assert summary['errors'] == {'ValidationError': 1}
+        assert summary['chunks']['max'] == 2
+        assert summary['ttft']['count'] == summary['duration']['count'] == 1
+        assert metrics.requests[0]['endpoint'] == 'OPENAI'
+        assert metrics.requests[0]['chars'] == len('{"foo": "bar"}')
+
+    @patch('utils.function_calling.LLM_JSON_TRANSPORT', 'tools')
+    @patch('utils.llm_endpoints.session_pool.post')
+    def test_create_gpt_chat_completion_tool_call(self, mock_post, monkeypatch):
+        # Given the JSON response is streamed as the arguments of a tool call
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+        monkeypatch.setenv('ENDPOINT', 'OPENAI')
+        monkeypatch.setenv('MODEL_NAME', 'gpt-4')
+        monkeypatch.delenv('LLM_ENDPOINTS', raising=False)
+
+        def tool_call(arguments):
+            return ('{"choices": [{"index": 0, "delta": {"tool_calls": [{"index": 0, "function": {"arguments": "'
+                    + arguments + '"}}]}}]}').encode()
+
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.iter_lines.return_value = [
+            b'{"choices": [{"index": 0, "delta": {"role": "assistant", "content": null, "tool_calls": '
+            b'[{"index": 0, "id": "call_1", "type": "function", '
+            b'"function": {"name": "process_technologies", "arguments": ""}}]}}]}',
+            tool_call('{\\"technologies\\": '),
+            tool_call('[\\"Node.js\\"]}'),
+            b'{"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}',
+        ]
+        mock_post.return_value = mock_response
+
+        # When
+        response = create_gpt_chat_completion([{'role': 'user', 'content': 'testing'}], 'architecture', project,
+                                              ARCHITECTURE, use_cache=False)
+
+        # Then the schema is sent as a tool instead of a message
+        assert response == {'text': '{"technologies": ["Node.js"]}'}
+        sent = mock_post.call_args.kwargs['json']
+        assert sent['tool_choice'] == {'type': 'function', 'function': {'name': 'process_technologies'}}
+        assert len(sent['messages']) == 1
+
+    @patch('utils.llm_connection.telemetry')
+    @patch('utils.llm_endpoints.session_pool.post')
+    def test_create_gpt_chat_completion_usage(self, mock_post, mock_telemetry, monkeypatch):
+        # Given a response with the token usage in the last chunk
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+        monkeypatch.setenv('ENDPOINT', 'OPENAI')
+        monkeypatch.delenv('LLM_ENDPOINTS', raising=False)
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.iter_lines.return_value = [
+            b'{"choices": [{"index": 0, "delta": {"role": "assistant", "content": "DONE"}}]}',
+            b'{"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}',
+            b'{"choices": [], "usage": {"prompt_tokens": 12, "completion_tokens": 1, '
+            b'"prompt_tokens_details": {"cached_tokens": 0}}}',
+        ]
+        mock_post.return_value = mock_response
+        metrics = RequestMetrics('test', None, None)
+
+        # When
+        create_gpt_chat_completion([{'role': 'user', 'content': 'testing'}], 'test', project,
+                                   use_cache=False, metrics=metrics)
+
+        # Then the provider's usage is used instead of local counts
+        assert mock_post.call_args.kwargs['json']['stream_options'] == {'include_usage': True}
+        assert (metrics.prompt_tokens, metrics.completion_tokens, metrics.cached_tokens) == (12, 1, 0)
+        assert metrics.usage_reported
+        mock_telemetry.inc.assert_any_call('num_llm_tokens', 13)
+
+    @patch('utils.llm_endpoints.session_pool.post')
+    def test_create_gpt_chat_completion_cache_incomplete(self, mock_post, monkeypatch, tmp_path):
+        # Given a response which was cut off
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+        monkeypatch.setenv('ENDPOINT', 'OPENAI')
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.iter_lines.return_value = [
+            b'{"choices": [{"index": 0, "delta": {"role": "assistant", "content": "DO"}}]}',
+        ]
+        mock_post.return_value = mock_response
+        messages = [{'role': 'user', 'content': 'testing'}]
+
+        with patch('utils.llm_connection.llm_cache', LLMCache(enabled=True, cache_dir=tmp_path)) as cache:
+            # When
+            create_gpt_chat_completion(messages, 'test', project)
+            create_gpt_chat_completion(messages, 'test', project)
+
+        # Then the partial response is not cached
+        assert mock_post.call_count == 2
+        assert cache.stats() == {'hits': 0, 'misses': 2}
+
+    @patch('utils.llm_endpoints.session_pool.post')
+    def test_stream_gpt_completion_aborts_invalid_json(self, mock_post, monkeypatch):
+        # Given a JSON response with an invalid value early on, then a valid response
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+
+        def stream(*deltas):
+            response = Mock()
+            response.status_code = 200
+            response.iter_lines.return_value = iter([
+                ('{"choices": [{"index": 0, "delta": {"role": "assistant", "content": "' + delta + '"}}]}').encode()
+                for delta in deltas
+            ])
+            return response
+
+        invalid_response = stream('{\\"type\\": 42,', ' \\"foo\\": \\"', 'bar\\"}')
+        mock_post.side_effect = [invalid_response, stream('{\\"type\\": \\"foo\\"}')]
+        data = {
+            'model': 'gpt-4',
+            'messages': [{'role': 'user', 'content': 'testing'}],
+            'functions': [{
+                'name': 'test',
+                'description': 'test',
+                'parameters': {'type': 'object', 'properties': {'type': {'type': 'string'}}},
+            }],
+        }
+
+        # When
+        response = stream_gpt_completion(data, 'test', project)
+
+        # Then the invalid response is closed and the request is retried
+        assert response == {'text': '{"type": "foo"}'}
+        invalid_response.close.assert_called()
+        assert data['function_error'] == "at $.type - 42 is not of type 'string'"
+        assert mock_post.call_count == 2
+
+    @patch('utils.llm_endpoints.session_pool.post')
+    def test_stream_gpt_completion_mismatched_bracket(self, mock_post, monkeypatch):
+        # Given a JSON response with a missing `]`
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.iter_lines.return_value = [
+            ('{"choices": [{"index": 0, "delta": {"role": "assistant", "content": "' + delta + '"}}]}').encode()
+            for delta in ['{\\"type\\": \\"foo\\", ', '\\"tags\\": [\\"a\\"}', ' ']
+        ] + [b'{"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}']
+        mock_post.return_value = mock_response
+        data = {
+            'model': 'gpt-4',
+            'messages': [{'role': 'user', 'content': 'testing'}],
+            'functions': [{
+                'name': 'test',
+                'description': 'test',
+                'parameters': {'type': 'object', 'properties': {
+                    'type': {'type': 'string'},
+                    'tags': {'type': 'array', 'items': {'type': 'string'}},
+                }},
+            }],
+        }
+
+        # When
+        response = stream_gpt_completion(data, 'test', project)
+
+        # Then the response is streamed to the end and repaired locally instead of retried
+        assert response == {'text': '{"type": "foo", "tags": ["a"]}'}
+        assert response.repairs == ['missing_bracket']
+        assert mock_post.call_count == 1
+
+    @patch('utils.llm_endpoints.session_pool.post')
+    @patch('utils.token_counter.LLM_CONTEXT_WINDOW', 1000)
+    def test_create_gpt_chat_completion_token_limit(self, mock_post, monkeypatch):
+        # Given messages which don't leave room for the response
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+        messages = [{'role': 'user', 'content': 'testing ' * 500}]
+
+        # When
+        with pytest.raises(TokenLimitError):
+            create_gpt_chat_completion(messages, 'test', project)
+
+        # Then the request is not sent
+        mock_post.assert_not_called()
+
+    @patch('utils.llm_endpoints.session_pool.post')
+    def test_acreate_gpt_chat_completion_concurrent(self, mock_post, monkeypatch):
+        # Given two requests, the first of which gets an invalid JSON response and is retried
+        monkeypatch.setenv('OPENAI_API_KEY', 'secret')
+        monkeypatch.setenv('ENDPOINT', 'OPENAI')
+
+        def respond(url, json, **kwargs):
+            content = json['messages'][0]['content']
+            if content == 'first' and len(json['messages']) == 2:
+                # cut off in the middle of a string, so it can't be repaired locally
+                content = '{\\"foo\\": \\"ba'
+            elif content == 'first':
+                # the rest of the incomplete JSON
+                content = 'r\\"}'
+            response = Mock()
+            response.status_code = 200
+            response.iter_lines.return_value = [
+                ('{"choices": [{"index": 0, "delta": {"role": "assistant", "content": "' + content + '"}}]}').encode()
+            ]
+            return response
+
+        mock_post.side_effect = lambda endpoint, url, **kwargs: respond(url, **kwargs)
+        first_messages = [{'role': 'user', 'content': 'first'}]
+        second_messages = [{'role': 'user', 'content': 'second'}]
+        function_calls = {'definitions': [{
+            'name': 'foo',
+            'description': 'foo',
+            'parameters': {'type': 'object', 'properties': {'foo': {'type': 'string'}}, 'required': ['foo']},
+        }], 'functions': {}}
+
+        async def send_both():
+            return await asyncio.gather(
+                acreate_gpt_chat_completion(first_messages, 'test', project, function_calls),
+                acreate_gpt_chat_completion(second_messages, 'test', project))
+
+        # When
+        first, second = asyncio.run(send_both())
+
+        # Then each request gets its own response and retry state
+        assert first == {'text': '{"foo": "bar"}'}
+        assert second == {'text': 'second'}
+        assert mock_post.call_count == 3
+        # and the caller's messages are left untouched
+        assert first_messages == [{'role': 'user', 'content': 'first'}]
+        assert second_messages == [{'role': 'user', 'content': 'second'}]
+
 
     @pytest.mark.uses_tokens
     @pytest.mark.parametrize('endpoint, model', [
@@ -0,0 +1,128 @@
+import hashlib
+import math
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock
+from typing import Optional
+
+import tiktoken
+
+from const.llm import LLM_CONTEXT_WINDOW, MODEL_CONTEXT_WINDOWS
+
+log = getLogger(__name__)
+
+# Every message is wrapped in `<|start|>{role}\n{content}<|end|>\n` and every reply is primed with
+# `<|start|>assistant<|message|>`, see https://github.com/openai/openai-cookbook (How to count tokens)
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+
+def get_context_window(model: Optional[str]) -> Optional[int]:
+    """
+    :param model: model name, eg. `gpt-4-1106-preview`, or `openai/gpt-4-1106-preview` for OpenRouter
+    :return: tokens in the context window of the model: `LLM_CONTEXT_WINDOW` if set, else the window
+        of the model in `MODEL_CONTEXT_WINDOWS`, None if the model is unknown
+    """
+    if LLM_CONTEXT_WINDOW:
+        return LLM_CONTEXT_WINDOW
+
+    name = (model or '').rsplit('/', 1)[-1]
+    prefixes = [prefix for prefix in MODEL_CONTEXT_WINDOWS if name.startswith(prefix)]
+    if not prefixes:
+        return None
+    return MODEL_CONTEXT_WINDOWS[max(prefixes, key=len)]
+
+
+class TokenCounter:
+    """
+    Counts tokens with a shared tokenizer, memoizing the count of every text by its content hash.
+
+    The tokenizer is loaded once, and counting a conversation again after a message was added
+    or changed only encodes that message, so the count can be checked before every request.
+
+    This class is a singleton, use the `token_counter` global variable to access it:
+
+    >>> from utils.token_counter import token_counter
+
+    To count the tokens in a text or a conversation:
+
+    >>> token_counter.count('Hello world')
+    2
+    >>> token_counter.count_messages([{'role': 'user', 'content': 'Hello world'}])
+    10
+
+    If the tokenizer can't be loaded (eg. tiktoken can't download its data while offline),
+    tokens are estimated at 4 characters per token.
+    """
+
+    def __init__(self, encoding_name: str = 'cl100k_base', max_entries: int = 4096):
+        self.encoding_name = encoding_name
+        self.max_entries = max_entries
+        self.counts: OrderedDict[str, int] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.encoder = None
+        self.encoder_loaded = False
+        self.lock = Lock()
+
+    def get_encoder(self) -> Optional[tiktoken.Encoding]:
+        """
+        :return: the tokenizer (GPT-4), or None if it isn't available
+        """
+        if not self.encoder_loaded:
+            try:
+                self.encoder = tiktoken.get_encoding(self.encoding_name)
+            except Exception as err:
+                log.warning(f'Unable to load the {self.encoding_name} tokenizer, estimating token counts: {err}')
+            self.encoder_loaded = True
+        return self.encoder
+
+    def encode_len(self, text: str) -> int:
+        encoder = self.get_encoder()
+        if encoder is None:
+            return math.ceil(len(text) / 4)
+        return len(encoder.encode(text, disallowed_special=()))
+
+    def count(self, text: str) -> int:
+        """
+        :param text: text to count the tokens in
+        :return: number of tokens
+        """
+        if not text:
+            return 0
+
+        key = hashlib.sha1(text.encode('utf-8', errors='surrogatepass')).hexdigest()
+        with self.lock:
+            num_tokens = self.counts.get(key)
+            if num_tokens is not None:
+                self.counts.move_to_end(key)
+                self.hits += 1
+                return num_tokens
+            self.misses += 1
+
+        num_tokens = self.encode_len(text)
+        with self.lock:
+            self.counts[key] = num_tokens
+            if len(self.counts) > self.max_entries:
+                self.counts.popitem(last=False)
+        return num_tokens
+
+    def count_message(self, message: dict) -> int:
+        """
+        :param message: { "role": "system"|"assistant"|"user", "content": string }
+        :return: number of tokens the message takes in a request
+        """
+        return TOKENS_PER_MESSAGE + self.count(message['role']) + self.count(message['content'])
+
+    def count_messages(self, messages: list[dict]) -> int:
+        """
+        :param messages: [{ "role": "system"|"assistant"|"user", "content": string }, ... ]
+        :return: number of tokens the messages take in a request, including the reply priming
+        """
+        return sum(self.count_message(message) for message in messages) + TOKENS_PER_REPLY
+
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+token_counter = TokenCounter()